@@ -35,7 +35,11 @@ USAGE='''
  -------------------
  frocc --cancel
 
- 6. Further help
+ 6. Benchmark the post-imaging stages on synthetic data
+ -----------------------------------------------------
+ frocc --bench [--scales 512x32,1024x64] [--workers 4]
+
+ 7. Further help
  ---------------
  frocc --readme
  frocc --help
@@ -4,7 +4,7 @@ import sys
 import os
 import re
 
-from frocc.lhelpers import get_config_in_dot_notation, get_basename_from_path, get_statusList, SEPERATOR, SEPERATOR_HEAVY
+from frocc.lhelpers import get_config_in_dot_notation, get_basename_from_path, get_statusList, get_channel_index, SEPERATOR, SEPERATOR_HEAVY
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
 
@@ -58,6 +58,7 @@ def get_missingImageList(conf, mode=None):
     missingImageList = []
     flatChannelList = [item for sublist in conf.data.predictedOutputChannels for item in sublist]
     channelSet = set(flatChannelList)
+    index = get_channel_index(conf) if os.path.isdir(conf.env.dirImages) else {}
     for channelNumber in channelSet:
         outputMS = (
             conf.env.dirImages
@@ -69,7 +70,7 @@ def get_missingImageList(conf, mode=None):
             outputMS += conf.env.extTcleanImageSmoothed
         else:
             outputMS += conf.env.extTcleanImage
-        if not os.path.exists(outputMS):
+        if os.path.basename(outputMS) not in index:
             missingImageList.append(outputMS)
     return missingImageList
 
@@ -93,6 +94,12 @@ def check_final_output_files(conf):
     outputExtList = conf.env.outputExtList
     if conf.input.smoothbeam:
         outputExtList += conf.env.outputExtSmoothedList
+        if conf.input.averageMapBands:
+            outputExtList += conf.env.outputExtAveragemapBandsList
+    if "cube_rmsynth.py" in conf.input.runScripts:
+        outputExtList += conf.env.outputExtRmsynthList
+        if conf.input.rmsynthWriteFdf:
+            outputExtList += ["extCubeRmsynthFdfFits"]
     # 
     for outputExt in outputExtList:
         if conf.env[outputExt].lower().endswith(".hdf5"):
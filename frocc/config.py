@@ -16,6 +16,9 @@ FILEPATH_CONFIG_TEMPLATE_ORIGINAL = os.path.join(PATH_PACKAGE, FILEPATH_CONFIG_T
 FILEPATH_LOG_PIPELINE = "pipeline.log"
 FILEPATH_LOG_TIMER = "timer.log"
 
+# slurm job ID of the imaging, handed over to the streaming buildcube
+ENVVAR_IMAGING_JOB_ID = "FROCC_IMAGING_JOB_ID"
+
 
 SPECIAL_FLAGS = [
         "--help",
@@ -31,5 +34,6 @@ SPECIAL_FLAGS = [
         "--status",
         "-s",
         "--copyScripts",
+        "--bench",
         ]
 
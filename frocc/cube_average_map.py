@@ -29,12 +29,13 @@ from glob import glob
 import re
 import shutil
 import sys
+import multiprocessing
 import click
 
 import numpy as np
 from astropy.io import fits
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header
+from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header, get_channel_statsDict, write_stats_store, CubeBlockWriter, get_channelBlockList, get_peak_rss, get_filepathAveragemapSums, read_manifest_sources, get_average_map_state, read_average_map_state, write_average_map_state, remove_average_map_state, get_deltaWeights, get_countsDtype, get_tileList_and_channelsPerBlock, accumulate_weighted_sums
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
 
@@ -48,50 +49,58 @@ from frocc.logger import *
 #    format="%(asctime)s\t[ %(levelname)s ]\t%(message)s", level=logging.INFO
 #)
 
+# robust average maps: the histograms cover +-ROBUST_HISTOGRAM_RANGE times the noise
+ROBUST_HISTOGRAM_RANGE = 1e6
+# robust average maps: pixels per chunk when reading the values from the histograms
+ROBUST_HISTOGRAM_CHUNK = 1024
+
 # SETTINGS
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-def make_empty_image(conf, mode="normal"):
+def get_frequencies_from_header(header):
     """
-    Generate an empty dummy fits data cube.
-
-    The data cube dimensions are derived from the cube images.
-
+    Returns the frequencies in Hz of all channels of the cube `header`.
     """
-    cubeNameInput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
-    cubeNameOutput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
-        
-    info(SEPERATOR)
-    info(f"Getting image dimension for data cube from: {cubeNameInput}")
-    hduCubeInput = fits.open(cubeNameInput, memmap=True, mode="update")
-    xdim, ydim = np.squeeze(hduCubeInput[0].data).shape[-2:]
-
-    info("X-dimension: %s", xdim)
-    info("Y-dimension: %s", ydim)
-
-    zdim = 1
-    info(f"Z-dimension: {zdim}")
-
-    info("Assuming full Stokes for dimension W.")
-    wdim = 3
-    info("W-dimension: %s", wdim)
-
-    dims = tuple([xdim, ydim, zdim, wdim])
+    return np.array([calculate_channelFreq_from_header(header, ii) for ii in range(int(header["NAXIS3"]))], dtype=np.float64)
 
-    # create header
 
-    dummy_dims = tuple(1 for d in dims)
-    #dummy_data = np.ones(dummy_dims, dtype=np.float64) * np.nan
-    #dummy_data = dummy_data.fill(np.nan)
-    dummy_data = np.zeros(dummy_dims, dtype=np.float32)
-    hdu = fits.PrimaryHDU(data=dummy_data)
+def get_bandList(conf, frequencies):
+    """
+    Returns the sub-bands of `averageMapBands` as list of [startFreq, stopFreq]
+    in Hz. A channel belongs to a band if startFreq <= freq < stopFreq.
 
-    header = hduCubeInput[0].header
+    Parameters
+    ----------
+    frequencies: numpy.array
+       Frequencies of all channels of the cube in Hz, used for equal-width bands
+    """
+    bands = conf.input.averageMapBands
+    if not bands:
+        return []
+    if bands == "freqRanges":
+        bands = conf.input.freqRanges
+    if isinstance(bands, int):
+        edges = np.linspace(np.min(frequencies), np.max(frequencies), bands + 1)
+        # the last band includes the highest channel
+        edges[-1] = np.nextafter(edges[-1], np.inf)
+        return [[edges[ii], edges[ii + 1]] for ii in range(bands)]
+    bandList = []
+    for freqRange in bands:
+        startFreq, stopFreq = freqRange.split("-")
+        bandList.append([float(startFreq) * 1e6, np.nextafter(float(stopFreq) * 1e6, np.inf)])
+    return bandList
+
+
+def write_empty_cube(header, cubeNameOutput, dims):
+    """
+    Writes a fits cube of zeros with the dimensions `dims` [x, y, z, w] and
+    `header`, without allocating its data in memory.
+    """
+    header = header.copy()
     for i, dim in enumerate(dims, 1):
         header["NAXIS%d" % i] = dim
 
-
     header.tofile(cubeNameOutput, overwrite=True)
 
     # create full-sized zero image
@@ -99,7 +108,7 @@ def make_empty_image(conf, mode="normal"):
     header_size = len(
         header.tostring()
     )  # Probably 2880. We don't pad the header any more; it's just the bare minimum
-    data_size = np.product(dims) * np.dtype(np.float32).itemsize
+    data_size = np.prod(dims) * np.dtype(np.float32).itemsize
     # This is not documented in the example, but appears to be Astropy's default behaviour
     # Pad the total file size to a multiple of the header block size
     block_size = 2880
@@ -110,6 +119,43 @@ def make_empty_image(conf, mode="normal"):
         f.write(b"\0")
 
 
+def make_empty_image(conf, mode="normal"):
+    """
+    Generate an empty dummy fits data cube.
+
+    The data cube dimensions are derived from the cube images. If
+    `averageMapBands` is set, a second cube with one plane per sub-band gets
+    generated.
+
+    """
+    cubeNameInput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    cubeNameOutput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
+    cubeNameBands = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapBandsFits)
+        
+    info(SEPERATOR)
+    info(f"Getting image dimension for data cube from: {cubeNameInput}")
+    header = fits.getheader(cubeNameInput)
+    xdim = int(header["NAXIS1"])
+    ydim = int(header["NAXIS2"])
+
+    info("X-dimension: %s", xdim)
+    info("Y-dimension: %s", ydim)
+
+    zdim = 1
+    info(f"Z-dimension: {zdim}")
+
+    info("Assuming full Stokes for dimension W.")
+    wdim = 3
+    info("W-dimension: %s", wdim)
+
+    write_empty_cube(header, cubeNameOutput, (xdim, ydim, zdim, wdim))
+
+    noOfBands = len(get_bandList(conf, get_frequencies_from_header(header)))
+    if noOfBands:
+        info(f"Z-dimension of the sub-band average maps: {noOfBands}")
+        write_empty_cube(header, cubeNameBands, (xdim, ydim, noOfBands, wdim))
+
+
 
 
 def write_statistics_file(statsDict, conf, mode="normal"):
@@ -135,83 +181,435 @@ def write_statistics_file(statsDict, conf, mode="normal"):
             weight = round(statsDict["weight"][ii] * 1e-6, 4)
             csvData.append([chanNo, freq, weight])
         writer.writerows(csvData)
+    write_stats_store(filepathStatistics, [
+        ["chanNo", "", np.array(statsDict["chanNo"], dtype=np.int64)],
+        ["frequency", "MHz", np.array(statsDict["frequency"], dtype=np.float64) * 1e-6],
+        ["weight", "Jy^-2", np.array(statsDict["weight"], dtype=np.float64) * 1e-6],
+        ])
 
-def fill_cube_with_images(conf, mode="normal"):
+def write_bands_statistics_file(bandList, bandWeights, frequencies, conf):
+    """
+    Writes the frequency range, effective frequency, weight sum and number of
+    channels of every sub-band average map.
+
+    Parameters
+    ----------
+    bandWeights: numpy.array
+       Weights [band, chan], zero for channels outside of the band
+    """
+    filepathStatistics = conf.input.basename + conf.env.extCubeAveragemapBandsStatistics
+    weightsSum = bandWeights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        effectiveFreqs = bandWeights @ frequencies / weightsSum
+    noOfChannels = np.count_nonzero(bandWeights, axis=1)
+    legendList = ["bandNo", "start frequency [MHz]", "stop frequency [MHz]", "frequency [MHz]", "weight [Jy^-2]", "channels"]
+    info("Writing statistics file: %s", filepathStatistics)
+    with open(filepathStatistics, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [legendList]
+        for ii, (startFreq, stopFreq) in enumerate(bandList):
+            csvData.append([ii + 1, round(startFreq * 1e-6, 4), round(stopFreq * 1e-6, 4), round(effectiveFreqs[ii] * 1e-6, 4), round(weightsSum[ii] * 1e-6, 4), noOfChannels[ii]])
+        writer.writerows(csvData)
+    write_stats_store(filepathStatistics, [
+        ["bandNo", "", np.arange(1, len(bandList) + 1, dtype=np.int64)],
+        ["startFrequency", "MHz", np.array([band[0] for band in bandList], dtype=np.float64) * 1e-6],
+        ["stopFrequency", "MHz", np.array([band[1] for band in bandList], dtype=np.float64) * 1e-6],
+        ["frequency", "MHz", effectiveFreqs * 1e-6],
+        ["weight", "Jy^-2", weightsSum * 1e-6],
+        ["channels", "", noOfChannels.astype(np.int64)],
+        ])
+    return effectiveFreqs
+
+
+# Per process state of the average map workers. Filled by `init_tile_worker`
+# before the first tile gets processed.
+WORKER_STATE = {}
+
+
+def init_tile_worker(cubeNameInput, filepathSums, mapWeights, blockList, deltaWeights=None, deltaBlockList=(), cubeNameOutput=None, cubeNameBands=None, robustDict=None):
+    """
+    Initialises an average map worker.
+
+    Each worker opens its own block reader of the smoothed cube, the weighted
+    sums and block writers of the average maps and only writes the rows of the
+    tiles it gets assigned. Therefore, no locking is necessary.
+
+    Parameters
+    ----------
+    mapWeights: numpy.array
+       Weights [map, chan] of the full band map followed by the sub-band maps,
+       zero for channels not used in a map
+    blockList: list of lists
+       Blocks of consecutive channel numbers with a finite weight
+    deltaWeights: numpy.array
+       Weight changes [map, chan] since the weighted sums got computed, or None
+       to compute them from scratch
+    deltaBlockList: list of lists
+       Blocks of consecutive channel numbers with a weight change
+    cubeNameOutput: str
+       Average map, or None to only update the weighted sums
+    robustDict: dict
+       "method", "bins", "noiseScale" and "trimFraction" of a robust
+       `averageMapMethod`, or None for the weighted mean
+    """
+    WORKER_STATE["blockReader"] = CubeBlockWriter(cubeNameInput, readOnly=True)
+    WORKER_STATE["sums"] = np.load(filepathSums, mmap_mode="r+") if filepathSums else None
+    WORKER_STATE["blockWriter"] = CubeBlockWriter(cubeNameOutput) if cubeNameOutput else None
+    WORKER_STATE["bandsWriter"] = CubeBlockWriter(cubeNameBands) if cubeNameOutput and mapWeights.shape[0] > 1 else None
+    WORKER_STATE["mapWeights"] = mapWeights
+    WORKER_STATE["blockList"] = blockList
+    WORKER_STATE["deltaWeights"] = deltaWeights
+    WORKER_STATE["deltaBlockList"] = deltaBlockList
+    WORKER_STATE["robustDict"] = robustDict
+
+
+def close_tile_worker():
+    for key in ["blockReader", "blockWriter", "bandsWriter"]:
+        if WORKER_STATE.get(key):
+            WORKER_STATE[key].close()
+    WORKER_STATE["sums"] = None
+
+
+def get_histogram_binIdx(values, noiseScale, noOfBins):
+    """
+    Returns the histogram bin of every value, -1 for non-finite values.
+
+    The bins are equally spaced in asinh(value / noiseScale) within
+    +-asinh(ROBUST_HISTOGRAM_RANGE): linear around the noise level and
+    logarithmic for bright pixels. Values outside of the range get the
+    outermost bins.
+    """
+    limit = np.arcsinh(ROBUST_HISTOGRAM_RANGE)
+    finite = np.isfinite(values)
+    position = (np.arcsinh(np.where(finite, values, 0.) / noiseScale) + limit) * (noOfBins / (2 * limit))
+    binIdx = np.clip(position, 0, noOfBins - 1).astype(np.int32)
+    binIdx[~finite] = -1
+    return binIdx
+
+
+def get_values_from_histograms(counts, noiseScale, method="median", trimFraction=0.1):
+    """
+    Returns the median or the trimmed mean of every pixel from its histogram.
+
+    The values within a bin are taken as evenly spread. The median is accurate
+    to one bin and the trimmed mean to half a bin of its largest value, see
+    `get_histogram_binIdx` for the bins.
+
+    Parameters
+    ----------
+    counts: numpy.array
+       Histograms [pixel, bin]
+    trimFraction: float
+       Fraction of the lowest and of the highest values excluded by the trimmed mean
+
+    Returns
+    -------
+    values: numpy.array
+       float64 [pixel], NaN for pixels without values
+    """
+    noOfPixels, noOfBins = counts.shape
+    limit = np.arcsinh(ROBUST_HISTOGRAM_RANGE)
+    binWidth = 2 * limit / noOfBins
+    binEdges = -limit + binWidth * np.arange(noOfBins + 1)
+    binCentreValues = noiseScale * np.sinh(binEdges[:-1] + binWidth / 2)
+    values = np.empty(noOfPixels, dtype=np.float64)
+    for start in range(0, noOfPixels, ROBUST_HISTOGRAM_CHUNK):
+        chunk = counts[start:start + ROBUST_HISTOGRAM_CHUNK].astype(np.float64)
+        cumulative = np.cumsum(chunk, axis=1)
+        total = cumulative[:, -1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if method == "median":
+                # mean of the two middle order statistics, each placed within
+                # its bin as if the values of the bin were evenly spread
+                result = 0
+                pixelIdx = np.arange(len(chunk))
+                for rank in [np.floor((total + 1) / 2), np.floor(total / 2) + 1]:
+                    binIdx = np.argmax(cumulative >= rank[:, None], axis=1)
+                    below = cumulative[pixelIdx, binIdx] - chunk[pixelIdx, binIdx]
+                    fraction = (rank - 0.5 - below) / chunk[pixelIdx, binIdx]
+                    result = result + noiseScale * np.sinh(binEdges[binIdx] + fraction * binWidth) / 2
+            else:
+                lower = (trimFraction * total)[:, None]
+                upper = ((1 - trimFraction) * total)[:, None]
+                inRange = np.clip(cumulative, lower, upper) - np.clip(cumulative - chunk, lower, upper)
+                result = inRange @ binCentreValues / (upper - lower)[:, 0]
+        values[start:start + len(chunk)] = np.where(total > 0, result, np.nan)
+    return values
+
+
+def get_robust_tile(yStart, yStop):
+    """
+    Streams the rows `yStart` to `yStop` of all channels once into a histogram
+    per pixel and map and returns the median or trimmed mean [3, map, pixel]
+    of Stokes I, the linear polarised intensity sqrt(Q^2 + U^2) and Stokes V.
+    The channels are not weighted, blanked pixels of single channels are ignored.
+    """
+    robustDict = WORKER_STATE["robustDict"]
+    blockReader = WORKER_STATE["blockReader"]
+    mapWeights = WORKER_STATE["mapWeights"]
+    noOfMaps = mapWeights.shape[0]
+    noOfPixels = (yStop - yStart) * blockReader.shape[-1]
+    noOfBins = robustDict["bins"]
+    counts = np.zeros((3, noOfMaps, noOfPixels, noOfBins), dtype=get_countsDtype(blockReader.shape[1]))
+    pixelIdx = np.arange(noOfPixels)
+    for blockChanNoList in WORKER_STATE["blockList"]:
+        block = blockReader.read_rows(blockChanNoList[0] - 1, len(blockChanNoList), yStart, yStop)
+        block = block.reshape(block.shape[0], block.shape[1], -1)
+        blockReader.flush()
+        polarised = np.hypot(block[1], block[2])
+        for blockIdx, chanNo in enumerate(blockChanNoList):
+            mapIdxArray = np.flatnonzero(mapWeights[:, chanNo - 1])
+            for stokesIdx, plane in enumerate([block[0, blockIdx], polarised[blockIdx], block[3, blockIdx]]):
+                binIdx = get_histogram_binIdx(plane, robustDict["noiseScale"], noOfBins)
+                valid = binIdx >= 0
+                # every pixel appears once per channel, no duplicate indices
+                for mapIdx in mapIdxArray:
+                    counts[stokesIdx, mapIdx, pixelIdx[valid], binIdx[valid]] += 1
+        del block, polarised
+    result = np.empty((3, noOfMaps, noOfPixels), dtype=np.float64)
+    for stokesIdx in range(3):
+        for mapIdx in range(noOfMaps):
+            result[stokesIdx, mapIdx] = get_values_from_histograms(counts[stokesIdx, mapIdx], robustDict["noiseScale"], robustDict["method"], robustDict["trimFraction"])
+    return result
+
+
+def write_map_rows(rows, yStart):
+    """
+    Writes the rows [3, map, y, x] into the average map and the sub-band maps.
+    """
+    WORKER_STATE["blockWriter"].write_rows(0, yStart, rows[:, :1])
+    WORKER_STATE["blockWriter"].flush()
+    if rows.shape[1] > 1:
+        WORKER_STATE["bandsWriter"].write_rows(0, yStart, rows[:, 1:])
+        WORKER_STATE["bandsWriter"].flush()
+
+
+def process_tile(tile):
+    """
+    Computes or updates the weighted sums of the rows `yStart` to `yStop` for
+    all maps at once and writes the normalised rows into the average maps.
+    For a robust `averageMapMethod` the rows get their median or trimmed mean.
+
+    Returns
+    -------
+    peakRSS: int
+       Peak RSS of the worker in bytes
+    fromScratch: bool
+       True if the weighted sums of the tile got computed from scratch
+    """
+    yStart, yStop = tile
+    sums = WORKER_STATE["sums"]
+    mapWeights = WORKER_STATE["mapWeights"]
+    noOfMaps = mapWeights.shape[0]
+    tileShape = (3, noOfMaps, yStop - yStart, WORKER_STATE["blockReader"].shape[-1])
+    if WORKER_STATE["robustDict"]:
+        write_map_rows(get_robust_tile(yStart, yStop).astype(np.float32).reshape(tileShape), yStart)
+        return get_peak_rss(), True
+    accumulator = None
+    if WORKER_STATE["deltaWeights"] is not None:
+        accumulator = np.array(sums[:, :, yStart:yStop], dtype=np.float64).reshape(3, noOfMaps, -1)
+        if not accumulate_weighted_sums(WORKER_STATE["blockReader"], accumulator, WORKER_STATE["deltaWeights"], WORKER_STATE["deltaBlockList"], yStart, yStop):
+            accumulator = None
+    fromScratch = accumulator is None
+    if fromScratch:
+        accumulator = np.zeros((3, noOfMaps, (yStop - yStart) * tileShape[-1]), dtype=np.float64)
+        accumulate_weighted_sums(WORKER_STATE["blockReader"], accumulator, mapWeights, WORKER_STATE["blockList"], yStart, yStop)
+    sums[:, :, yStart:yStop] = accumulator.reshape(tileShape)
+    sums.flush()
+    if WORKER_STATE["blockWriter"]:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rows = (accumulator / mapWeights.sum(axis=1)[:, None]).astype(np.float32).reshape(tileShape)
+        write_map_rows(rows, yStart)
+    return get_peak_rss(), fromScratch
+
+
+def process_all_tiles(tileList, initargs, conf):
+    """
+    Processes all tiles with `averageMapWorkers` processes.
     """
-    Fills the empty data cube with fits data.
+    workers = max(1, int(conf.input.averageMapWorkers))
+    if workers == 1:
+        init_tile_worker(*initargs)
+        resultList = list(map(process_tile, tileList))
+        close_tile_worker()
+    else:
+        info(f"Processing average maps with {workers} worker processes.")
+        # fork: the weights are handed over to the workers without pickling
+        with multiprocessing.get_context("fork").Pool(processes=workers, initializer=init_tile_worker, initargs=initargs) as pool:
+            resultList = list(pool.imap_unordered(process_tile, tileList))
+    peakRSS = max(result[0] for result in resultList)
+    info(f"Peak RSS of an average map process: {peakRSS / 1024**3:.2f} GB")
+    if initargs[4] is not None:
+        noOfFromScratch = sum(result[1] for result in resultList)
+        if noOfFromScratch:
+            info(f"Removed channels hold blanked pixels in {noOfFromScratch} of {len(tileList)} tiles, their weighted sums got computed from scratch.")
+
+
+def get_rms_from_stokesV(blockReader, chanIdx, conf):
+    """
+    Returns the robust RMS noise in uJy/beam of the Stokes V plane of channel
+    index `chanIdx`, for channels without RMS noise in the statistics file.
+    """
+    stokesV = blockReader.read_channels(chanIdx, 1)[3, 0]
+    blockReader.flush()
+    return get_std_via_mad(stokesV, method=conf.input.robustStatsMethod) * 1e6
+
+
+def process_weighted_mean_tiles(cubeNameInput, cubeNameOutput, cubeNameBands, shapeCube, mapWeights, bandList, blockList, tileList, channelsPerBlock, previousState, conf):
+    """
+    Fills the weighted mean average maps. The float64 weighted sums of the
+    previous run in `previousState` get updated by the changed channels only,
+    if possible.
+    """
+    noOfMaps = mapWeights.shape[0]
+    signature, sourceDict = read_manifest_sources(cubeNameInput)
+    state = get_average_map_state(mapWeights, bandList, shapeCube, signature, sourceDict)
+    deltaWeights = get_deltaWeights(previousState, state, conf) if conf.input.averageMapIncremental else None
+    filepathSums = get_filepathAveragemapSums(conf)
+    if deltaWeights is None:
+        np.lib.format.open_memmap(filepathSums, mode="w+", dtype=np.float64, shape=(3, noOfMaps) + shapeCube[2:])
+        deltaBlockList = []
+        info(f"Processing {noOfMaps} average maps: {len(tileList)} tiles of up to {tileList[0][1]} rows, {len(blockList)} blocks of up to {channelsPerBlock} channels.")
+    else:
+        changedChanNoList = [ii + 1 for ii in np.flatnonzero(np.any(deltaWeights != 0, axis=0))]
+        deltaBlockList = get_channelBlockList(changedChanNoList, channelsPerBlock)
+        info(f"Updating {noOfMaps} average maps incrementally: {len(changedChanNoList)} channels changed since the previous run.")
+
+    initargs = (cubeNameInput, filepathSums, mapWeights, blockList, deltaWeights, deltaBlockList, cubeNameOutput, cubeNameBands)
+    process_all_tiles(tileList, initargs, conf)
+    write_average_map_state(conf, state)
 
 
+def fill_cube_with_images(conf, mode="normal"):
+    """
+    Fills the empty average map with the weighted averages of the smoothed cube.
+
+    The map is built in spatial tiles of full image rows. Every tile reads its
+    rows of all channels once and accumulates the three maps in float64, the
+    tiles get processed by `averageMapWorkers` processes within
+    `cubeMemoryBudget`. The weights are the inverse variances from the Stokes V
+    RMS noise known from buildcube. The sub-band maps of `averageMapBands` get
+    filled in the same pass.
+
+    The float64 weighted sums are kept next to the average map. If only the
+    flags of channels changed since, e.g. after a new IOR flagging, just the
+    contributions of these channels get added or subtracted.
+
+    The robust `averageMapMethod` "median" and "trimmed-mean" estimate the
+    unweighted median or trimmed mean of every pixel from a histogram that
+    gets filled in the same single pass, see `get_robust_tile`.
     """
 
     cubeNameInput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
     cubeNameOutput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
+    cubeNameBands = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapBandsFits)
 
     info(SEPERATOR)
     info(f"Opening data cube: {cubeNameInput}")
-    hudCubeInput = fits.open(cubeNameInput, memmap=True, ignore_missing_end=True, mode="update")
-    dataCubeInput = hudCubeInput[0].data
+    headerInput = fits.getheader(cubeNameInput)
+    blockReader = CubeBlockWriter(cubeNameInput, readOnly=True)
+    highestChannel = int(blockReader.shape[1])
 
-    info(f"Opening data cube: {cubeNameOutput}")
-    hudCubeOutput = fits.open(cubeNameOutput, memmap=True, ignore_missing_end=True, mode="update")
-    dataCubeOutput = hudCubeOutput[0].data
-
-    highestChannel = int(dataCubeInput.shape[1])
+    # weights from the Stokes V RMS noise computed by buildcube
+    channelStatsDict = get_channel_statsDict(conf, mode="smoothed")
+    rmsVDict = dict(zip(channelStatsDict["chanNo"], channelStatsDict["rmsStokesV"]))
+    flaggedDict = dict(zip(channelStatsDict["chanNo"], channelStatsDict["flagged"]))
 
     statsDict = {}
     statsDict["chanNo"] = []
     statsDict["weight"] = []
     statsDict["frequency"] = []
     for ii in range(0, highestChannel):
-        if np.isnan(np.sum(dataCubeInput[3, ii, :, :])):
+        chanNo = ii + 1
+        if flaggedDict.get(chanNo, True):
             w = np.nan
         else:
-            info(f"Getting RMS from Stokes V for channel {ii}")
-            rms = get_std_via_mad(dataCubeInput[3, ii, :, :])
-            w = 1/(rms**2)
-        calcFreq = calculate_channelFreq_from_header(hudCubeInput[0].header, ii)
+            rms = rmsVDict.get(chanNo, np.nan)
+            if not np.isfinite(rms):
+                rms = get_rms_from_stokesV(blockReader, ii, conf)
+                info(f"No RMS noise of channel {chanNo} in the statistics file, estimated from Stokes V: {rms} uJy/beam")
+            rms = rms * 1e-6  # uJy/beam to Jy/beam
+            w = 1/(rms**2) if np.isfinite(rms) and rms > 0 else np.nan
+        calcFreq = calculate_channelFreq_from_header(headerInput, ii)
         statsDict["frequency"].append(calcFreq)
         statsDict["weight"].append(w)
         statsDict["chanNo"].append(ii)
-
-    P_I = dataCubeOutput[0, 0, :, :]
-    P_QU = dataCubeOutput[1, 0, :, :]
-    P_V = dataCubeOutput[2, 0, :, :]
-    weightedFreqs = 0
-    for ii, w in enumerate(statsDict["weight"]):
-        info(f"Processing average maps: Progress {ii+1}/{len(statsDict['weight'])}")
-        if not np.isnan(w):
-            I = dataCubeInput[0, ii, :, :]
-            Q = dataCubeInput[1, ii, :, :]
-            #info(f"Q: Progress {Q}")
-            U = dataCubeInput[2, ii, :, :]
-            V = dataCubeInput[3, ii, :, :]
-            P_I += w * I
-            P_QU += w * np.sqrt(Q**2 + U**2)
-            #info(f"P_QU: Progress {P_QU}")
-            P_V += w * V
-            weightedFreqs += w * np.sqrt(statsDict["frequency"][ii]**2)
-    weightsSum = np.nansum(statsDict["weight"])
-    dataCubeOutput[0, 0, :, :] = P_I / weightsSum
-    dataCubeOutput[1, 0, :, :] = P_QU / weightsSum
-    dataCubeOutput[2, 0, :, :] = P_V / weightsSum
-    averagedFreq = np.nansum(weightedFreqs) / weightsSum
-
-    hudCubeInput.close()
-    hudCubeOutput.close()
+    blockReader.close()
+
+    weights = np.array(statsDict["weight"], dtype=np.float64)
+    frequencies = np.array(statsDict["frequency"], dtype=np.float64)
+    weightsSum = np.nansum(weights)
+    averagedFreq = np.nansum(weights * frequencies) / weightsSum
+
+    bandList = get_bandList(conf, frequencies)
+    bandWeights = np.zeros((len(bandList), highestChannel))
+    for bandIdx, (startFreq, stopFreq) in enumerate(bandList):
+        inBand = (frequencies >= startFreq) & (frequencies < stopFreq) & np.isfinite(weights)
+        bandWeights[bandIdx, inBand] = weights[inBand]
+        if not inBand.any():
+            warning(f"No channels with data in average map band {startFreq * 1e-6:.4f}-{stopFreq * 1e-6:.4f} MHz.")
+    mapWeights = np.vstack([np.nan_to_num(weights, nan=0.)[None, :], bandWeights])
+
+    noOfMaps = mapWeights.shape[0]
+    shapeCube = blockReader.shape
+    tileList, channelsPerBlock = get_tileList_and_channelsPerBlock(shapeCube, noOfMaps, conf)
+    blockList = get_channelBlockList([ii + 1 for ii in np.flatnonzero(np.isfinite(weights))], channelsPerBlock)
+
+    # an interrupted run leaves the sums without valid state behind
+    previousState = read_average_map_state(conf)
+    remove_average_map_state(conf)
+    if conf.input.averageMapMethod != "mean":
+        if conf.input.averageMapMethod not in ["median", "trimmed-mean"]:
+            error(f"Unknown averageMapMethod: {conf.input.averageMapMethod}")
+            raise ValueError(f"Unknown averageMapMethod: {conf.input.averageMapMethod}")
+        # the histograms are scaled by the typical channel noise in Jy/beam
+        finiteWeights = weights[np.isfinite(weights)]
+        robustDict = {
+            "method": conf.input.averageMapMethod,
+            "bins": int(conf.input.averageMapHistogramBins),
+            "noiseScale": float(np.median(1 / np.sqrt(finiteWeights))) if len(finiteWeights) else 1.,
+            "trimFraction": float(conf.input.averageMapTrimFraction),
+            }
+        info(f"Processing {noOfMaps} {robustDict['method']} average maps: {len(tileList)} tiles of up to {tileList[0][1]} rows with {robustDict['bins']} histogram bins per pixel, {len(blockList)} blocks of up to {channelsPerBlock} channels.")
+        initargs = (cubeNameInput, None, mapWeights, blockList, None, (), cubeNameOutput, cubeNameBands, robustDict)
+        process_all_tiles(tileList, initargs, conf)
+    else:
+        process_weighted_mean_tiles(cubeNameInput, cubeNameOutput, cubeNameBands, shapeCube, mapWeights, bandList, blockList, tileList, channelsPerBlock, previousState, conf)
 
     addFitsHeaderDict = {
         "CRPIX3": 1,
         "NAXIS3": 1,
         "CRVAL3": averagedFreq,
+        "AVGMETH": conf.input.averageMapMethod,
         }
     update_fits_header_of_cube(cubeNameOutput, addFitsHeaderDict)
     write_statistics_file(statsDict, conf, mode=mode)
+    outputList = [cubeNameOutput]
+
+    if bandList:
+        effectiveFreqs = write_bands_statistics_file(bandList, bandWeights, frequencies, conf)
+        # the effective frequencies are not equally spaced, the linear axis is
+        # an approximation and every plane gets its own keyword. Bands without
+        # data get their centre frequency on the axis.
+        axisFreqs = np.where(np.isfinite(effectiveFreqs), effectiveFreqs, np.mean(bandList, axis=1))
+        addFitsHeaderDict = {
+            "CRPIX3": 1,
+            "NAXIS3": len(bandList),
+            "CRVAL3": axisFreqs[0],
+            "CDELT3": (axisFreqs[-1] - axisFreqs[0]) / (len(bandList) - 1) if len(bandList) > 1 else bandList[0][1] - bandList[0][0],
+            "AVGMETH": conf.input.averageMapMethod,
+            }
+        for ii, effectiveFreq in enumerate(effectiveFreqs, 1):
+            addFitsHeaderDict[f"EFFRQ{ii:03d}"] = effectiveFreq if np.isfinite(effectiveFreq) else "NaN"
+        update_fits_header_of_cube(cubeNameBands, addFitsHeaderDict)
+        outputList.append(cubeNameBands)
 
     # make a copy to the hdf5 output directory
-    try:
-        shutil.copyfile(cubeNameOutput, os.path.join(conf.input.dirHdf5Output, os.path.basename(cubeNameOutput)))
-    except shutil.SameFileError:
-        pass
+    for filepath in outputList:
+        try:
+            shutil.copyfile(filepath, os.path.join(conf.input.dirHdf5Output, os.path.basename(filepath)))
+        except shutil.SameFileError:
+            pass
 
 
 
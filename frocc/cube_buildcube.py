@@ -20,20 +20,21 @@
 """
 
 import itertools
+import json
 import logging
+import multiprocessing
 from logging import info, error
 import os
 import csv
-import datetime
 from glob import glob
 import re
+import subprocess
 import sys
+import time
+import zlib
 import click
 import pandas as pd
 import seaborn as sns
-import casatasks
-from radio_beam import Beam, Beams
-from astropy import units
 
 import matplotlib as mpl
 mpl.use('Agg') # Backend that doesn't need X server
@@ -42,8 +43,9 @@ from matplotlib import pyplot as plt
 import numpy as np
 from astropy.io import fits
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args
-from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
+from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, update_fits_header_of_cube, DotMap, get_dict_from_click_args, get_memmap_of_cube, get_dict_from_statsFile, write_stats_store, merge_stats_stores, get_filepathStatsStore, get_channel_index, get_channelFitsfileList_from_index, CubeBlockWriter, get_channelsPerBlock, get_channelBlockList, get_peak_rss, read_channel_mask, write_channel_mask, queue_plot
+from frocc.smoothing import get_smoothing_beam, get_presmoothed_beam, get_fitsfiles_to_smooth, get_smoothedFitsname, smoother
+from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER, ENVVAR_IMAGING_JOB_ID
 
 
 
@@ -51,6 +53,14 @@ from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
 
+# partitioned buildcube: seconds to wait for the pre-allocated cube
+PARTITION_WAIT_TIMEOUT = 4 * 3600
+PARTITION_POLL_INTERVAL = 10
+# channels between two saves of the partial manifest
+MANIFEST_SAVE_INTERVAL = 50
+# streaming buildcube: seconds between two polls of the image directory
+STREAM_POLL_INTERVAL = 30
+
 logging.basicConfig(
     format="%(asctime)s\t[ %(levelname)s ]\t%(message)s", level=logging.INFO
 )
@@ -61,74 +71,6 @@ mpl.rcParams['axes.titlesize'] = 26
 sns.set_style("ticks")
 # SETTINGS
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-def smoother(fitsnames, conf):
-    """Smooth channel images to common resolution
-
-    Args:
-        fitsnames (list): List of fits files to be smoothed
-        conf (config): Config object
-
-    Returns:
-        list: List of smoothed fits files
-    """    
-    if conf.input.smoothbeam == "auto":
-        beam_list = []
-        for fitsname in fitsnames:
-            header = fits.getheader(fitsname)
-            beam = Beam.from_fits_header(header)
-            beam_list.append(beam)
-        beams = Beams(
-            major=np.array([b.major.to(units.deg).value for b in beam_list])
-            * units.deg,
-            minor=np.array([b.minor.to(units.deg).value for b in beam_list])
-            * units.deg,
-            pa=np.array([b.pa.to(units.deg).value for b in beam_list]) * units.deg,
-        )
-        common_beam = beams.common_beam()
-        major = f"{np.ceil(common_beam.major.to(units.arcsec).value)}arcsec"
-        minor = f"{np.ceil(common_beam.minor.to(units.arcsec).value)}arcsec"
-        pa = f"{np.ceil(common_beam.pa.to(units.deg).value)}deg"
-    elif conf.input.smoothbeam.find(",") > 0:
-        major, minor = conf.input.smoothbeam.split(",")
-        pa = "0deg"
-    else:
-        major = conf.input.smoothbeam
-        minor = conf.input.smoothbeam
-        pa = "0deg"
-    
-    outSmoothedFitsNames = []
-    for fitsname in fitsnames:
-        outImageName = fitsname.replace(".fits", "")
-        outSmoothedName = outImageName + ".smoothed"
-        outSmoothedFits = outSmoothedName + ".fits"
-
-        info(f"Importing: {fitsname}")
-        casatasks.importfits(
-            fitsimage=fitsname, 
-            imagename=outImageName,
-            overwrite=True,
-        )
-
-        casatasks.imsmooth(
-            imagename=outImageName,
-            outfile=outSmoothedName,
-            targetres=True,
-            kernel="gauss",
-            major=major,
-            minor=minor,
-            pa=pa,
-            overwrite=True,
-        )
-        info(f"Exporting: {outSmoothedFits}")
-        casatasks.exportfits(
-            imagename=outSmoothedName, 
-            fitsimage=outSmoothedFits, 
-            overwrite=True
-        )
-        outSmoothedFitsNames.append(outSmoothedFits)
-    return outSmoothedFitsNames
-
-
 def second_order_poly(x, coeffs):
     #y = a*x**2 + b*x + c
     poly = np.poly1d(coeffs)
@@ -158,6 +100,74 @@ def get_correction_coefficients(conf, obsid):
     return df
 
 
+def get_rotation_coefficients(conf):
+    """
+    Reads the XY-phase and polarisation angle coefficients once for all channels.
+
+    Returns
+    -------
+    rotationCoeffsDict: dict
+       Polynomial coefficients "coeffsXY" and "coeffsPol" (highest power
+       first, frequency in GHz) or None if no coefficient file is set.
+
+    """
+    if not conf.input.fileXYphasePolAngleCoeffs:
+        return None
+    # grep obsid from MS filename. TODO: find something better
+    basename = os.path.basename(os.path.normpath(conf.input.inputMS[0]))
+    obsid = re.search(r"[0-9]{10}", basename)[0]
+    info(f"Uning observation ID (obsid): {obsid}")
+    coeffs = get_correction_coefficients(conf, obsid)
+    info(f"Using correction coefficients: {coeffs.to_dict()}")
+    return {
+        "coeffsXY": [coeffs['coeffsXY_a'].to_numpy()[0], coeffs['coeffsXY_b'].to_numpy()[0], coeffs['coeffsXY_c'].to_numpy()[0]],
+        "coeffsPol": [coeffs['coeffsPol_a'].to_numpy()[0], coeffs['coeffsPol_b'].to_numpy()[0], coeffs['coeffsPol_c'].to_numpy()[0]],
+        }
+
+
+def get_rotation_angles(freqs, rotationCoeffsDict):
+    """
+    Returns the XY-phase and polarisation angles in rad for frequencies in Hz.
+
+    `freqs` can be a scalar or an array with the frequencies of many channels.
+    """
+    freqsGHz = np.asarray(freqs) * 1e-9
+    xyPhaseAngle = np.polyval(rotationCoeffsDict["coeffsXY"], freqsGHz)
+    polAngle = np.polyval(rotationCoeffsDict["coeffsPol"], freqsGHz)
+    return xyPhaseAngle, polAngle
+
+
+def rotate_stokesQUV_inplace(stokesQ, stokesU, stokesV, xyPhaseAngle, polAngle, bufferA, bufferB):
+    """
+    Applies the XY-phase and then the polarisation angle rotation in place.
+
+    The Stokes arrays are overwritten with the rotated data, the two buffers
+    of the same shape are used as scratch space. For a block of channels the
+    angles must have a shape that broadcasts against the channel axis, e.g.
+    (nChan, 1, 1).
+
+    """
+    sinXY = np.sin(xyPhaseAngle)
+    cosXY = np.cos(xyPhaseAngle)
+    # U' = U cos - V sin, V' = U sin + V cos
+    np.multiply(stokesU, sinXY, out=bufferA)
+    np.multiply(stokesV, sinXY, out=bufferB)
+    stokesU *= cosXY
+    stokesU -= bufferB
+    stokesV *= cosXY
+    stokesV += bufferA
+
+    sinPol = np.sin(polAngle)
+    cosPol = np.cos(polAngle)
+    # Q' = Q cos - U' sin, U'' = Q sin + U' cos
+    np.multiply(stokesQ, sinPol, out=bufferA)
+    np.multiply(stokesU, sinPol, out=bufferB)
+    stokesQ *= cosPol
+    stokesQ -= bufferB
+    stokesU *= cosPol
+    stokesU += bufferA
+
+
 
 def get_and_add_custom_header(lowestChannelFitsfile):
     """
@@ -209,37 +219,50 @@ def get_cropped_size_in_px(conf):
 
 
 
-def make_empty_image(conf, mode="normal"):
+def get_filepathCube(conf, mode="normal"):
+    """
+    Returns the path of the normal or smoothed data cube.
+    """
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    else:
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+
+
+def make_empty_image(conf, mode="normal", channelFitsfileList=None):
     """
     Generate an empty dummy fits data cube.
 
     The data cube dimensions are derived from the channel fits images. The
     resulting data cube can exceed the machine's RAM.
 
+    Parameters
+    ----------
+    conf: DotMap
+       Config object
+    mode: str
+       "normal" or "smoothed"
+    channelFitsfileList: list
+       Sorted channel fits files the cube is derived from. If not given, all
+       channel images in `conf.env.dirImages` are used (and smoothed for
+       mode "smoothed").
+
     """
-    if mode == "smoothed":
-        oldChannelFitsfileList = sorted(glob(conf.env.dirImages + "*.chan*image.fits"))
+    if channelFitsfileList:
+        pass
+    elif mode == "smoothed":
+        oldChannelFitsfileList = get_channelFitsfileList_from_index(get_channel_index(conf))
         channelFitsfileList = smoother(oldChannelFitsfileList, conf)
     else:
-        channelFitsfileList = sorted(glob(conf.env.dirImages + "*.chan*image.fits"))
+        channelFitsfileList = get_channelFitsfileList_from_index(get_channel_index(conf))
         
     lowestChannelFitsfile = channelFitsfileList[0]
     highestChannelFitsfile = channelFitsfileList[-1]
     info(SEPERATOR)
-    if conf.input.crop:
-        info("Getting image dimension for data cube from flag '--crop %s'", conf.input.crop)
-        xdim, ydim = get_cropped_size_in_px(conf)
-        with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-            xdim_check, ydim_check = np.squeeze(hud[0].data).shape[-2:]
-        if xdim_check < xdim or ydim_check < ydim:
-            info(f"Input dimensions {xdim_check}px,{ydim_check}px are lower than target '--crop {conf.input.crop}'")
-            info(f"Falling back to: {xdim_check}px,{ydim_check}px")
-            xdim = xdim_check
-            ydim = xdim_check
-    else:
-        info("Getting image dimension for data cube from: %s", lowestChannelFitsfile)
-        with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-            xdim, ydim = np.squeeze(hud[0].data).shape[-2:]
+    info("Getting image dimension for data cube from header of: %s", lowestChannelFitsfile)
+    cropWindow = get_crop_window(conf, fits.getheader(lowestChannelFitsfile))
+    ydim = cropWindow[0].stop - cropWindow[0].start
+    xdim = cropWindow[1].stop - cropWindow[1].start
     info("X-dimension: %s", xdim)
     info("Y-dimension: %s", ydim)
 
@@ -266,6 +289,10 @@ def make_empty_image(conf, mode="normal"):
 
     header = hdu.header
     header = get_and_add_custom_header(lowestChannelFitsfile)
+    # the cube starts with channel 1 at CRPIX3 = 1, see `update_cube_header_after_filling`
+    lowestChanNo = int(get_channelNumber_from_filename(lowestChannelFitsfile, conf.env.markerChannel))
+    header["CRVAL3"] = float(header["CRVAL3"]) - (lowestChanNo - 1) * float(header["CDELT3"])
+    info(f"Reference frequency of channel 1: {header['CRVAL3']} Hz")
     for i, dim in enumerate(dims, 1):
         header["NAXIS%d" % i] = dim
         info(header["CRPIX1"])
@@ -275,10 +302,7 @@ def make_empty_image(conf, mode="normal"):
         info(header["CRPIX1"])
         info(header["CRPIX2"])
 
-    if mode == "smoothed":
-        cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
-    else:
-        cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+    cubeName = get_filepathCube(conf, mode)
 
     header.tofile(cubeName, overwrite=True)
 
@@ -300,7 +324,7 @@ def make_empty_image(conf, mode="normal"):
 
 
 
-def check_rms(npArray):
+def check_rms(npArray, method="exact"):
     """
     Check if the Numpy Array is above 1e-6 uJy/beam.
 
@@ -311,6 +335,8 @@ def check_rms(npArray):
     ----------
     npArray: numpy.array
        The numpy array to check
+    method: str
+       Robust statistics method passed to `get_std_via_mad`
 
     Returns
     -------
@@ -318,29 +344,44 @@ def check_rms(npArray):
        List of length 2 with  the Numpy Array and the Standard Deviation
 
     """
-    std = get_std_via_mad(npArray)
+    std = get_std_via_mad(npArray, method=method)
     if (std < 1e-6):
         npArray = np.nan
         std = np.nan
     return [npArray, std]
 
 
-def write_statistics_file(statsDict, conf, mode="normal"):
+def get_filepathStatistics(conf, mode="normal"):
+    """
+    Returns the path of the statistics file of the normal or smoothed cube.
+    """
+    if mode == "smoothed":
+        return conf.input.basename + conf.env.extCubeSmoothedStatistics
+    else:
+        return conf.input.basename + conf.env.extCubeStatistics
+
+
+def write_statistics_file(statsDict, conf, mode="normal", filepathStatistics=None):
     """
-    Takes the dictionary with Stokes I and V RMS noise and writes it to a file.
+    Takes the dictionary with the channel statistics and writes it to a file.
+
+    Besides the Stokes I and V RMS noise the file holds the Stokes Q and U RMS
+    noise, the pixel position of the Stokes I maximum and the fraction of
+    blanked Stokes I pixels. This way the following stages don't need to read
+    the data cube again to get them.
 
     Parameters
     ----------
     rmdDict: dict of lists with floats
-       Dictionary with lists for Stokes I and V rms noise
+       Dictionary with lists for the channel statistics
+    filepathStatistics: str
+       Output file, defaults to the statistics file of `mode`
 
     """
     # Outputs a statistics file with estimates for RMS noise in Stokes I and V
-    if mode == "smoothed":
-        filepathStatistics = conf.input.basename + conf.env.extCubeSmoothedStatistics
-    else:
-        filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
-    legendList = ["chanNo", "frequency [MHz]", "rmsStokesI [uJy/beam]", "rmsStokesV [uJy/beam]",  "maxStokesI [uJy/beam]", "flagged", "xyPhaseCorr", "polAngleCorr"]
+    if not filepathStatistics:
+        filepathStatistics = get_filepathStatistics(conf, mode)
+    legendList = ["chanNo", "frequency [MHz]", "rmsStokesI [uJy/beam]", "rmsStokesV [uJy/beam]",  "maxStokesI [uJy/beam]", "flagged", "xyPhaseCorr", "polAngleCorr", "rmsStokesQ [uJy/beam]", "rmsStokesU [uJy/beam]", "maxStokesIposX [px]", "maxStokesIposY [px]", "nanFraction"]
     info("Writing statistics file: %s", filepathStatistics)
     with open(filepathStatistics, "w") as csvFile:
         writer = csv.writer(csvFile, delimiter="\t")
@@ -354,8 +395,28 @@ def write_statistics_file(statsDict, conf, mode="normal"):
             xyPhaseCorr = round(statsDict["xyPhaseCorr"][ii], 4)
             polAngleCorr = round(statsDict["polAngleCorr"][ii], 4)
             flagged = statsDict["flagged"][ii]
-            csvData.append([chanNo, freq, rmsI, rmsV, maxI, flagged, xyPhaseCorr, polAngleCorr])
+            rmsQ = round(statsDict["rmsQ"][ii] * 1e6, 4)
+            rmsU = round(statsDict["rmsU"][ii] * 1e6, 4)
+            maxIposX = statsDict["maxIposX"][ii]
+            maxIposY = statsDict["maxIposY"][ii]
+            nanFraction = round(statsDict["nanFraction"][ii], 6)
+            csvData.append([chanNo, freq, rmsI, rmsV, maxI, flagged, xyPhaseCorr, polAngleCorr, rmsQ, rmsU, maxIposX, maxIposY, nanFraction])
         writer.writerows(csvData)
+    write_stats_store(filepathStatistics, [
+        ["chanNo", "", np.array(statsDict["chanNo"], dtype=np.int64)],
+        ["frequency", "MHz", np.array(statsDict["freq"], dtype=np.float64) * 1e-6],
+        ["rmsStokesI", "uJy/beam", np.array(statsDict["rmsI"], dtype=np.float64) * 1e6],
+        ["rmsStokesV", "uJy/beam", np.array(statsDict["rmsV"], dtype=np.float64) * 1e6],
+        ["maxStokesI", "uJy/beam", np.array(statsDict["maxI"], dtype=np.float64) * 1e6],
+        ["flagged", "", np.array(statsDict["flagged"], dtype=bool)],
+        ["xyPhaseCorr", "", np.array(statsDict["xyPhaseCorr"], dtype=np.float64)],
+        ["polAngleCorr", "", np.array(statsDict["polAngleCorr"], dtype=np.float64)],
+        ["rmsStokesQ", "uJy/beam", np.array(statsDict["rmsQ"], dtype=np.float64) * 1e6],
+        ["rmsStokesU", "uJy/beam", np.array(statsDict["rmsU"], dtype=np.float64) * 1e6],
+        ["maxStokesIposX", "px", np.array(statsDict["maxIposX"], dtype=np.float64)],
+        ["maxStokesIposY", "px", np.array(statsDict["maxIposY"], dtype=np.float64)],
+        ["nanFraction", "", np.array(statsDict["nanFraction"], dtype=np.float64)],
+        ])
 
 def plot_xyPhaseCorr_and_polAngleCorr(statsDict,  conf):
     xData = statsDict['freq']
@@ -385,46 +446,249 @@ def plot_xyPhaseCorr_and_polAngleCorr(statsDict,  conf):
     #plt.show()
 
 
-def get_cropped_numpy_plane(conf, plane):
-    if conf.input.crop:
-        plane_height, plane_width = plane.shape
-        print(plane_width, plane_height)
-        width, height = get_cropped_size_in_px(conf)
-        print(width, height)
+def get_crop_window(conf, header):
+    """
+    Returns the centered crop window of a channel image.
 
-        if plane_width < width or plane_height < height:
-            #info(f"Input dimensions {plane_width}px,{plane_height}px are lower than target '--crop {conf.input.crop}'")
-            #info(f"Falling back to: {plane_width}px,{plane_height}px")
-            width = plane_width
-            height = plane_height
+    The window is derived from the NAXIS keywords of the header, so no image
+    data has to be read. Without `--crop` the window covers the full image.
 
-        left = int(plane_width/2 - width/2)
-        top = int(plane_height/2 - height/2)
-        right = int(plane_width/2 + width/2)
-        bottom = int(plane_height/2 + height/2)
-        plane = plane[top:bottom, left:right]
-        print(plane.shape)
-    return plane
+    Parameters
+    ----------
+    conf: DotMap
+       Config object
+    header: astropy.io.fits.Header
+       Header of the channel image
 
+    Returns
+    -------
+    [ySlice, xSlice]: list of slices
+       Window along the y (NAXIS2) and x (NAXIS1) axis
 
-def fill_cube_with_images(channelFitsfileList, conf, mode="normal"):
     """
-    Fills the empty data cube with fits data.
+    plane_width = int(header["NAXIS1"])
+    plane_height = int(header["NAXIS2"])
+    if not conf.input.crop:
+        return [slice(0, plane_height), slice(0, plane_width)]
+
+    width, height = get_cropped_size_in_px(conf)
+    if plane_width < width or plane_height < height:
+        #info(f"Input dimensions {plane_width}px,{plane_height}px are lower than target '--crop {conf.input.crop}'")
+        #info(f"Falling back to: {plane_width}px,{plane_height}px")
+        width = plane_width
+        height = plane_height
+
+    left = int(plane_width/2 - width/2)
+    top = int(plane_height/2 - height/2)
+    right = int(plane_width/2 + width/2)
+    bottom = int(plane_height/2 + height/2)
+    return [slice(top, bottom), slice(left, right)]
+
+
+def get_cropped_numpy_plane(hdu, stokesIdx, cropWindow):
+    """
+    Reads only the crop window of one Stokes plane from a channel image.
+
+    Parameters
+    ----------
+    hdu: astropy.io.fits.PrimaryHDU
+       Channel image with the axes [Stokes, chan, y, x]
+    stokesIdx: int
+       0, 1, 2, 3 for Stokes I, Q, U, V
+    cropWindow: list of slices
+       Window from `get_crop_window`
 
+    Returns
+    -------
+    plane: numpy.array
+       2D array with the cropped plane
 
     """
-    if mode == "smoothed":
-        cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
-    else:
-        cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+    return hdu.section[stokesIdx, 0, cropWindow[0], cropWindow[1]]
+
+
+# Per process state of the channel ingestion workers. Filled by
+# `init_channel_worker` before the first channel gets processed.
+WORKER_STATE = {}
+
+
+def init_channel_worker(cubeName, channelFitsfileTemplate, conf, rotationCoeffsDict=None, sourceFitsfileTemplate=None):
+    """
+    Initialises a channel ingestion worker.
+
+    Each worker opens its own block writer of the pre-allocated data cube and
+    only writes into the channel blocks it gets assigned. Therefore, no locking
+    is necessary.
+
+    Parameters
+    ----------
+    cubeName: str
+       Path to the pre-allocated data cube
+    channelFitsfileTemplate: str
+       Any channel fits file, used to derive the filenames of all channels
+    conf: DotMap
+       Config object
+    rotationCoeffsDict: dict
+       Coefficients from `get_rotation_coefficients` or None for no rotation
+    sourceFitsfileTemplate: str
+       Any source channel image (before smoothing) for the manifest. If None,
+       no fingerprint of the source images is taken.
+
+    """
+    WORKER_STATE["conf"] = conf
+    WORKER_STATE["channelFitsfileTemplate"] = channelFitsfileTemplate
+    WORKER_STATE["blockWriter"] = CubeBlockWriter(cubeName)
+    WORKER_STATE["block"] = None
+    WORKER_STATE["rotationCoeffsDict"] = rotationCoeffsDict
+    WORKER_STATE["rotationBuffers"] = None
+    WORKER_STATE["sourceFitsfileTemplate"] = sourceFitsfileTemplate
 
-    info(SEPERATOR)
-    info(f"Opening data cube: {cubeName}")
-    # TODO: debug: if ignore_missing_end is not true I get an error.
-    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="update")
-    dataCube = hudCube[0].data
-    highestChannel = int(dataCube.shape[1] + 1)
 
+def get_rotation_buffers(shape):
+    """
+    Returns the two scratch planes of the worker for the rotation. They get
+    allocated once and reused for all channels.
+    """
+    buffers = WORKER_STATE["rotationBuffers"]
+    if buffers is None or buffers[0].shape != shape:
+        buffers = (np.empty(shape, dtype=np.float32), np.empty(shape, dtype=np.float32))
+        WORKER_STATE["rotationBuffers"] = buffers
+    return buffers
+
+
+def process_channel(chanNo, block, blockIdx):
+    """
+    Reads, crops, rotates and checks one channel image and writes it into the
+    channel block.
+
+    Parameters
+    ----------
+    chanNo: int
+       Channel number, starting with 1
+    block: numpy.array
+       Channel block [Stokes, chan, y, x] in memory
+    blockIdx: int
+       Channel index of `chanNo` in `block`
+
+    Returns
+    -------
+    row: dict
+       Statistics of the channel with the same keys as `rmsDict`
+
+    """
+    conf = WORKER_STATE["conf"]
+    row = {
+        "chanNo": chanNo,
+        "freq": np.nan,
+        "rmsI": np.nan,
+        "rmsV": np.nan,
+        "maxI": np.nan,
+        "flagged": True,
+        "polAngleCorr": np.nan,
+        "xyPhaseCorr": np.nan,
+        "rmsQ": np.nan,
+        "rmsU": np.nan,
+        "maxIposX": np.nan,
+        "maxIposY": np.nan,
+        "nanFraction": 1.0,
+    }
+    channelFitsfile = change_channelNumber_from_filename(WORKER_STATE["channelFitsfileTemplate"], conf.env.markerChannel, chanNo)
+    info(f"Trying to open fits file: {channelFitsfile}")
+
+    # Try to open file. If channel doesn't exists flag channel
+    try:
+        hud = fits.open(channelFitsfile, memmap=True)
+        freq = hud[0].header["CRVAL3"]
+        cropWindow = get_crop_window(conf, hud[0].header)
+        stokesV = get_cropped_numpy_plane(hud[0], 3, cropWindow)
+        checkedArray, std = check_rms(stokesV, method=conf.input.robustStatsMethod)
+    except:
+        info(f"Flagging channel, can not open file: {channelFitsfile}")
+        block[:, blockIdx, :, :] = np.nan
+        return row
+
+    with hud:
+        row["rmsV"] = std
+        if np.isnan(np.sum(checkedArray)) or std == 0:
+            block[:, blockIdx, :, :] = np.nan
+            info(
+                "Stokes V RMS noise of {0} is below below 1 [uJy/beam]. Flagging Stokes IQUV.".format(round(row["rmsV"] * 1e6, 2))
+            )
+            return row
+
+        row["freq"] = freq
+        row["flagged"] = False
+        stokesI = get_cropped_numpy_plane(hud[0], 0, cropWindow)
+        row["rmsI"] = get_std_via_mad(stokesI, method=conf.input.robustStatsMethod)
+        row["maxI"] = np.max(stokesI)
+        row["nanFraction"] = np.count_nonzero(np.isnan(stokesI)) / stokesI.size
+        if row["nanFraction"] < 1:
+            row["maxIposY"], row["maxIposX"] = np.unravel_index(np.nanargmax(stokesI), stokesI.shape)
+        block[0, blockIdx, :, :] = stokesI
+
+        block[1, blockIdx, :, :] = get_cropped_numpy_plane(hud[0], 1, cropWindow)
+        block[2, blockIdx, :, :] = get_cropped_numpy_plane(hud[0], 2, cropWindow)
+        block[3, blockIdx, :, :] = stokesV
+
+        rotationCoeffsDict = WORKER_STATE["rotationCoeffsDict"]
+        if rotationCoeffsDict:
+            info(f'Starting XY phase and pol angle rotation for image frequency: {row["freq"]}')
+            xyPhaseAngle, polAngle = get_rotation_angles(row["freq"], rotationCoeffsDict)
+            info(f"Using xy-phase angle: {xyPhaseAngle}")
+            info(f"Using polarization angle: {polAngle}")
+            # rotate the written planes of the cube in place
+            stokesQ, stokesU, stokesV = block[1, blockIdx, :, :], block[2, blockIdx, :, :], block[3, blockIdx, :, :]
+            bufferA, bufferB = get_rotation_buffers(stokesQ.shape)
+            rotate_stokesQUV_inplace(stokesQ, stokesU, stokesV, xyPhaseAngle, polAngle, bufferA, bufferB)
+            row["xyPhaseCorr"] = xyPhaseAngle
+            row["polAngleCorr"] = polAngle
+
+        row["rmsQ"] = get_std_via_mad(block[1, blockIdx, :, :], method=conf.input.robustStatsMethod)
+        row["rmsU"] = get_std_via_mad(block[2, blockIdx, :, :], method=conf.input.robustStatsMethod)
+    return row
+
+
+def process_channel_block(chanNoList):
+    """
+    Processes a block of consecutive channels in memory and writes it into
+    the data cube with one write per Stokes parameter. The block is synced to
+    disk and dropped from the page cache before the rows are returned.
+
+    If the worker got a source fits file template, each row gets the
+    fingerprint of its source channel image as "source" for the manifest.
+
+    Parameters
+    ----------
+    chanNoList: list of int
+       Consecutive channel numbers
+
+    Returns
+    -------
+    [rowList, peakRSS]: list
+       Statistics of the channels and peak RSS of the worker in bytes
+
+    """
+    blockWriter = WORKER_STATE["blockWriter"]
+    shape = (blockWriter.shape[0], len(chanNoList)) + blockWriter.shape[2:]
+    block = WORKER_STATE["block"]
+    if block is None or block.shape[1] < shape[1]:
+        block = np.empty(shape, dtype=np.float32)
+        WORKER_STATE["block"] = block
+    block = block[:, :shape[1]]
+    rowList = [process_channel(chanNo, block, blockIdx) for blockIdx, chanNo in enumerate(chanNoList)]
+    blockWriter.write_channels(chanNoList[0] - 1, block)
+    blockWriter.flush()
+    if WORKER_STATE["sourceFitsfileTemplate"]:
+        for row in rowList:
+            sourceFitsfile = change_channelNumber_from_filename(WORKER_STATE["sourceFitsfileTemplate"], WORKER_STATE["conf"].env.markerChannel, row["chanNo"])
+            row["source"] = get_channel_fingerprint(sourceFitsfile)
+    return [rowList, get_peak_rss()]
+
+
+def get_empty_rmsDict():
+    """
+    Returns the dictionary for the channel statistics without any channel.
+    """
     rmsDict = {}
     rmsDict["chanNo"] = []
     rmsDict["freq"] = []
@@ -434,103 +698,103 @@ def fill_cube_with_images(channelFitsfileList, conf, mode="normal"):
     rmsDict["flagged"] = []
     rmsDict["polAngleCorr"] = []
     rmsDict["xyPhaseCorr"] = []
-    maxChanNo =  int(get_channelNumber_from_filename(channelFitsfileList[-1], conf.env.markerChannel))
-    for ii in range(0, maxChanNo):
-        rmsDict['chanNo'].append(ii + 1)
-        hudSwitch = False
-        channelFitsfile = change_channelNumber_from_filename(channelFitsfileList[0], conf.env.markerChannel, ii + 1)
-        info(f"Trying to open fits file: {channelFitsfile}")
-        # Switch
-        stokesVflag = False
-
-        # Try to open file. If channel doesn't exists flag channel
-        try:
-            hud = fits.open(channelFitsfile, memmap=True)
-            rmsDict['freq'].append(hud[0].header["CRVAL3"])
-            stokesV = get_cropped_numpy_plane(conf, hud[0].data[3, 0, :, :])
-            checkedArray, std = check_rms(stokesV)
-            rmsDict["rmsV"].append(std)
-            dataCube[3, ii, :, :] = checkedArray
-            if np.isnan(np.sum(checkedArray)) or std==0:
-                stokesVflag = True
-                rmsDict['freq'][-1] = np.nan
-            hudSwitch = True
-        except:
-            info(f"Flagging channel, can not open file: {channelFitsfile}")
-            stokesVflag = True
-            rmsDict["freq"].append(np.nan)
-            rmsDict["rmsV"].append(np.nan)
-
-        if not stokesVflag:
-            stokesI = get_cropped_numpy_plane(conf, hud[0].data[0, 0, :, :])
-            std = get_std_via_mad(stokesI)
-            rmsDict["rmsI"].append(std)
-            rmsDict["maxI"].append(np.max(stokesI))
-            rmsDict["flagged"].append(False)
-            dataCube[0, ii, :, :] = stokesI
-
-            stokesQ = get_cropped_numpy_plane(conf, hud[0].data[1, 0, :, :])
-            stokesU = get_cropped_numpy_plane(conf, hud[0].data[2, 0, :, :])
-            stokesV = get_cropped_numpy_plane(conf, hud[0].data[3, 0, :, :])
-
-            if conf.input.fileXYphasePolAngleCoeffs:
-                info("Starting XY phase and pol angle rotation.")
-                # grep obsid from MS filename. TODO: find something better
-                basename = os.path.basename(os.path.normpath(conf.input.inputMS[0]))
-                obsid = re.search(r"[0-9]{10}", basename)[0]
-                info(f"Uning observation ID (obsid): {obsid}")
-
-                coeffs = get_correction_coefficients(conf, obsid)
-                info(f"Using correction coefficients: {coeffs.to_dict()}")
-                info(f'Image frequency : {rmsDict["freq"][-1]}')
-
-                # correctXYPhase, and convert from GHz to Hz
-                coeffsXY = [coeffs['coeffsXY_a'].to_numpy()[0], coeffs['coeffsXY_b'].to_numpy()[0], coeffs['coeffsXY_c'].to_numpy()[0]]
-                xyPhaseAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsXY)
-                #xyPhaseAngle = xyPhaseAngle * np.pi/180
-                info(f"Using xy-phase angle: {xyPhaseAngle}")
-                stokesUtmp = stokesU*np.cos(xyPhaseAngle) - stokesV*np.sin(xyPhaseAngle)
-                stokesVtmp = stokesU*np.sin(xyPhaseAngle) + stokesV*np.cos(xyPhaseAngle)
-
-                # correctPolAngle, and convert from GHz to Hz
-                coeffsPol = [coeffs['coeffsPol_a'].to_numpy()[0], coeffs['coeffsPol_b'].to_numpy()[0], coeffs['coeffsPol_c'].to_numpy()[0]]
-                polAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsPol)
-                #polAngle = polAngle * np.pi/180
-                info(f"Using polarization angle: {polAngle}")
-                stokesQtmp = stokesQ*np.cos(polAngle) - stokesUtmp*np.sin(polAngle)
-                stokesUtmp = stokesQ*np.sin(polAngle) + stokesUtmp*np.cos(polAngle)
-                stokesQ = stokesQtmp
-                stokesU = stokesUtmp
-                stokesV = stokesVtmp
-                rmsDict["xyPhaseCorr"].append(xyPhaseAngle)
-                rmsDict["polAngleCorr"].append(polAngle)
-
-            elif not conf.input.fileXYphasePolAngleCoeffs:
-                rmsDict["xyPhaseCorr"].append(np.nan)
-                rmsDict["polAngleCorr"].append(np.nan)
-
-            dataCube[1, ii, :, :] = stokesQ
-            dataCube[2, ii, :, :] = stokesU
-            dataCube[3, ii, :, :] = stokesV
-
-        #if False:
-        elif stokesVflag:
-            dataCube[:, ii, :, :] = np.nan
-            rmsDict["rmsI"].append(np.nan)
-            rmsDict["maxI"].append(np.nan)
-            rmsDict["flagged"].append(True)
-            rmsDict["xyPhaseCorr"].append(np.nan)
-            rmsDict["polAngleCorr"].append(np.nan)
-            info(
-                "Stokes V RMS noise of {0} is below below 1 [uJy/beam]. Flagging Stokes IQUV.".format(round(rmsDict["rmsV"][-1] * 1e6, 2))
-            )
+    rmsDict["rmsQ"] = []
+    rmsDict["rmsU"] = []
+    rmsDict["maxIposX"] = []
+    rmsDict["maxIposY"] = []
+    rmsDict["nanFraction"] = []
+    return rmsDict
 
-        if hudSwitch:
-            hud.close()
-    info(SEPERATOR)
+
+def get_rmsDict_from_rowList(rowList):
+    """
+    Merges the rows of `process_channel` into the dictionary for the channel
+    statistics.
+    """
+    rmsDict = get_empty_rmsDict()
+    for row in rowList:
+        for key in rmsDict:
+            rmsDict[key].append(row[key])
+    return rmsDict
+
+
+def get_rowList_from_channel_images(cubeName, channelFitsfileTemplate, chanNoList, conf, sourceFitsfileTemplate=None, rowCallback=None):
+    """
+    Writes the channel images of `chanNoList` into the pre-allocated cube.
+
+    The channels are processed by `conf.input.buildcubeWorkers` worker
+    processes in blocks of consecutive channels, sized to fit
+    `cubeMemoryBudget`. Each worker writes into disjoint channel blocks of the
+    pre-allocated cube. The rows are returned in channel order.
+
+    Parameters
+    ----------
+    sourceFitsfileTemplate: str
+       If given, each row gets the fingerprint of its source image, see
+       `process_channel_block`
+    rowCallback: function
+       Gets called with each row as soon as the channel is written
+
+    Returns
+    -------
+    rowList: list of dicts
+       Statistics of all channels in `chanNoList`
+
+    """
+    workers = max(1, int(conf.input.buildcubeWorkers or 1))
+    initargs = (cubeName, channelFitsfileTemplate, conf, get_rotation_coefficients(conf), sourceFitsfileTemplate)
+    memoryBudget = float(conf.input.cubeMemoryBudget) * 1024**3
+    with fits.open(cubeName, memmap=True, ignore_missing_end=True) as hud:
+        shapeCube = hud[0].shape
+    # block buffer, the cropped planes read from the channel image and the rotation buffers
+    channelsPerBlock = get_channelsPerBlock(shapeCube, memoryBudget, workers)
+    blockList = get_channelBlockList(chanNoList, channelsPerBlock)
+    info(f"Writing {len(chanNoList)} channels in {len(blockList)} blocks of up to {channelsPerBlock} channels.")
+
+    rowList = []
+    peakRSS = 0
+    if workers == 1:
+        init_channel_worker(*initargs)
+        resultIterator = map(process_channel_block, blockList)
+    else:
+        info(f"Filling data cube with {workers} worker processes.")
+        # fork: the config object is handed over to the workers without pickling
+        pool = multiprocessing.get_context("fork").Pool(processes=workers, initializer=init_channel_worker, initargs=initargs)
+        resultIterator = pool.imap(process_channel_block, blockList)
+    for blockRowList, workerPeakRSS in resultIterator:
+        peakRSS = max(peakRSS, workerPeakRSS)
+        for row in blockRowList:
+            rowList.append(row)
+            if rowCallback:
+                rowCallback(row)
+    if workers == 1:
+        WORKER_STATE["blockWriter"].close()
+    else:
+        pool.close()
+        pool.join()
+    info(f"Peak RSS of a cube writer process: {peakRSS / 1024**3:.2f} GB")
+    return rowList
+
+
+def get_rmsDict_from_channel_images(cubeName, channelFitsfileTemplate, chanNoList, conf):
+    """
+    Writes the channel images of `chanNoList` into the pre-allocated cube.
+
+    Returns
+    -------
+    rmsDict: dict of lists
+       Statistics of all channels in `chanNoList`
+
+    """
+    rowList = get_rowList_from_channel_images(cubeName, channelFitsfileTemplate, chanNoList, conf)
+    return get_rmsDict_from_rowList(rowList)
 
 
-    hudCube.close()
+def update_cube_header_after_filling(cubeName, conf):
+    """
+    Updates the header of the filled data cube.
+    """
+    highestChannel = int(get_memmap_of_cube(cubeName, mode="r").shape[1] + 1)
     # TODO, check whether lowestChanNo is necessary
     # lowestChanNo = get_lowest_channelNo_with_data_in_cube(cubeName)
     addFitsHeaderDict = {
@@ -541,9 +805,642 @@ def fill_cube_with_images(channelFitsfileList, conf, mode="normal"):
             "COMMENT": "Created by IDIA Pipeline"
             }
     update_fits_header_of_cube(cubeName, addFitsHeaderDict)
+
+
+def fill_cube_with_images(channelFitsfileList, conf, mode="normal"):
+    """
+    Fills the empty data cube with fits data.
+
+
+    """
+    cubeName = get_filepathCube(conf, mode)
+
+    info(SEPERATOR)
+    info(f"Opening data cube: {cubeName}")
+    maxChanNo =  int(get_channelNumber_from_filename(channelFitsfileList[-1], conf.env.markerChannel))
+    chanNoList = list(range(1, maxChanNo + 1))
+    rmsDict = get_rmsDict_from_channel_images(cubeName, channelFitsfileList[0], chanNoList, conf)
+    info(SEPERATOR)
+
+    update_cube_header_after_filling(cubeName, conf)
     write_statistics_file(rmsDict, conf, mode=mode)
     if conf.input.fileXYphasePolAngleCoeffs:
-        plot_xyPhaseCorr_and_polAngleCorr(rmsDict, conf)
+        queue_plot(conf, "xyPhaseCorr-polAngleCorr", plot_xyPhaseCorr_and_polAngleCorr, statsDict={key: rmsDict[key] for key in ["freq", "xyPhaseCorr", "polAngleCorr"]})
+
+
+def get_partitions(conf):
+    """
+    Returns the number of partitions of one cube. The streaming buildcube
+    fills each cube with a single task and doesn't use partitions.
+    """
+    if conf.input.buildcubeStreaming:
+        return 1
+    return max(1, int(conf.input.buildcubePartitions or 1))
+
+
+def get_mode_and_partitionNo_from_slurmArrayTaskId(slurmArrayTaskId, conf):
+    """
+    Maps the slurm array task ID to the cube mode and the partition number.
+
+    With N partitions from `get_partitions` the tasks 1..N fill the normal
+    cube and the tasks N+1..2N fill the smoothed cube.
+
+    Returns
+    -------
+    [mode, partitionNo]: list with str and int
+       "normal" or "smoothed" and the partition number starting with 1
+
+    """
+    partitions = get_partitions(conf)
+    taskIdx = int(slurmArrayTaskId) - 1
+    if taskIdx // partitions == 1:
+        mode = "smoothed"
+    else:
+        mode = "normal"
+    return [mode, taskIdx % partitions + 1]
+
+
+def get_chanNoList_of_partition(maxChanNo, partitionNo, partitions):
+    """
+    Splits the channel numbers 1..maxChanNo into `partitions` contiguous
+    ranges and returns the range of `partitionNo` (starting with 1).
+    """
+    chanNoRangeList = np.array_split(np.arange(1, maxChanNo + 1), partitions)
+    return [int(chanNo) for chanNo in chanNoRangeList[partitionNo - 1]]
+
+
+def get_filepathPartialStatistics(conf, mode, partitionNo, partitions):
+    """
+    Returns the path of the statistics file of one partition.
+    """
+    filepathStatistics = get_filepathStatistics(conf, mode)
+    return filepathStatistics.replace(".tab", f".part{partitionNo:03d}-of-{partitions:03d}.tab")
+
+
+def get_slurmArrayJobId():
+    """
+    Returns the slurm array job ID, which is shared by all tasks of one
+    buildcube run. Falls back to "local" outside of slurm.
+    """
+    return os.environ.get("SLURM_ARRAY_JOB_ID", "local")
+
+
+def wait_for_allocated_cube(cubeName, timeout=PARTITION_WAIT_TIMEOUT):
+    """
+    Waits until the pre-allocated cube of this slurm array job exists.
+
+    Returns
+    -------
+    reuseCube: bool
+       True if the existing cube gets updated instead of being re-created
+
+    """
+    filepathAllocated = cubeName + ".allocated"
+    slurmArrayJobId = get_slurmArrayJobId()
+    info(f"Waiting for pre-allocated data cube: {cubeName}")
+    waited = 0
+    while waited < timeout:
+        if os.path.exists(filepathAllocated):
+            with open(filepathAllocated) as f:
+                lines = f.read().splitlines()
+            if lines and lines[0] == slurmArrayJobId:
+                info(f"Found pre-allocated data cube after {waited} seconds.")
+                return len(lines) > 1 and lines[1] == "reuse"
+        time.sleep(PARTITION_POLL_INTERVAL)
+        waited += PARTITION_POLL_INTERVAL
+    error(f"Data cube has not been pre-allocated after {timeout} seconds: {cubeName}")
+    sys.exit(1)
+
+
+def mark_cube_as_allocated(cubeName, conf, mode, partitions, reuseCube=False):
+    """
+    Removes left overs of previous runs and marks the pre-allocated cube as
+    ready for the other partitions of this slurm array job.
+    """
+    for partitionNo in range(1, partitions + 1):
+        filepathPartialStatistics = get_filepathPartialStatistics(conf, mode, partitionNo, partitions)
+        for filepath in [filepathPartialStatistics, get_filepathStatsStore(filepathPartialStatistics)]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+    if os.path.exists(cubeName + ".reduce.lock"):
+        os.remove(cubeName + ".reduce.lock")
+    with open(cubeName + ".allocated", "w") as f:
+        f.write(get_slurmArrayJobId() + "\n")
+        f.write("reuse" if reuseCube else "new")
+
+
+def get_filepathManifest(cubeName, partitionNo=None, partitions=None):
+    """
+    Returns the path of the manifest of the cube or of one partition.
+    """
+    if partitionNo:
+        return cubeName + f".manifest.part{partitionNo:03d}-of-{partitions:03d}.json"
+    return cubeName + ".manifest.json"
+
+
+def get_crc32_of_file(filepath, chunkSize=16 * 1024**2):
+    """
+    Returns the CRC32 checksum of a file, read in chunks.
+    """
+    crc = 0
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def get_channel_fingerprint(filepath, checksum=False):
+    """
+    Returns path, size and mtime of a channel image or None if the file does
+    not exist. The CRC32 checksum reads the whole image and is only taken with
+    `checksum`.
+    """
+    if not os.path.exists(filepath):
+        return None
+    fileStat = os.stat(filepath)
+    return {
+        "path": os.path.abspath(filepath),
+        "size": fileStat.st_size,
+        "mtime": fileStat.st_mtime,
+        "crc32": get_crc32_of_file(filepath) if checksum else None,
+        }
+
+
+def is_channel_unchanged(entry, sourceFitsfile):
+    """
+    Checks a manifest entry against the current source channel image.
+
+    Size and mtime are compared first. Only if the mtime changed and the entry
+    holds a checksum, the checksum of the image is computed and decides, e.g.
+    for files that got touched or copied without changes. Entries without
+    checksum count as changed once the mtime changed.
+
+    Parameters
+    ----------
+    entry: dict
+       Manifest entry of the channel or None
+    sourceFitsfile: str
+       Source channel image (before smoothing)
+
+    Returns
+    -------
+    unchanged: bool
+       True if the channel in the cube is up to date
+    """
+    if not entry:
+        return False
+    fingerprint = get_channel_fingerprint(sourceFitsfile)
+    if not fingerprint or not entry["source"]:
+        return fingerprint == entry["source"]
+    if fingerprint["size"] != entry["source"]["size"]:
+        return False
+    if fingerprint["mtime"] == entry["source"]["mtime"]:
+        return True
+    if entry["source"].get("crc32") is None:
+        return False
+    if get_crc32_of_file(sourceFitsfile) == entry["source"]["crc32"]:
+        entry["source"]["mtime"] = fingerprint["mtime"]
+        return True
+    return False
+
+
+def get_cube_signature(conf, mode, shape, beam=None):
+    """
+    Returns everything besides the channel images that determines the content
+    of the cube. A manifest is only valid for a cube with the same signature.
+    """
+    signature = {
+        "mode": mode,
+        "shape": [int(dim) for dim in shape],
+        "crop": conf.input.crop,
+        "fileXYphasePolAngleCoeffs": conf.input.fileXYphasePolAngleCoeffs,
+        "robustStatsMethod": conf.input.robustStatsMethod,
+        "smoothbeam": beam,
+        }
+    # same types as after reading it from json
+    return json.loads(json.dumps(signature))
+
+
+def get_manifest_entry_from_row(row):
+    """
+    Returns the manifest entry of a row from `process_channel_block`.
+    """
+    stats = {}
+    for key in get_empty_rmsDict():
+        value = row[key]
+        stats[key] = value.item() if hasattr(value, "item") else value
+    if not row["source"]:
+        state = "missing"
+    elif row["flagged"]:
+        state = "flagged"
+    else:
+        state = "written"
+    return {"source": row["source"], "state": state, "stats": stats}
+
+
+def read_manifest(cubeName, signature):
+    """
+    Reads the manifest of the cube together with the partial manifests of
+    unfinished runs. Only manifests with the same signature are used, newer
+    entries replace older ones.
+
+    Returns
+    -------
+    channelDict: dict
+       Manifest entries with the channel number (str) as key
+    """
+    channelDict = {}
+    filepathList = sorted(glob(cubeName + ".manifest.part*.json"), key=os.path.getmtime)
+    if os.path.exists(get_filepathManifest(cubeName)):
+        filepathList = [get_filepathManifest(cubeName)] + filepathList
+    for filepath in filepathList:
+        try:
+            with open(filepath) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            error(f"Ignoring unreadable manifest {filepath}: {e}")
+            continue
+        if manifest.get("signature") != signature:
+            info(f"Ignoring manifest of a different cube configuration: {filepath}")
+            continue
+        channelDict.update(manifest["channels"])
+    return channelDict
+
+
+def write_manifest(filepath, signature, channelDict):
+    """
+    Writes the manifest atomically, so an interrupted run never leaves a
+    broken manifest behind.
+    """
+    with open(filepath + ".tmp", "w") as f:
+        json.dump({"signature": signature, "channels": channelDict}, f, indent=1)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def remove_manifests(cubeName):
+    """
+    Removes the manifest and all partial manifests of the cube.
+    """
+    for filepath in glob(cubeName + ".manifest*.json"):
+        os.remove(filepath)
+
+
+def get_iorFlagged_chanNoSet(cubeName, conf):
+    """
+    Returns the channel numbers that got blanked in the cube by the IOR
+    flagging of a previous run.
+    """
+    channelMask = read_channel_mask(cubeName, conf)
+    if channelMask:
+        return channelMask["blanked"]
+    filepathIORStatistics = conf.input.basename + conf.env.extCubeIORStatistics
+    if not os.path.exists(filepathIORStatistics):
+        return set()
+    statsDict = get_dict_from_statsFile(filepathIORStatistics)
+    return {chanNo for chanNo, flagged in zip(statsDict["chanNo"], statsDict["flagged"]) if flagged}
+
+
+def merge_partitions(cubeName, conf, mode, partitions, signature):
+    """
+    Merges the statistics files and the manifests of all partitions and
+    finalises the cube header. Only the partition that finishes last (and wins
+    the lock) does this, all others return without merging.
+
+    Returns
+    -------
+    merged: bool
+       True if this partition merged the statistics
+
+    """
+    filepathPartialStatisticsList = [get_filepathPartialStatistics(conf, mode, partitionNo, partitions) for partitionNo in range(1, partitions + 1)]
+    # the store is written after the `.tab` file, so a partition is done once its store exists
+    filepathPartialStoreList = [get_filepathStatsStore(filepath) for filepath in filepathPartialStatisticsList]
+    if not all(os.path.exists(filepath) for filepath in filepathPartialStoreList):
+        info("Not all partitions are done yet. Leaving the merge to the last one.")
+        return False
+    try:
+        fd = os.open(cubeName + ".reduce.lock", os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.close(fd)
+    except FileExistsError:
+        info("Another partition is already merging the statistics.")
+        return False
+    if not all(os.path.exists(filepath) for filepath in filepathPartialStoreList):
+        info("Statistics have already been merged by another partition.")
+        os.remove(cubeName + ".reduce.lock")
+        return False
+
+    filepathStatistics = get_filepathStatistics(conf, mode)
+    info(f"Merging {partitions} partial statistics files into: {filepathStatistics}")
+    csvData = []
+    for filepathPartialStatistics in filepathPartialStatisticsList:
+        with open(filepathPartialStatistics, newline="") as csvFile:
+            partialCsvData = list(csv.reader(csvFile, delimiter="\t"))
+        if not csvData:
+            csvData.append(partialCsvData[0])
+        csvData += partialCsvData[1:]
+    with open(filepathStatistics, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        writer.writerows(csvData)
+    merge_stats_stores(filepathPartialStatisticsList, filepathStatistics)
+
+    filepathManifest = get_filepathManifest(cubeName)
+    info(f"Merging manifests into: {filepathManifest}")
+    channelDict = read_manifest(cubeName, signature)
+    write_manifest(filepathManifest, signature, channelDict)
+    for filepath in filepathPartialStatisticsList + filepathPartialStoreList + glob(cubeName + ".manifest.part*.json"):
+        os.remove(filepath)
+    channelMask = read_channel_mask(cubeName, conf)
+    if channelMask and channelMask["blanked"]:
+        # the channels blanked by the IOR flagging have been written again
+        write_channel_mask(cubeName, conf, channelMask["flagged"], [])
+
+    update_cube_header_after_filling(cubeName, conf)
+    if conf.input.fileXYphasePolAngleCoeffs:
+        statsDict = get_dict_from_statsFile(filepathStatistics, asArrays=True)
+        rmsDict = {
+                "freq": np.array(statsDict["frequency"]) * 1e6,
+                "xyPhaseCorr": statsDict["xyPhaseCorr"],
+                "polAngleCorr": statsDict["polAngleCorr"],
+                }
+        queue_plot(conf, "xyPhaseCorr-polAngleCorr", plot_xyPhaseCorr_and_polAngleCorr, statsDict=rmsDict)
+    os.remove(cubeName + ".allocated")
+    os.remove(cubeName + ".reduce.lock")
+    return True
+
+
+def build_cube_partition(conf, mode, partitionNo=1, partitions=1):
+    """
+    Fills one contiguous channel range of the data cube.
+
+    All partitions of a slurm array job share one pre-allocated cube. The
+    partition holding the lowest channel image allocates the cube, all others
+    wait for it. Each partition writes its own partial statistics file and
+    manifest, which get merged by the partition that finishes last.
+
+    The manifest next to the cube records the fingerprint of the source image,
+    the state and the statistics of every channel. If the cube exists with the
+    same configuration, only missing or changed channels get (re-)written and
+    the statistics of all other channels are taken from the manifest. An
+    interrupted run continues where it stopped.
+
+    """
+    cubeName = get_filepathCube(conf, mode)
+    rawChannelFitsfileList = get_channelFitsfileList_from_index(get_channel_index(conf))
+    sourceFitsfileTemplate = rawChannelFitsfileList[0]
+    maxChanNo = int(get_channelNumber_from_filename(rawChannelFitsfileList[-1], conf.env.markerChannel))
+    chanNoList = get_chanNoList_of_partition(maxChanNo, partitionNo, partitions)
+    info(f"Partition {partitionNo}/{partitions} of {mode} cube: channels {chanNoList[0]} to {chanNoList[-1]}")
+
+    cropWindow = get_crop_window(conf, fits.getheader(sourceFitsfileTemplate))
+    shape = [4, maxChanNo, cropWindow[0].stop - cropWindow[0].start, cropWindow[1].stop - cropWindow[1].start]
+    if mode == "smoothed":
+        # the target beam must be the same for all partitions
+        beam = None
+        if conf.input.smoothInImaging and conf.input.smoothbeam == "auto":
+            beam = get_presmoothed_beam(rawChannelFitsfileList, conf)
+        if not beam:
+            beam = get_smoothing_beam(rawChannelFitsfileList, conf)
+        channelFitsfileTemplate = get_smoothedFitsname(sourceFitsfileTemplate)
+    else:
+        beam = None
+        channelFitsfileTemplate = sourceFitsfileTemplate
+    signature = get_cube_signature(conf, mode, shape, beam)
+
+    smoothedFitsfileList = []
+    lowestChanNo = int(get_channelNumber_from_filename(sourceFitsfileTemplate, conf.env.markerChannel))
+    if lowestChanNo in chanNoList:
+        reuseCube = os.path.exists(cubeName) and bool(read_manifest(cubeName, signature))
+        if reuseCube:
+            info(f"Partition {partitionNo} holds the lowest channel and found an up to date manifest. Updating the existing cube.")
+        else:
+            info(f"Partition {partitionNo} holds the lowest channel and pre-allocates the cube.")
+            remove_manifests(cubeName)
+            if mode == "smoothed":
+                smoother(get_fitsfiles_to_smooth([sourceFitsfileTemplate], beam), conf, beam=beam)
+                smoothedFitsfileList = [channelFitsfileTemplate]
+            make_empty_image(conf, mode=mode, channelFitsfileList=[channelFitsfileTemplate, rawChannelFitsfileList[-1]])
+        mark_cube_as_allocated(cubeName, conf, mode, partitions, reuseCube=reuseCube)
+    else:
+        reuseCube = wait_for_allocated_cube(cubeName)
+
+    channelDict = read_manifest(cubeName, signature) if reuseCube else {}
+    iorFlaggedChanNoSet = get_iorFlagged_chanNoSet(cubeName, conf) if reuseCube else set()
+    ownChannelDict = {}
+    processChanNoList = []
+    for chanNo in chanNoList:
+        entry = channelDict.get(str(chanNo))
+        sourceFitsfile = change_channelNumber_from_filename(sourceFitsfileTemplate, conf.env.markerChannel, chanNo)
+        # channels blanked by the IOR flagging need to be written again
+        blanked = chanNo in iorFlaggedChanNoSet and entry and entry["state"] == "written"
+        if is_channel_unchanged(entry, sourceFitsfile) and not blanked:
+            ownChannelDict[str(chanNo)] = entry
+        else:
+            processChanNoList.append(chanNo)
+    info(f"Channels to write: {len(processChanNoList)} of {len(chanNoList)}")
+
+    if mode == "smoothed":
+        smoothFitsfileList = [change_channelNumber_from_filename(sourceFitsfileTemplate, conf.env.markerChannel, chanNo) for chanNo in processChanNoList]
+        smoothFitsfileList = [fitsname for fitsname in smoothFitsfileList if os.path.exists(fitsname) and get_smoothedFitsname(fitsname) not in smoothedFitsfileList]
+        smoother(get_fitsfiles_to_smooth(smoothFitsfileList, beam), conf, beam=beam)
+
+    filepathPartialManifest = get_filepathManifest(cubeName, partitionNo, partitions)
+    def add_row_to_manifest(row):
+        ownChannelDict[str(row["chanNo"])] = get_manifest_entry_from_row(row)
+        if len(ownChannelDict) % MANIFEST_SAVE_INTERVAL == 0:
+            write_manifest(filepathPartialManifest, signature, ownChannelDict)
+
+    info(SEPERATOR)
+    get_rowList_from_channel_images(cubeName, channelFitsfileTemplate, processChanNoList, conf, sourceFitsfileTemplate=sourceFitsfileTemplate, rowCallback=add_row_to_manifest)
+    write_manifest(filepathPartialManifest, signature, ownChannelDict)
+    info(SEPERATOR)
+
+    rmsDict = get_rmsDict_from_rowList([ownChannelDict[str(chanNo)]["stats"] for chanNo in chanNoList])
+    write_statistics_file(rmsDict, conf, mode=mode, filepathStatistics=get_filepathPartialStatistics(conf, mode, partitionNo, partitions))
+    merge_partitions(cubeName, conf, mode, partitions, signature)
+
+
+def get_predicted_chanNoList(conf):
+    """
+    Returns the sorted channel numbers predicted from the input measurement sets.
+    """
+    return sorted(set(int(chanNo) for chanNo in itertools.chain(*conf.data.predictedOutputChannels)))
+
+
+def get_channelFitsfileDict(conf):
+    """
+    Returns the paths of the channel images in the channel index by channel
+    number.
+    """
+    return {entry["chanNo"]: entry["path"] for entry in get_channel_index(conf).values() if entry["kind"] == "image"}
+
+
+def is_fits_file_complete(filepath):
+    """
+    Checks whether a fits file holds the full data announced by its header.
+    """
+    try:
+        with fits.open(filepath, memmap=True) as hud:
+            header = hud[0].header
+            dataLoc = hud.fileinfo(0)["datLoc"]
+            dataSize = abs(int(header["BITPIX"])) // 8 * int(np.prod([header[f"NAXIS{i}"] for i in range(1, int(header["NAXIS"]) + 1)]))
+    except Exception:
+        return False
+    return os.path.getsize(filepath) >= dataLoc + dataSize
+
+
+def is_slurm_job_active(jobId):
+    """
+    Checks whether any task of the slurm job `jobId` is still pending or
+    running. A job that `squeue` doesn't know any more has ended.
+    """
+    try:
+        result = subprocess.run(["squeue", "--noheader", "--jobs", str(jobId), "--format", "%T"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as e:
+        error(f"Can't check the state of slurm job {jobId}: {e}")
+        return False
+    return result.returncode == 0 and bool(result.stdout.split())
+
+
+def watch_channel_images(conf, chanNoList, ingest_function, timeout, imagingJobId=None):
+    """
+    Polls the channel index of `env.dirImages` for the images of `chanNoList`
+    while the imaging is still running and hands over every complete image to
+    `ingest_function`.
+
+    An image counts as complete once its size and mtime did not change between
+    two polls and the file holds all the data announced by its header.
+
+    Parameters
+    ----------
+    chanNoList: list of int
+       Channel numbers to wait for
+    ingest_function: function
+       Gets called with a dict of the paths of new complete images by channel
+       number
+    timeout: int
+       Stop waiting if no image changed or arrived for `timeout` seconds
+    imagingJobId: str
+       Slurm job ID of the imaging. The timeout only counts once this job is
+       neither pending nor running.
+
+    Returns
+    -------
+    pendingChanNoList: list of int
+       Channel numbers that never arrived
+    """
+    pendingChanNoSet = set(chanNoList)
+    lastFingerprintDict = {}
+    idle = 0
+    info(f"Watching {conf.env.dirImages} for {len(pendingChanNoSet)} channel images.")
+    while pendingChanNoSet:
+        readyChanNoList = []
+        changed = False
+        channelFitsfileDict = get_channelFitsfileDict(conf)
+        for chanNo in sorted(pendingChanNoSet):
+            channelFitsfile = channelFitsfileDict.get(chanNo)
+            if not channelFitsfile or not os.path.exists(channelFitsfile):
+                continue
+            fileStat = os.stat(channelFitsfile)
+            fingerprint = (fileStat.st_size, fileStat.st_mtime)
+            if lastFingerprintDict.get(chanNo) == fingerprint:
+                if is_fits_file_complete(channelFitsfile):
+                    readyChanNoList.append(chanNo)
+            else:
+                changed = True
+            lastFingerprintDict[chanNo] = fingerprint
+        if readyChanNoList:
+            info(f"New channel images: {readyChanNoList}")
+            pendingChanNoSet -= set(readyChanNoList)
+            ingest_function({chanNo: channelFitsfileDict[chanNo] for chanNo in readyChanNoList})
+        if readyChanNoList or changed:
+            idle = 0
+        elif imagingJobId and is_slurm_job_active(imagingJobId):
+            # the imaging of the missing channels is pending or running
+            idle = 0
+        elif idle >= timeout:
+            info(f"No new channel images for {timeout} seconds. Stop watching.")
+            break
+        if pendingChanNoSet:
+            time.sleep(STREAM_POLL_INTERVAL)
+            idle += STREAM_POLL_INTERVAL
+    return sorted(pendingChanNoSet)
+
+
+def stream_cube(conf, mode="normal"):
+    """
+    Fills the data cube while the imaging is still running.
+
+    The cube is pre-allocated for all predicted channels as soon as the first
+    channel image is complete. Every further image is written into the cube
+    right away. Once all predicted channels arrived (or none arrived for
+    `buildcubeStreamingTimeout` seconds after the imaging job, given by the
+    environment variable `ENVVAR_IMAGING_JOB_ID`, ended) the remaining
+    channels are flagged
+    and the statistics, manifest and header are finalised like for a
+    partitioned run with one partition. A later run without streaming picks up
+    late channels from the manifest.
+
+    With `smoothbeam = "auto"` the common beam is only known once all images
+    exist, therefore the smoothed cube waits for the imaging and is built
+    afterwards.
+
+    """
+    timeout = int(conf.input.buildcubeStreamingTimeout)
+    imagingJobId = os.environ.get(ENVVAR_IMAGING_JOB_ID)
+    if imagingJobId:
+        info(f"Waiting for channel images while the imaging job {imagingJobId} is pending or running.")
+    predictedChanNoList = get_predicted_chanNoList(conf)
+    maxChanNo = predictedChanNoList[-1]
+    if mode == "smoothed" and conf.input.smoothbeam == "auto":
+        info("Smoothed cube with `smoothbeam` auto can't be streamed. Waiting for the imaging to finish.")
+        watch_channel_images(conf, predictedChanNoList, lambda channelFitsfileDict: None, timeout, imagingJobId)
+        build_cube_partition(conf, mode)
+        return
+
+    cubeName = get_filepathCube(conf, mode)
+    beam = get_smoothing_beam([], conf) if mode == "smoothed" else None
+    streamDict = {}
+    ownChannelDict = {}
+
+    def add_row_to_manifest(row):
+        ownChannelDict[str(row["chanNo"])] = get_manifest_entry_from_row(row)
+        if len(ownChannelDict) % MANIFEST_SAVE_INTERVAL == 0:
+            write_manifest(get_filepathManifest(cubeName, 1, 1), streamDict["signature"], ownChannelDict)
+
+    def ingest_channels(channelFitsfileDict):
+        chanNoList = sorted(channelFitsfileDict)
+        if mode == "smoothed":
+            smoother(get_fitsfiles_to_smooth([channelFitsfileDict[chanNo] for chanNo in chanNoList if os.path.exists(channelFitsfileDict[chanNo])], beam), conf, beam=beam)
+        if not streamDict:
+            sourceFitsfileTemplate = channelFitsfileDict[chanNoList[0]]
+            cropWindow = get_crop_window(conf, fits.getheader(sourceFitsfileTemplate))
+            shape = [4, maxChanNo, cropWindow[0].stop - cropWindow[0].start, cropWindow[1].stop - cropWindow[1].start]
+            streamDict["sourceFitsfileTemplate"] = sourceFitsfileTemplate
+            streamDict["channelFitsfileTemplate"] = get_smoothedFitsname(sourceFitsfileTemplate) if mode == "smoothed" else sourceFitsfileTemplate
+            streamDict["signature"] = get_cube_signature(conf, mode, shape, beam)
+            info(f"Pre-allocating the {mode} cube for {maxChanNo} channels.")
+            remove_manifests(cubeName)
+            # CRVAL3 gets shifted from the first channel to arrive to channel 1
+            make_empty_image(conf, mode=mode, channelFitsfileList=[streamDict["channelFitsfileTemplate"], change_channelNumber_from_filename(sourceFitsfileTemplate, conf.env.markerChannel, maxChanNo)])
+            mark_cube_as_allocated(cubeName, conf, mode, 1)
+        get_rowList_from_channel_images(cubeName, streamDict["channelFitsfileTemplate"], chanNoList, conf, sourceFitsfileTemplate=streamDict["sourceFitsfileTemplate"], rowCallback=add_row_to_manifest)
+
+    missingChanNoList = watch_channel_images(conf, predictedChanNoList, ingest_channels, timeout, imagingJobId)
+    if not streamDict:
+        error(f"No channel image arrived in {conf.env.dirImages}. Can't build the {mode} cube.")
+        sys.exit(1)
+    if missingChanNoList:
+        error(f"Flagging channels without image: {missingChanNoList}. A buildcube run without streaming picks them up later.")
+    # blank all channels that have not been written, including the ones that weren't predicted
+    remainingChanNoList = [chanNo for chanNo in range(1, maxChanNo + 1) if str(chanNo) not in ownChannelDict]
+    if remainingChanNoList:
+        ingest_channels({chanNo: change_channelNumber_from_filename(streamDict["sourceFitsfileTemplate"], conf.env.markerChannel, chanNo) for chanNo in remainingChanNoList})
+    write_manifest(get_filepathManifest(cubeName, 1, 1), streamDict["signature"], ownChannelDict)
+
+    rmsDict = get_rmsDict_from_rowList([ownChannelDict[str(chanNo)]["stats"] for chanNo in range(1, maxChanNo + 1)])
+    write_statistics_file(rmsDict, conf, mode=mode, filepathStatistics=get_filepathPartialStatistics(conf, mode, 1, 1))
+    merge_partitions(cubeName, conf, mode, 1, streamDict["signature"])
+
 
 def move_casalogs_to_dirLogs(conf):
     '''
@@ -573,18 +1470,15 @@ def main(ctx):
     info(f"Scripts config: {conf}")
     move_casalogs_to_dirLogs(conf)
 
+    partitions = get_partitions(conf)
     # exploit slurm task ID to run normal buildcube or smoothed buildcube
-    if int(args.slurmArrayTaskId) == 1:
-        channelFitsfileList = make_empty_image(conf, mode="normal")
-        fill_cube_with_images(channelFitsfileList, conf, mode="normal")
-
-    elif int(args.slurmArrayTaskId) == 2:
-        channelFitsfileList = make_empty_image(conf, mode="smoothed")
-        fill_cube_with_images(channelFitsfileList, conf, mode="smoothed")
-
+    mode, partitionNo = get_mode_and_partitionNo_from_slurmArrayTaskId(args.slurmArrayTaskId, conf)
+    if conf.input.buildcubeStreaming:
+        if int(conf.input.buildcubePartitions or 1) > 1:
+            info("Ignoring buildcubePartitions, the streaming buildcube fills each cube with a single task.")
+        stream_cube(conf, mode)
     else:
-        channelFitsfileList = make_empty_image(conf, mode="normal")
-        fill_cube_with_images(channelFitsfileList, conf, mode="normal")
+        build_cube_partition(conf, mode, partitionNo, partitions)
 
 
 
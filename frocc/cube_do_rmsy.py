@@ -6,7 +6,7 @@ import numpy as np
 import json
 
 from glob import glob
-from frocc.lhelpers import get_config_in_dot_notation, main_timer
+from frocc.lhelpers import get_config_in_dot_notation, main_timer, get_dict_from_statsFile, is_stats_store_up_to_date
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from logging import info, error
 
@@ -64,18 +64,14 @@ def saveOutput(outdict, arrdict, prefixOut, verbose=True):
 
 def get_statsList_from_datFile(datFile):
     '''
-    TODO: write better
+    Returns the columns frequency, Stokes I, Q, U maximum and RMS noise of a
+    RM synthesis input file as list of numpy arrays. The binary store is read
+    if available, otherwise the tab separated file.
     '''
-    allStatsList = [np.array([]), np.array([]), np.array([]), np.array([]), np.array([]), np.array([]), np.array([])]
-    #allStatsList = [[], [], [], [], [], [], []]
-    with open(datFile) as f:
-        lines = f.read().splitlines()
-        for line in lines:
-            # to float
-            valueList = [float(i) for i in line.split("\t")]
-            for i, item in enumerate(valueList):
-                allStatsList[i] = np.append(allStatsList[i], item)
-    return allStatsList
+    if is_stats_store_up_to_date(datFile):
+        statsDict = get_dict_from_statsFile(datFile, asArrays=True)
+        return list(statsDict.values())
+    return list(np.loadtxt(datFile, delimiter="\t", ndmin=2).T)
 
 
 
@@ -4,21 +4,18 @@
 import numpy as np
 import logging
 import csv
-from numpy.polynomial.polynomial import polyfit
-import seaborn as sns
-from matplotlib import pyplot as plt
-import matplotlib as mpl
-from scipy.stats import linregress
-from scipy import optimize
 from astropy.io import fits
-from glob import glob
 import os
+import json
+import warnings
+from astropy.wcs import WCS
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+from scipy import ndimage
 
-from scipy import *
-from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, get_firstFreq
+from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, get_firstFreq, get_channel_statsDict, get_lowest_channelNo_with_data_from_statsDict, write_stats_store, get_channelsPerBlock, CubeBlockWriter
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
-from logging import info, error
-import subprocess
+from logging import info, warning
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -40,14 +37,27 @@ def format_legend(item):
         item = item[0:index]
     return item.strip()
 
-def write_statistics_file(statsDict, conf):
+def get_filepathRmsyData(conf, sourceName=""):
     """
+    Returns the path of the RM synthesis input file of the source `sourceName`.
+    """
+    if sourceName:
+        return os.path.join(conf.env.dirRMSYdata, "rmsy." + conf.input.basename + "." + sourceName + ".tab")
+    return os.path.join(conf.env.dirRMSYdata, "rmsy." + conf.input.basename + ".tab")
+
+
+def write_statistics_file(statsDict, filepathStatistics):
+    """
+    Writes the RM synthesis input file with the columns frequency, Stokes I, Q,
+    U and their RMS noise in [uJy/beam] and its binary store.
 
     Parameters
     ----------
-
+    statsDict: dict
+       Frequencies, Stokes I, Q, U values and Stokes V RMS noise in [Jy/beam]
+    filepathStatistics: str
+       Path of the tab separated file
     """
-    filepathStatistics = os.path.join(conf.env.dirRMSYdata, "rmsy." + conf.input.basename + ".tab")
     info("Writing statistics file: %s", filepathStatistics)
     with open(filepathStatistics, "w") as csvFile:
         writer = csv.writer(csvFile, delimiter="\t")
@@ -61,6 +71,16 @@ def write_statistics_file(statsDict, conf):
             rmsU = round(statsDict['stokesVrmsList'][i] * 1e6, 4)
             csvData.append([freq, maxI, rmsI, maxQ, rmsQ, maxU, rmsU])
         writer.writerows(csvData)
+    rmsV = np.array(statsDict['stokesVrmsList'], dtype=np.float64) * 1e6
+    write_stats_store(filepathStatistics, [
+        ["frequency", "Hz", np.array(statsDict["frequency"], dtype=np.float64)],
+        ["maxStokesI", "uJy/beam", np.array(statsDict['stokesImaxList'], dtype=np.float64) * 1e6],
+        ["rmsStokesI", "uJy/beam", rmsV],
+        ["maxStokesQ", "uJy/beam", np.array(statsDict['stokesQmaxList'], dtype=np.float64) * 1e6],
+        ["rmsStokesQ", "uJy/beam", rmsV],
+        ["maxStokesU", "uJy/beam", np.array(statsDict['stokesUmaxList'], dtype=np.float64) * 1e6],
+        ["rmsStokesU", "uJy/beam", rmsV],
+        ])
 
 
 def get_dict_from_tabFile(tabFile):
@@ -76,72 +96,202 @@ def get_dict_from_tabFile(tabFile):
     return allStatsDict
 
 
+def get_peakList_from_average_map(conf, topN, minSeparation):
+    """
+    Returns the pixel coordinates [x, y] of the `topN` brightest local maxima
+    of the Stokes I average map, which are at least `minSeparation` pixels
+    apart.
+    """
+    filepathAveragemap = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
+    info(f"Getting the {topN} brightest peaks of the average map: {filepathAveragemap}")
+    with fits.open(filepathAveragemap, memmap=True) as hud:
+        stokesI = np.array(hud[0].data[0, 0], dtype=np.float64)
+    stokesI[~np.isfinite(stokesI)] = -np.inf
+    isLocalMax = (stokesI == ndimage.maximum_filter(stokesI, size=2 * minSeparation + 1)) & np.isfinite(stokesI)
+    yArray, xArray = np.nonzero(isLocalMax)
+    peakList = []
+    for idx in np.argsort(stokesI[yArray, xArray], kind="stable")[::-1]:
+        if len(peakList) == topN:
+            break
+        x, y = int(xArray[idx]), int(yArray[idx])
+        # plateaus give several local maxima next to each other
+        if all(np.hypot(x - xPeak, y - yPeak) >= minSeparation for xPeak, yPeak in peakList):
+            peakList.append([x, y])
+    if len(peakList) < topN:
+        warning(f"Found only {len(peakList)} peaks in the average map.")
+    return peakList
+
+
+def get_sourceList(conf, header, rmsBoxSize):
+    """
+    Returns the sources of the RM synthesis input data as list of dicts with
+    the name and the pixel coordinates `x` (column) and `y` (row).
+
+    The sources are the entries of `rmsySources`, given as pixel coordinates
+    [x, y] or as sky coordinates "RA Dec", and the `rmsyTopN` brightest peaks
+    of the average map. Without sources the position of the highest Stokes I
+    value of the lowest channel with data is used, taken from the buildcube
+    statistics.
+    """
+    wcs = WCS(header).celestial
+    xdim, ydim = int(header["NAXIS1"]), int(header["NAXIS2"])
+    sourceList = []
+    for source in conf.input.rmsySources:
+        if isinstance(source, str):
+            # sexagesimal with colons is in hours, everything else in degrees
+            coordinate = SkyCoord(source.replace(",", " "), unit=(u.hourangle if ":" in source else u.deg, u.deg))
+            x, y = wcs.world_to_pixel(coordinate)
+        else:
+            x, y = source
+        x, y = int(np.round(float(x))), int(np.round(float(y)))
+        if not (0 <= x < xdim and 0 <= y < ydim):
+            warning(f"Skipping source outside of the image: {source}")
+            continue
+        sourceList.append({"x": x, "y": y, "origin": str(source)})
+    if int(conf.input.rmsyTopN) > 0:
+        for x, y in get_peakList_from_average_map(conf, int(conf.input.rmsyTopN), max(1, rmsBoxSize)):
+            sourceList.append({"x": x, "y": y, "origin": "averageMap"})
+    if sourceList:
+        for ii, source in enumerate(sourceList):
+            source["name"] = f"src{ii + 1:03d}"
+    else:
+        info("Getting x-y coordinates of highest value of Stokes I in channel from statistics.")
+        channelStatsDict = get_channel_statsDict(conf)
+        chanNo = get_lowest_channelNo_with_data_from_statsDict(channelStatsDict, allowNan=True)
+        idx = channelStatsDict["chanNo"].index(chanNo)
+        info(f"Using channel: {chanNo}")
+        # maxStokesIposY is the row and maxStokesIposX the column of the image
+        sourceList.append({
+            "name": "",
+            "x": int(channelStatsDict["maxStokesIposX"][idx]),
+            "y": int(channelStatsDict["maxStokesIposY"][idx]),
+            "origin": "statistics",
+            })
+    for source in sourceList:
+        coordinate = wcs.pixel_to_world(source["x"], source["y"])
+        source["ra"], source["dec"] = float(coordinate.ra.deg), float(coordinate.dec.deg)
+        info(f"Source {source['name'] or conf.input.basename}: x = {source['x']}, y = {source['y']}, RA = {source['ra']:.6f}, Dec = {source['dec']:.6f} ({source['origin']})")
+    return sourceList
+
+
+def get_rowRangeList(sourceList, rmsBoxSize, ydim):
+    """
+    Adds the rows and columns of the RMS box to every source and returns the
+    merged ranges of rows [yStart, yStop] that hold the sources and their
+    boxes.
+    """
+    rangeList = []
+    for source in sourceList:
+        source["yBox"] = [max(0, int(source["y"] - rmsBoxSize / 2)), min(ydim, int(source["y"] + rmsBoxSize / 2))]
+        source["xBox"] = [max(0, int(source["x"] - rmsBoxSize / 2)), int(source["x"] + rmsBoxSize / 2)]
+        rangeList.append([min(source["y"], source["yBox"][0]), max(source["y"] + 1, source["yBox"][1])])
+    rowRangeList = []
+    for yStart, yStop in sorted(rangeList):
+        if rowRangeList and yStart <= rowRangeList[-1][1]:
+            rowRangeList[-1][1] = max(rowRangeList[-1][1], yStop)
+        else:
+            rowRangeList.append([yStart, yStop])
+    return rowRangeList
+
+
+def get_spectra_of_sources(cubeName, sourceList, rmsBoxSize, conf):
+    """
+    Returns the Stokes I, Q and U spectra at the positions of the sources as
+    array [Stokes, source, chan] and the robust Stokes V RMS noise in a box of
+    `rmsBoxSize` pixels around them as array [source, chan].
+
+    The cube is opened read-only and read once in channel order, in blocks of
+    channels within `cubeMemoryBudget`. Of every channel only the rows of the
+    sources and their boxes get read. The spectral-major copy from
+    `cube_transpose.py` is used instead if it is up to date.
+    """
+    filepathSpectralMajor = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSpectralMajorNpy)
+    if os.path.exists(filepathSpectralMajor) and os.path.getmtime(filepathSpectralMajor) >= os.path.getmtime(cubeName):
+        info("Reading spectra from spectral-major cube: %s", filepathSpectralMajor)
+        # [Stokes, y, x, chan]
+        spectralMajor = np.load(filepathSpectralMajor, mmap_mode="r")
+        shapeCube = (spectralMajor.shape[0], spectralMajor.shape[3]) + spectralMajor.shape[1:3]
+        blockReader = None
+
+        def read_rows(firstChanIdx, noOfChannels, yStart, yStop):
+            return np.moveaxis(np.array(spectralMajor[:, yStart:yStop, :, firstChanIdx:firstChanIdx + noOfChannels], dtype=np.float32), -1, 1)
+    else:
+        blockReader = CubeBlockWriter(cubeName, readOnly=True)
+        shapeCube = blockReader.shape
+        read_rows = blockReader.read_rows
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    rowRangeList = get_rowRangeList(sourceList, rmsBoxSize, ydim)
+    noOfRows = sum(yStop - yStart for yStart, yStop in rowRangeList)
+    # the read buffer and the float32 copy of the rows
+    channelsPerBlock = get_channelsPerBlock((noOfStokes, noOfChan, noOfRows, xdim), float(conf.input.cubeMemoryBudget) * 1024**3, copies=2)
+    info(f"Reading {noOfRows} of {ydim} rows of {noOfChan} channels in blocks of {channelsPerBlock} channels for {len(sourceList)} sources.")
+
+    spectra = np.full((3, len(sourceList), noOfChan), np.nan)
+    stokesVrms = np.full((len(sourceList), noOfChan), np.nan)
+    for firstChanIdx in range(0, noOfChan, channelsPerBlock):
+        noOfChannels = min(channelsPerBlock, noOfChan - firstChanIdx)
+        chanSlice = slice(firstChanIdx, firstChanIdx + noOfChannels)
+        for yStart, yStop in rowRangeList:
+            rows = read_rows(firstChanIdx, noOfChannels, yStart, yStop)
+            for srcIdx, source in enumerate(sourceList):
+                if not yStart <= source["y"] < yStop:
+                    continue
+                spectra[:, srcIdx, chanSlice] = rows[:3, :, source["y"] - yStart, source["x"]]
+                box = rows[3, :, source["yBox"][0] - yStart:source["yBox"][1] - yStart, source["xBox"][0]:source["xBox"][1]]
+                if box.size:
+                    with warnings.catch_warnings():
+                        # channels that are entirely blanked
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        stokesVrms[srcIdx, chanSlice] = get_std_via_mad(box.reshape(noOfChannels, -1).T, axis=0)
+        if blockReader:
+            blockReader.flush()
+    if blockReader:
+        blockReader.close()
+    return spectra, stokesVrms
+
+
+def write_sources_file(sourceList, conf):
+    """
+    Writes the names, pixel and sky coordinates of the sources as json file.
+    """
+    filepathSources = os.path.join(conf.env.dirRMSYdata, "rmsy." + conf.input.basename + ".sources.json")
+    info(f"Writing sources file: {filepathSources}")
+    with open(filepathSources, "w") as f:
+        json.dump([{key: source[key] for key in ["name", "x", "y", "ra", "dec", "origin"]} for source in sourceList], f, indent=2)
+
+
 def get_rmsyDict_from_cube(conf):
     """
-    Simple not optimized version TODO
+    Writes the RM synthesis input data of the sources from `get_sourceList`,
+    one file per source.
 
     """
     cubeName = conf.input.basename + conf.env.extCubeFits
     info(SEPERATOR)
     info("Opening data cube: %s", cubeName)
-    # TODO: debug: if ignore_missing_end is not true I get an error.
-    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="update")
-    dataCube = hudCube[0].data
-    asd, maxIndex, width, height = shape(dataCube)
-    rmsBoxSize = int(width * 0.04)
-    # get pixel coordinates of max value. try first channel. If it is nan, go to next channel
-    info("Trying to get x-y coordinates of highest value of Stokes I in channel.")
-    for ii in range(0, maxIndex + 1):
-        info(f"Trying channel: {ii + 1}")
-        if not np.isnan(np.nanmax(dataCube[0, ii, :, :])):
-            print(np.nanmax(dataCube[0, ii, :, :]))
-            print(np.where(dataCube == np.amax(dataCube[0, ii, :, :])))
-            asd, asdidx, xMaxIndex, yMaxIndex = np.where(dataCube == np.amax(dataCube[0, ii, :, :]))
-            xMaxIndex = xMaxIndex[0]
-            yMaxIndex = yMaxIndex[0]
-            break
-    info(f"Found max value at coordinates: x = {xMaxIndex}, y = {yMaxIndex}")
-
-    freqList = []
-    stokesImaxList = []
-    stokesQmaxList = []
-    stokesUmaxList = []
-    stokesVrmsList = []
-
-    for ii in range(0, maxIndex + 1):
-        # try except, excepts by np.nan. TODO: write this cleaner
-        try:
-            firstFreq = get_firstFreq(conf)
-            freq = firstFreq + conf.input.outputChanBandwidth * ii
-            stokesImax = dataCube[0, ii, xMaxIndex, yMaxIndex]
-            stokesQmax = dataCube[1, ii, xMaxIndex, yMaxIndex]
-            stokesUmax = dataCube[2, ii, xMaxIndex, yMaxIndex]
-
-            xStart = int(xMaxIndex - rmsBoxSize/2)
-            xStop = int(xMaxIndex + rmsBoxSize/2)
-            yStart = int(yMaxIndex - rmsBoxSize/2)
-            yStop = int(yMaxIndex + rmsBoxSize/2)
-            stokesVrms = get_std_via_mad(dataCube[3, ii, xStart:xStop, yStart:yStop])
-
-            freqList.append(freq)
-            stokesImaxList.append(stokesImax)
-            stokesQmaxList.append(stokesQmax)
-            stokesUmaxList.append(stokesUmax)
-            stokesVrmsList.append(stokesVrms)
-            info(f"From channel number {ii + 1} got frequency [Hz], stokesImax [uJy/beam], stokesQmax [uJy/beam], stokesUmax [uJy/beam], stokesVrms [uJy/beam]: {freq * 1e6}, {stokesImax * 1e6}, {stokesQmax * 1e6}, {stokesUmax * 1e6}, {stokesVrms * 1e6}")
-        except:
-            info(f"Channel is nan: {ii + 1}")
+    header = fits.getheader(cubeName, ignore_missing_end=True)
+    rmsBoxSize = int(int(header["NAXIS2"]) * 0.04)
+    sourceList = get_sourceList(conf, header, rmsBoxSize)
+    spectra, stokesVrms = get_spectra_of_sources(cubeName, sourceList, rmsBoxSize, conf)
 
-    info(SEPERATOR)
-    hudCube.close()
-    statsDict = dict()
-    statsDict["frequency"] = freqList
-    statsDict["stokesImaxList"] = stokesImaxList
-    statsDict["stokesQmaxList"] = stokesQmaxList
-    statsDict["stokesUmaxList"] = stokesUmaxList
-    statsDict["stokesVrmsList"] = stokesVrmsList
-    write_statistics_file(statsDict, conf)
+    # channels flagged in the channel mask may not be blanked in the cube
+    channelStatsDict = get_channel_statsDict(conf)
+    flaggedChanIdxList = [chanNo - 1 for chanNo, flagged in zip(channelStatsDict["chanNo"], channelStatsDict["flagged"]) if flagged and chanNo <= stokesVrms.shape[1]]
+    spectra[:, :, flaggedChanIdxList] = np.nan
+    stokesVrms[:, flaggedChanIdxList] = np.nan
+    freqList = list(get_firstFreq(conf) + conf.input.outputChanBandwidth * np.arange(stokesVrms.shape[1]))
 
+    info(SEPERATOR)
+    for srcIdx, source in enumerate(sourceList):
+        statsDict = dict()
+        statsDict["frequency"] = freqList
+        statsDict["stokesImaxList"] = spectra[0, srcIdx]
+        statsDict["stokesQmaxList"] = spectra[1, srcIdx]
+        statsDict["stokesUmaxList"] = spectra[2, srcIdx]
+        statsDict["stokesVrmsList"] = stokesVrms[srcIdx]
+        write_statistics_file(statsDict, get_filepathRmsyData(conf, source["name"]))
+    if sourceList[0]["name"]:
+        write_sources_file(sourceList, conf)
 
 
 @main_timer
@@ -4,6 +4,7 @@
 import numpy as np
 import logging
 import csv
+import copy
 import shutil
 from numpy.polynomial.polynomial import polyfit
 import seaborn as sns
@@ -11,19 +12,18 @@ import matplotlib as mpl
 mpl.use('Agg') # Backend that doesn't need X server
 from matplotlib import pyplot as plt
 from scipy.stats import linregress
-from scipy import optimize
-from astropy.io import fits
 from glob import glob
 import os
 
 from scipy import *
-from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, update_CRPIX3, SEPERATOR, run_command_with_logging, get_dict_from_tabFile, format_legend
+from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, update_CRPIX3, SEPERATOR, run_command_with_logging, get_dict_from_statsFile, write_stats_store, get_filepathStatsStore, format_legend, CubeBlockWriter, get_channelsPerBlock, get_channelBlockList, get_peak_rss, read_channel_mask, write_channel_mask, queue_plot, subtract_channels_from_average_maps
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from logging import info, error
 import subprocess
 
 PRE_IOR_LIMIT_SIGMA = 10 # n sigma over median
 IOR_LIMIT_SIGMA = 8 # n sigma over median
+CREATE_ITERATION_PLOTS = False
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
@@ -68,12 +68,21 @@ def write_statistics_file(statsDict, conf):
             freq = round(statsDict["frequency"][i], 4)
             csvData.append([chanNo, freq, rmsI, rmsV, maxI, flagged])
         writer.writerows(csvData)
+    write_stats_store(filepathStatistics, [
+        ["chanNo", "", np.array(statsDict["chanNo"], dtype=np.int64)],
+        ["frequency", "MHz", np.array(statsDict["frequency"], dtype=np.float64)],
+        ["rmsStokesI", "uJy/beam", np.array(statsDict["rmsStokesI"], dtype=np.float64)],
+        ["rmsStokesV", "uJy/beam", np.array(statsDict["rmsStokesV"], dtype=np.float64)],
+        ["maxStokesI", "uJy/beam", np.array(statsDict["maxStokesI"], dtype=np.float64)],
+        ["flagged", "", np.array(statsDict["flagged"], dtype=bool)],
+        ])
     # also copy ior-flagged statistics file in dirOutput
             # code when Exception occur
-    try:
-        shutil.copyfile(filepathStatistics, os.path.join(conf.input.dirOutput, filepathStatistics))
-    except shutil.SameFileError:
-        pass
+    for filepath in [filepathStatistics, get_filepathStatsStore(filepathStatistics)]:
+        try:
+            shutil.copyfile(filepath, os.path.join(conf.input.dirOutput, filepath))
+        except shutil.SameFileError:
+            pass
 
 # polyom to fit
 def h(x, a, b, c, d):
@@ -91,6 +100,7 @@ def plot_all(statsDict, yDataFit, std, outlierIndexSet, iteration, conf):
     xData = statsDict['chanNo']
     x2Data = np.array(statsDict['frequency']) /1000  # conver to GHz
     yData = statsDict['rmsStokesV']
+    yDataFit = np.asarray(yDataFit)
     fig, ax1 = plt.subplots(figsize=(16,7.5))
     ax1.set_title(r'Iterative outlier rejection, iteration ' + str(iteration))
     ax1.set_xlabel(r'channel',fontsize=22)
@@ -131,67 +141,99 @@ def plot_all(statsDict, yDataFit, std, outlierIndexSet, iteration, conf):
     #plt.show()
 
 
-def get_xyData_after_flagging_by_indexList(indexList, xData, yData):
-    xDataNew = []
-    yDataNew = []
-    for i, asd in enumerate(xData):
-        if i not in indexList:
-            xDataNew.append(xData[i])
-            yDataNew.append(yData[i])
-    return [xDataNew, yDataNew]
+def get_polynomial_fit(xData, yData):
+    '''
+    Returns the least-squares coefficients [a, b, c, d] of `h` in closed form.
+
+    `h` is linear in its coefficients, so the fit is a single linear
+    least-squares solve. The x-axis is scaled to [-1, 1] to keep the
+    design matrix well conditioned for many channels. `c` and `d` are
+    degenerate, the constant gets split evenly between them.
+    '''
+    xData = np.asarray(xData, dtype=np.float64)
+    yData = np.asarray(yData, dtype=np.float64)
+    xScale = np.max(np.abs(xData)) if xData.size else 1.
+    xScale = xScale if xScale > 0 else 1.
+    xScaled = xData / xScale
+    designMatrix = np.column_stack([xScaled**3, xScaled**2, np.ones_like(xScaled)])
+    (a, b, constant), _, _, _ = np.linalg.lstsq(designMatrix, yData, rcond=None)
+    return [a / xScale**3, b / xScale**2, constant / 2, constant / 2]
 
 
-def get_flaggedIndexList_by_strong_outliers(xData, yData):
+def get_flaggedMask_for_nan_and_zero(xData, yData):
     '''
-    Removes strong outiers that are PRE_IOR_LIMIT_SIGMA * yStd away from the
-    median.
+    Returns a boolean mask of the channels with NaN or zero values.
+    '''
+    return (xData == 0) | np.isnan(xData) | (yData == 0) | np.isnan(yData)
+
+
+def get_flaggedMask_by_strong_outliers(yData):
+    '''
+    Returns a boolean mask of the strong outiers that are
+    PRE_IOR_LIMIT_SIGMA * yStd away from the median.
     '''
     yMedian = np.nanmedian(yData)
     yStd = get_std_via_mad(yData)
-    upperLimit = yMedian + (PRE_IOR_LIMIT_SIGMA * yStd)
-    lowerLimit = yMedian - (PRE_IOR_LIMIT_SIGMA * yStd)
-    flaggedIndexList = []
-    for idx, (x, y) in enumerate(zip(xData, yData)):
-        if y > upperLimit or y < lowerLimit:
-            flaggedIndexList.append(idx)
-    return flaggedIndexList
-
-
-def get_flaggedIndexList_by_ior_with_fit(xData, yData, outlierIndexSet, xDataInitial, yDataInitial):
-    flaggedIndexList = []
-    initial_guess_abc = [1, 1, 1, 1]
-    xDataCleaned, yDataCleaned = remove_nan_and_zero_from_xyData(xData, yData)
-    variables, variables_covariance = optimize.curve_fit(h, xDataCleaned, yDataCleaned, initial_guess_abc)
-    a, b, c, d = variables
-    yDataFit = h(xData, a, b, c, d)
-    yDataFitAllData = h(xDataInitial, a, b, c, d)
-    std = get_std_via_mad(np.array(yDataFit) - np.array(yData))
-    for i, asd in enumerate(xDataInitial):
-        # above x times sigma
-        if yDataInitial[i] > yDataFitAllData[i] + IOR_LIMIT_SIGMA * std:
-            flaggedIndexList.append(i)
-        # below x times sigma
-        elif yDataInitial[i] < yDataFitAllData[i] - IOR_LIMIT_SIGMA * std:
-            flaggedIndexList.append(i)
-    return [flaggedIndexList, std, [a, b, c, d]]
-
-def remove_nan_and_zero_from_xyData(xData, yData):
-    xDataCleaned = []
-    yDataCleaned = []
-    for i, y_i in enumerate(yData):
-        if np.isnan(y_i) or y_i is 0:
-            pass
-        else:
-            xDataCleaned.append(xData[i])
-            yDataCleaned.append(yData[i])
-    return [np.array(xDataCleaned), np.array(yDataCleaned)]
-
-def get_flaggedIndexList_for_nan_and_zero(xData, yData):
-    flaggedIndexList = []
-    for i, asd in enumerate(xData):
-        if xData[i] in [0, np.nan] or yData[i] in [0, np.nan]:
-            flaggedIndexList.append(i)
-    return flaggedIndexList
+    with np.errstate(invalid="ignore"):
+        return np.abs(yData - yMedian) > PRE_IOR_LIMIT_SIGMA * yStd
+
+
+def get_flaggedMask_by_ior_with_fit(xData, yData, outlierMask):
+    '''
+    Fits `h` to the channels not in `outlierMask` and returns the mask of all
+    channels more than IOR_LIMIT_SIGMA * std away from the fit.
+
+    Returns
+    -------
+    [flaggedMask, std, fitCoefficients]
+    '''
+    unflaggedMask = ~outlierMask
+    fitMask = unflaggedMask & ~np.isnan(yData)
+    fitCoefficients = get_polynomial_fit(xData[fitMask], yData[fitMask])
+    yDataFitAllData = h(xData, *fitCoefficients)
+    std = get_std_via_mad(yDataFitAllData[unflaggedMask] - yData[unflaggedMask])
+    with np.errstate(invalid="ignore"):
+        flaggedMask = np.abs(yData - yDataFitAllData) > IOR_LIMIT_SIGMA * std
+    return [flaggedMask, std, fitCoefficients]
+
+
+def get_outlierMask_by_ior(xData, yData, iterationCallback=None):
+    '''
+    Iterative outlier rejection on arrays, without plots or config, so it can
+    be run on many cubes in a batch.
+
+    Channels with NaN or zero values and strong outliers are excluded from the
+    first fit. The fit gets repeated without the outliers found so far until
+    no new outliers are found. The outliers of the last fit are returned.
+
+    Parameters
+    ----------
+    xData: numpy.array
+       Channel numbers
+    yData: numpy.array
+       Stokes V RMS noise per channel
+    iterationCallback: function
+       Called as `iterationCallback(iteration, outlierMask, std, fitCoefficients)`
+       after every iteration
+
+    Returns
+    -------
+    [outlierMask, std, fitCoefficients]
+    '''
+    xData = np.asarray(xData, dtype=np.float64)
+    yData = np.asarray(yData, dtype=np.float64)
+    outlierMask = get_flaggedMask_for_nan_and_zero(xData, yData) | get_flaggedMask_by_strong_outliers(yData)
+    iteration = 1
+    while True:
+        noOfOutliersBefore = np.count_nonzero(outlierMask)
+        flaggedMask, std, fitCoefficients = get_flaggedMask_by_ior_with_fit(xData, yData, outlierMask)
+        outlierMask = outlierMask | flaggedMask
+        if iterationCallback:
+            iterationCallback(iteration, outlierMask, std, fitCoefficients)
+            iteration += 1
+        if np.count_nonzero(outlierMask) == noOfOutliersBefore:
+            return [flaggedMask, std, fitCoefficients]
+
 
 def get_outlierIndex_and_fitStats_dict(statsDict, conf):
     xData = statsDict['chanNo']
@@ -199,34 +241,19 @@ def get_outlierIndex_and_fitStats_dict(statsDict, conf):
     resultsDict = {}
     resultsDict['xData'] = xData
     resultsDict['yData'] = yData
-    xDataInitial = xData
-    yDataInitial = yData
-    flaggedIndexListOfNanAndZero = get_flaggedIndexList_for_nan_and_zero(xData, yData)
-    # flag far above/below median
-    flaggedIndexListOfStrongOutliers = get_flaggedIndexList_by_strong_outliers(xData, yData)
-    xData, yData = get_xyData_after_flagging_by_indexList(flaggedIndexListOfNanAndZero, xDataInitial, yDataInitial)
-    outlierIndexSet = set(flaggedIndexListOfNanAndZero).union(set(flaggedIndexListOfStrongOutliers))
-    tmpOutlierIndexList, std, fitCoefficients = get_flaggedIndexList_by_ior_with_fit(xDataInitial, yDataInitial, outlierIndexSet, xDataInitial, yDataInitial)
-
-    outlierSwitch = True
-    iteration = 1
-    while outlierSwitch:
-        outlierIndexLengthBefore = len(outlierIndexSet)
-        xData, yData = get_xyData_after_flagging_by_indexList(outlierIndexSet, xDataInitial, yDataInitial)
 
-        tmpOutlierIndexList, std, fitCoefficients = get_flaggedIndexList_by_ior_with_fit(xData, yData, outlierIndexSet, xDataInitial, yDataInitial)
+    # number of the final plot, follows the iteration plots
+    finalIteration = [1]
 
-        outlierIndexSet = outlierIndexSet.union(set(tmpOutlierIndexList))
-        outlierIndexLengthAfter = len(outlierIndexSet)
+    plotStatsDict = {key: statsDict[key] for key in ['chanNo', 'frequency', 'rmsStokesV']}
 
-        a, b, c, d = fitCoefficients
-        if CREATE_ITERATION_PLOTS:
-            plot_all(statsDict, get_yDataFit(resultsDict['xData'], a, b, c, d), std, outlierIndexSet, iteration, conf)
-            iteration += 1
-        if outlierIndexLengthBefore == outlierIndexLengthAfter:
-            outlierIndexSet = set(tmpOutlierIndexList)
-            plot_all(statsDict, get_yDataFit(resultsDict['xData'], a, b, c, d), std, outlierIndexSet, iteration, conf)
-            outlierSwitch = False
+    def plot_iteration(iteration, outlierMask, std, fitCoefficients):
+        queue_plot(conf, "ior-iterations", plot_all, statsDict=plotStatsDict, yDataFit=get_yDataFit(xData, *fitCoefficients), std=std, outlierIndexSet=np.flatnonzero(outlierMask), iteration=iteration)
+        finalIteration[0] = iteration + 1
+
+    outlierMask, std, fitCoefficients = get_outlierMask_by_ior(xData, yData, iterationCallback=plot_iteration if CREATE_ITERATION_PLOTS else None)
+    outlierIndexSet = set(np.flatnonzero(outlierMask).tolist())
+    queue_plot(conf, "ior", plot_all, statsDict=plotStatsDict, yDataFit=get_yDataFit(xData, *fitCoefficients), std=std, outlierIndexSet=outlierIndexSet, iteration=finalIteration[0])
     resultsDict['outlierIndexSet'] = outlierIndexSet
     resultsDict['sigmaRMS'] = std
     resultsDict['fitCoefficients'] = fitCoefficients
@@ -244,9 +271,30 @@ def get_outlierChanNoList_from_outlierIndexSet(statsDict, outlierIndexSet):
         outlierChanNoList.append(statsDict['chanNo'][idx])
     return outlierChanNoList
 
-def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal"):
+def blank_channels_in_cube(chanNoList, cubeName, conf):
+    """
+    Writes NaN into all pixels of the channels `chanNoList` of the cube.
+    """
+    info(SEPERATOR)
+    info("Opening data cube: %s", cubeName)
+    info(SEPERATOR)
+    with CubeBlockWriter(cubeName) as blockWriter:
+        channelsPerBlock = get_channelsPerBlock(blockWriter.shape, float(conf.input.cubeMemoryBudget) * 1024**3, copies=1)
+        nanBlock = np.full((blockWriter.shape[0], channelsPerBlock) + blockWriter.shape[2:], np.nan, dtype=np.float32)
+        for blockChanNoList in get_channelBlockList([int(chanNo) for chanNo in chanNoList], channelsPerBlock):
+            info(f"Flagging chanNo {blockChanNoList}")
+            blockWriter.write_channels(blockChanNoList[0] - 1, nanBlock[:, :len(blockChanNoList)])
+            blockWriter.flush()
+    info(f"Peak RSS: {get_peak_rss() / 1024**3:.2f} GB")
+
+
+def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal", initialStatsDict=None):
     """
     Flag channels in data cube.
+
+    The flagged channels are stored in the channel mask of the cube and of its
+    HDF5 file. If `blankFlaggedChannels` is set, the channels that are not
+    blanked in the cube yet get blanked with NaN.
     """
     if mode == "smoothed":
         cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
@@ -256,19 +304,18 @@ def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal"):
     if conf.input.ignoreStokesVFlagging:
         info("ignoreStokesVFlagging flag is set! NOT APPLYING FLAGGING TO CHANNELS!")
         info("Attention: Plots and report will show flagged channels and statistics as if the flagging has been applied.")
-    info(SEPERATOR)
-    info("Opening data cube: %s", cubeName)
-    # TODO: debug: if ignore_missing_end is not true I get an error.
-    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="update")
-    dataCube = hudCube[0].data
-
-    info(SEPERATOR)
-    if not conf.input.ignoreStokesVFlagging:
-        for chanNo in chanNoList:
-            idx = int(chanNo) - 1
-            info(f"Flagging chanNo {chanNo}")
-            dataCube[:, idx, :, :] = np.nan
-    hudCube.close()
+    channelMask = read_channel_mask(cubeName, conf)
+    blankedChanNoSet = channelMask["blanked"] if channelMask else set()
+    if conf.input.blankFlaggedChannels and not conf.input.ignoreStokesVFlagging:
+        newChanNoList = get_only_newly_flagged_chanNoList(initialStatsDict, chanNoList, blankedChanNoSet)
+        info(f"Blanking {len(newChanNoList)} newly flagged of {len(chanNoList)} flagged channels.")
+        if newChanNoList:
+            if mode == "smoothed":
+                # the average maps can only drop the channels while they hold data
+                subtract_channels_from_average_maps(newChanNoList, conf)
+            blank_channels_in_cube(newChanNoList, cubeName, conf)
+        blankedChanNoSet = blankedChanNoSet.union(newChanNoList)
+    write_channel_mask(cubeName, conf, chanNoList, blankedChanNoSet)
 
     update_CRPIX3(cubeName)
 
@@ -278,26 +325,26 @@ def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal"):
     hdf5Outputfile = os.path.join(conf.input.dirHdf5Output, os.path.basename(cubeName.replace(".fits", '.hdf5')))
     command = " ".join([conf.input.hdf5Converter, "-o", hdf5Outputfile, cubeName])
     run_command_with_logging(command)
+    write_channel_mask(hdf5Outputfile, conf, chanNoList, blankedChanNoSet)
 
-def get_only_newly_flagged_chanNoList(initialStatsDict, outlierChanNoList):
+def get_only_newly_flagged_chanNoList(initialStatsDict, outlierChanNoList, blankedChanNoSet=None):
     '''
-    TODO: implement when time!
-    TODO: not optimzed yet. This goes through the whole cube even if flagged
-    channels are known from the previous statistics
+    Returns the outlier channels that are not blanked in the cube yet. Channels
+    flagged by buildcube in `initialStatsDict` and channels in
+    `blankedChanNoSet`, blanked by a previous run, are already NaN.
     '''
-    #chanNoList = []
-    #for chanNo, flagged in zip(initialStatsDict['chanNo'], initialStatsDict['flagged']):
-    #    if not flagged and (chanNo in outlierChanNoList):
-    #        chanNoList.append(chanNo)
-    #return chanNoList
-    return outlierChanNoList
+    if blankedChanNoSet is None:
+        blankedChanNoSet = set()
+    if initialStatsDict:
+        blankedChanNoSet = blankedChanNoSet.union(chanNo for chanNo, flagged in zip(initialStatsDict['chanNo'], initialStatsDict['flagged']) if flagged)
+    return [chanNo for chanNo in outlierChanNoList if chanNo not in blankedChanNoSet]
 
 @main_timer
 def main():
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
     filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
-    statsDict = get_dict_from_tabFile(filepathStatistics)
-    initialStatsDict = dict(statsDict)  # make a deep copy
+    statsDict = get_dict_from_statsFile(filepathStatistics)
+    initialStatsDict = copy.deepcopy(statsDict)
     resultsDict = get_outlierIndex_and_fitStats_dict(statsDict, conf)
     a, b, c, d = resultsDict['fitCoefficients']
     std = resultsDict['sigmaRMS']
@@ -306,14 +353,12 @@ def main():
     write_statistics_file(statsDictUpdated, conf)
     outlierChanNoList = get_outlierChanNoList_from_outlierIndexSet(statsDictUpdated, outlierIndexSet)
 
-    # optimize: remove channels from list that are already np.nan from cube creation
-    outlierChanNoList = get_only_newly_flagged_chanNoList(initialStatsDict, outlierChanNoList)
-    # TODO: flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf)
-    # TODO: make this nicer
-    flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf, mode="normal")
+    flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf, mode="normal", initialStatsDict=initialStatsDict)
     # TODO maybe try a better if-clause
     if os.path.exists(os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)):
-        flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf, mode="smoothed")
+        filepathSmoothedStatistics = conf.input.basename + conf.env.extCubeSmoothedStatistics
+        initialSmoothedStatsDict = get_dict_from_statsFile(filepathSmoothedStatistics) if os.path.exists(filepathSmoothedStatistics) else None
+        flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf, mode="smoothed", initialStatsDict=initialSmoothedStatsDict)
 
 if __name__ == "__main__":
     CREATE_ITERATION_PLOTS = True
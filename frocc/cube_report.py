@@ -36,7 +36,7 @@ from astropy.io import fits
 import aplpy
 from casatasks import listobs
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header, read_file_as_string, write_file_from_string, get_timestamp, run_command_with_logging, get_dict_from_tabFile, get_lowest_channelIdx_and_freq_with_data_in_cube
+from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header, read_file_as_string, write_file_from_string, get_timestamp, run_command_with_logging, get_dict_from_statsFile, get_channel_statsDict, get_lowest_channelNo_with_data_from_statsDict, render_plot_queue
 from frocc.check_output import print_output
 from frocc.config import FORMAT_LOGS_TIMESTAMP, FILEPATH_JINJA_TEMPLATE, FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
@@ -88,21 +88,33 @@ def generate_preview_jpg(conf, mode=None):
         print(filepath)
         savePath = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubeAveragemapPreviewJpg)
         print(savePath)
-        data, header = fits.getdata(filepath, header=True)
+        header = fits.getheader(filepath)
         title = "Preview: Average map for Stokes I, scalar P, Stokes V"
+        refChanIdx = 0
     else:
         filepath = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
         savePath = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubePreviewJpg)
-        data, header = fits.getdata(filepath, header=True)
-        chanIdxFreqDict = get_lowest_channelIdx_and_freq_with_data_in_cube(filepath)
-        title = f"Preview: Cube with Stokes IQUV for channel index {chanIdxFreqDict['chanIdx']} at {round(float(chanIdxFreqDict['freq']),2)} GHz"
+        header = fits.getheader(filepath)
+        # lowest channel with data from the buildcube statistics, the cube is not read
+        statsDict = get_channel_statsDict(conf)
+        chanNo = get_lowest_channelNo_with_data_from_statsDict(statsDict)
+        if chanNo is None:
+            # every channel has blanked pixels
+            chanNo = get_lowest_channelNo_with_data_from_statsDict(statsDict, allowNan=True)
+        if chanNo is None:
+            info("No channel with data in the statistics, using channel 1 for the preview.")
+            chanNo = 1
+        refChanIdx = chanNo - 1
+        if chanNo in statsDict['chanNo'] and np.isfinite(statsDict['frequency'][statsDict['chanNo'].index(chanNo)]):
+            freq = statsDict['frequency'][statsDict['chanNo'].index(chanNo)] * 1e-3  # MHz to GHz
+        else:
+            freq = (float(header['CRVAL3']) + (chanNo - float(header['CRPIX3'])) * float(header['CDELT3'])) * 1e-9  # Hz to GHz
+        title = f"Preview: Cube with Stokes IQUV for channel index {refChanIdx} at {round(float(freq),2)} GHz"
 #        title = f"Preview: Cube with Stokes IQUV for channel {header['CRPIX3']} at {round(float(header['CRVAL3'])*1e-9,2)} GHz"
 
 
-    #refChanIdx = int(header['CRPIX3']) - 1
-    refChanIdx = get_lowest_channelNo_with_data_in_cube(filepath) - 1
-    imgCount = data.shape[0]
-    imSize = data.shape[-1]
+    imgCount = header['NAXIS4']
+    imSize = header['NAXIS1']
     if imSize >= 512:
         downsamplingFactor = imSize//512
     else:
@@ -144,11 +156,18 @@ def write_jinja_reportTemplate(conf):
     listobsOutputList = [ read_file_as_string(s) for s in write_listobs_for_inputMS_and_get_filenames(conf) ]
     timestamp = get_timestamp("%H:%M:%S")
     chanStatsDict = get_cube_channel_statsDict(conf)
-    iorPlotFilePath = sorted(glob(os.path.join(conf.env.dirPlots, "*diagnostic-ior*pdf")))[-1]
+    # plots can be disabled via `disabledPlots` or fail in the plot queue,
+    # their figures are left out of the report
+    iorPlotFileList = sorted(glob(os.path.join(conf.env.dirPlots, "*diagnostic-ior*pdf")))
+    iorPlotFilePath = iorPlotFileList[-1] if iorPlotFileList else ""
     if conf.input.fileXYphasePolAngleCoeffs:
-        xyPhasePolCorrPlotFilePath = sorted(glob(os.path.join(conf.env.dirPlots, "*diagnostic-xyPhaseCorr-polAngleCorr*pdf")))[-1]
+        xyPhasePolCorrPlotFileList = sorted(glob(os.path.join(conf.env.dirPlots, "*diagnostic-xyPhaseCorr-polAngleCorr*pdf")))
+        xyPhasePolCorrPlotFilePath = xyPhasePolCorrPlotFileList[-1] if xyPhasePolCorrPlotFileList else ""
     else:
         xyPhasePolCorrPlotFilePath = ""
+    maxStokesIPlotFilePath = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubeMaxStokesIPlotPdf)
+    if not os.path.exists(maxStokesIPlotFilePath):
+        maxStokesIPlotFilePath = ""
 
     runtimeDict = get_total_runtime_formated(conf)
 
@@ -161,6 +180,7 @@ def write_jinja_reportTemplate(conf):
             listobsOutputList = listobsOutputList,
             chanStatsDict = chanStatsDict,
             iorPlotFilePath = iorPlotFilePath,
+            maxStokesIPlotFilePath = maxStokesIPlotFilePath,
             runtimeDict = runtimeDict,
             xyPhasePolCorrPlotFilePath = xyPhasePolCorrPlotFilePath,
             )
@@ -268,7 +288,7 @@ def get_total_runtime_formated(conf):
 
 def generate_max_stokesI_plot(conf):
     tabfile = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeIORStatistics)
-    statsDict = get_dict_from_tabFile(tabfile)
+    statsDict = get_dict_from_statsFile(tabfile)
     xData = statsDict['chanNo']
     x2Data = np.array(statsDict['frequency']) /1000  # convert to GHz
     yData = np.array(statsDict['maxStokesI']) / 1e6  # convert to Jy
@@ -347,7 +367,7 @@ def get_cube_channel_statsDict(conf):
     dataDict = {}
     dataDict['predicted'] = len([item for sublist in conf.data.predictedOutputChannels for item in sublist])
     tabfile = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeIORStatistics)
-    statsDict = get_dict_from_tabFile(tabfile)
+    statsDict = get_dict_from_statsFile(tabfile)
     dataDict['total'] = len(statsDict['chanNo'])
     iorflaggedCount = 0
     imageCount = 0
@@ -367,12 +387,15 @@ def get_cube_channel_statsDict(conf):
 def report_all(conf):
 #    try:
     if True:
-        generate_max_stokesI_plot(conf)
-        generate_plot_runtimes(conf)
-        generate_max_stokesI_plot(conf)
-        generate_preview_jpg(conf)
+        # the queued plots of the stages and the report plots are rendered in parallel
+        plotJobList = [
+            ["maxStokesI", generate_max_stokesI_plot, {}],
+            ["runtimes", generate_plot_runtimes, {}],
+            ["preview", generate_preview_jpg, {}],
+            ]
         if conf.input.smoothbeam:
-            generate_preview_jpg(conf, mode="smoothed")
+            plotJobList.append(["preview-smoothed", generate_preview_jpg, {"mode": "smoothed"}])
+        render_plot_queue(conf, plotJobList)
         write_jinja_reportTemplate(conf)
         create_md_from_template(conf)
         create_pdf_from_template(conf)
@@ -0,0 +1,641 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ This script runs RM synthesis on every pixel of the data cube. The Stokes Q
+ and U cube is read in spatial tiles of image rows, the Faraday dispersion
+ function (FDF) of all pixels of a tile is computed at once as matrix product
+ with a kernel that is shared by all pixels with the same channels with data,
+ or for large Faraday depth grids with a non-uniform FFT, see `rmsynthKernel`.
+ The tiles get processed by `rmsynthWorkers` processes within
+ `cubeMemoryBudget`, which write disjoint rows of the output cubes: the
+ Faraday depth and polarised intensity of the FDF peak and optionally the FDF
+ itself, see `rmsynthWriteFdf`.
+ Pixels with a peak below `rmsynthThreshold` times the noise of the FDF are
+ blanked.
+
+------------------------------------------------------------------------------
+
+ Developed at: IDIA (Institure for Data Intensive Astronomy), Cape Town, ZA
+
+------------------------------------------------------------------------------
+"""
+
+import os
+import csv
+import multiprocessing
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import get_config_in_dot_notation, main_timer, SEPERATOR, get_channel_statsDict, write_stats_store, update_fits_header_of_cube, CubeBlockWriter, get_channelBlockList, get_peak_rss
+from frocc.cube_average_map import write_empty_cube, get_rms_from_stokesV
+from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
+from frocc.logger import *
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# SETTINGS
+
+SPEED_OF_LIGHT = 299792458.  # m/s
+# kernels of different channel patterns that a worker keeps
+RMSYNTH_KERNEL_CACHE_SIZE = 16
+# NUFFT kernel: oversampling of the Faraday depth grid by the FFT grid
+NUFFT_OVERSAMPLING = 2
+# NUFFT kernel: complex values gridded at once, bounds the temporary memory
+NUFFT_CHUNK_SIZE = 2**22
+# NUFFT kernel: the channels get gridded with a matrix product if they cover at
+# most this many times the cells of one channel, the matrix product is about
+# 20 times faster per value than `np.add.reduceat`
+NUFFT_DENSE_GRIDDING_FACTOR = 16
+
+# SETTINGS
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def get_cubeNameInput_and_mode(conf):
+    """
+    Returns the smoothed cube if `smoothbeam` is set, with a common resolution
+    of all channels, otherwise the cube.
+    """
+    if conf.input.smoothbeam:
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits), "smoothed"
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits), "normal"
+
+
+def get_lambdaSqArray_from_header(header):
+    """
+    Returns the wavelength squared in m^2 of all channels of the cube `header`.
+    """
+    chanIdxArray = np.arange(int(header["NAXIS3"]), dtype=np.float64)
+    frequencies = float(header["CRVAL3"]) + (chanIdxArray + 1 - float(header["CRPIX3"])) * float(header["CDELT3"])
+    return (SPEED_OF_LIGHT / frequencies)**2
+
+
+def get_weights_and_noise(blockReader, conf, mode="normal"):
+    """
+    Returns the weights and the Stokes V RMS noise in Jy/beam of all channels.
+    Flagged channels and channels without noise estimate get a weight of zero.
+
+    The weights are the inverse variances for `rmsynthWeighting` "variance"
+    and one for "uniform".
+    """
+    channelStatsDict = get_channel_statsDict(conf, mode=mode)
+    rmsVDict = dict(zip(channelStatsDict["chanNo"], channelStatsDict["rmsStokesV"]))
+    flaggedDict = dict(zip(channelStatsDict["chanNo"], channelStatsDict["flagged"]))
+    noOfChan = blockReader.shape[1]
+    noise = np.full(noOfChan, np.nan)
+    for ii in range(noOfChan):
+        chanNo = ii + 1
+        if flaggedDict.get(chanNo, True):
+            continue
+        rms = rmsVDict.get(chanNo, np.nan)
+        if not np.isfinite(rms):
+            rms = get_rms_from_stokesV(blockReader, ii, conf)
+            info(f"No RMS noise of channel {chanNo} in the statistics file, estimated from Stokes V: {rms} uJy/beam")
+        noise[ii] = rms * 1e-6  # uJy/beam to Jy/beam
+    hasNoise = np.isfinite(noise) & (noise > 0)
+    if conf.input.rmsynthWeighting == "variance":
+        weights = np.where(hasNoise, 1 / np.where(hasNoise, noise, 1.)**2, 0.)
+    elif conf.input.rmsynthWeighting == "uniform":
+        weights = hasNoise.astype(np.float64)
+    else:
+        error(f"Unknown rmsynthWeighting: {conf.input.rmsynthWeighting}")
+        raise ValueError(f"Unknown rmsynthWeighting: {conf.input.rmsynthWeighting}")
+    return weights, np.where(hasNoise, noise, 0.)
+
+
+def get_phiArray(lambdaSqArray, weights, conf):
+    """
+    Returns the Faraday depths in rad/m^2 of `rmsynthPhiMax` and `rmsynthDPhi`.
+    Unset values are derived from the theoretical width of the RMSF,
+    2 sqrt(3) / (lambda^2_max - lambda^2_min), of the channels with data.
+    """
+    lambdaSqUsed = lambdaSqArray[weights > 0]
+    fwhmRMSF = 2 * np.sqrt(3) / (np.max(lambdaSqUsed) - np.min(lambdaSqUsed))
+    phiMax = float(conf.input.rmsynthPhiMax) or 10 * fwhmRMSF
+    dPhi = float(conf.input.rmsynthDPhi) or fwhmRMSF / 10
+    noOfSteps = int(np.ceil(phiMax / dPhi))
+    info(f"Theoretical RMSF FWHM: {fwhmRMSF:.3f} rad/m^2, Faraday depths: -{noOfSteps * dPhi:.3f} to {noOfSteps * dPhi:.3f} rad/m^2 in steps of {dPhi:.3f} rad/m^2")
+    return dPhi * np.arange(-noOfSteps, noOfSteps + 1, dtype=np.float64)
+
+
+def get_rmsynth_kernel(weights, lambdaSqArray, phiArray):
+    """
+    Returns the kernel [phi, chan] of the direct RM synthesis, the FDF of
+    pixels [pixel, chan] of complex polarisation is `pol @ kernel.T`.
+
+    F(phi) = sum_i w_i P_i exp(-2i phi (lambda^2_i - lambda^2_0)) / sum_i w_i,
+    with the weighted mean lambda^2_0 of the channels.
+    """
+    weightsSum = np.sum(weights)
+    lambdaSq0 = weights @ lambdaSqArray / weightsSum
+    return np.exp(-2j * np.outer(phiArray, lambdaSqArray - lambdaSq0)) * (weights / weightsSum)
+
+
+def get_fft_size(size):
+    """
+    Returns the smallest size >= `size` without prime factors above 5.
+    """
+    while True:
+        remainder = size
+        for factor in [2, 3, 5]:
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return size
+        size += 1
+
+
+def get_nufft_spread(tolerance, oversampling=NUFFT_OVERSAMPLING):
+    """
+    Returns the number of grid cells on each side of a channel that the
+    Gaussian gridding kernel covers for the relative error `tolerance`
+    (Greengard & Lee 2004, SIAM Review 46, 443).
+    """
+    return max(2, int(np.ceil(-np.log(tolerance) * (oversampling - 0.5) / (np.pi * (oversampling - 1)))))
+
+
+def get_nufft_plan(weights, lambdaSqArray, phiArray, tolerance):
+    """
+    Returns the plan of the NUFFT RM synthesis of the channels with
+    `lambdaSqArray`, the same transform as the kernel of `get_rmsynth_kernel`
+    on the equally spaced `phiArray`.
+
+    With phi_k = phi_c + k dphi the FDF is a non-uniform discrete Fourier
+    transform F_k = sum_i c_i exp(-i k theta_i) of the channel positions
+    theta_i = 2 dphi (lambda^2_i - lambda^2_0) mod 2 pi. The channels get
+    gridded with a Gaussian onto an oversampled regular grid, which is Fourier
+    transformed with an FFT and divided by the transform of the Gaussian. This
+    costs O(spread * chan + grid log(grid)) per pixel instead of O(phi * chan).
+    The error is below about `tolerance` times the weighted mean polarised
+    intensity sum_i w_i |P_i| / sum_i w_i of the pixel.
+    """
+    noOfPhi = len(phiArray)
+    noOfChan = len(lambdaSqArray)
+    dPhi = phiArray[1] - phiArray[0] if noOfPhi > 1 else 1.
+    # modes centred on phi_c, k = -noOfPhi // 2, ..., noOfPhi - noOfPhi // 2 - 1
+    phiCentre = phiArray[noOfPhi // 2]
+    modeArray = np.arange(noOfPhi) - noOfPhi // 2
+    weightsSum = np.sum(weights)
+    lambdaSq0 = weights @ lambdaSqArray / weightsSum
+    coeffArray = (weights / weightsSum) * np.exp(-2j * phiCentre * (lambdaSqArray - lambdaSq0))
+    thetaArray = np.mod(2 * dPhi * (lambdaSqArray - lambdaSq0), 2 * np.pi)
+
+    gridSize = get_fft_size(int(np.ceil(NUFFT_OVERSAMPLING * noOfPhi)))
+    oversampling = gridSize / noOfPhi
+    spread = get_nufft_spread(tolerance, oversampling)
+    # variance parameter of the Gaussian exp(-x^2 / (4 tau))
+    tau = np.pi * spread / (noOfPhi**2 * oversampling * (oversampling - 0.5))
+    cellSize = 2 * np.pi / gridSize
+    cellArray = np.floor(thetaArray / cellSize).astype(np.int64)[None, :] + np.arange(1 - spread, spread + 1)[:, None]
+    kernelValues = np.exp(-(thetaArray[None, :] - cellArray * cellSize)**2 / (4 * tau))
+    # sort the contributions [offset, chan] by grid cell, the channels that
+    # contribute to the same cell get summed with one `np.add.reduceat`
+    cellArray = np.mod(cellArray, gridSize).ravel()
+    order = np.argsort(cellArray, kind="stable")
+    sortedCells = cellArray[order]
+    startArray = np.flatnonzero(np.concatenate([[True], np.diff(sortedCells) != 0]))
+    chanIdxArray = order % noOfChan
+    plan = {
+        "chanIdx": chanIdxArray,
+        "values": kernelValues.ravel()[order] * coeffArray[chanIdxArray],
+        "starts": startArray,
+        "cells": sortedCells[startArray],
+        "gridSize": gridSize,
+        "fftIdx": np.mod(modeArray, gridSize),
+        "deconvolution": np.sqrt(np.pi / tau) * np.exp(modeArray**2 * tau) / gridSize,
+        }
+    # the channels cover a fraction of the grid, 2 dphi (lambda^2_max -
+    # lambda^2_min) of 2 pi, e.g. 11% with dphi of a tenth of the RMSF FWHM
+    if len(startArray) <= NUFFT_DENSE_GRIDDING_FACTOR * 2 * spread:
+        griddingMatrix = np.zeros((len(startArray), noOfChan), dtype=np.complex128)
+        cellIdxArray = np.repeat(np.arange(len(startArray)), np.diff(np.append(startArray, len(order))))
+        np.add.at(griddingMatrix, (cellIdxArray, chanIdxArray), plan["values"])
+        plan["griddingMatrix"] = griddingMatrix
+    return plan
+
+
+def get_fdf_nufft(pol, plan):
+    """
+    Returns the FDFs [pixel, phi] of the complex polarisation `pol`
+    [pixel, chan] with a plan of `get_nufft_plan`.
+    """
+    fdf = np.empty((pol.shape[0], len(plan["fftIdx"])), dtype=np.complex128)
+    pixelsPerChunk = max(1, NUFFT_CHUNK_SIZE // max(len(plan["values"]), plan["gridSize"]))
+    for start in range(0, pol.shape[0], pixelsPerChunk):
+        stop = min(pol.shape[0], start + pixelsPerChunk)
+        grid = np.zeros((stop - start, plan["gridSize"]), dtype=np.complex128)
+        if "griddingMatrix" in plan:
+            grid[:, plan["cells"]] = pol[start:stop] @ plan["griddingMatrix"].T
+        else:
+            grid[:, plan["cells"]] = np.add.reduceat(pol[start:stop, plan["chanIdx"]] * plan["values"], plan["starts"], axis=1)
+        fdf[start:stop] = np.fft.fft(grid, axis=1)[:, plan["fftIdx"]] * plan["deconvolution"]
+    return fdf
+
+
+def get_fdf(pol, kernel):
+    """
+    Returns the FDFs [pixel, phi] of the complex polarisation `pol`
+    [pixel, chan] with a kernel of `get_rmsynth_kernel` or a plan of
+    `get_nufft_plan`.
+    """
+    if isinstance(kernel, dict):
+        return get_fdf_nufft(pol, kernel)
+    return pol @ kernel.T
+
+
+def get_rmsf(weights, lambdaSqArray, phiArray):
+    """
+    Returns the Faraday depths of twice the range of `phiArray`, the RMSF and
+    its measured FWHM in rad/m^2.
+    """
+    dPhi = phiArray[1] - phiArray[0] if len(phiArray) > 1 else 1.
+    phi2Array = dPhi * np.arange(-(len(phiArray) - 1), len(phiArray), dtype=np.float64)
+    rmsf = get_rmsynth_kernel(weights, lambdaSqArray, phi2Array).sum(axis=1)
+    # half maximum of the main lobe, interpolated on both sides of the centre
+    absRmsf = np.abs(rmsf)
+    centreIdx = len(phi2Array) // 2
+    belowIdxArray = np.flatnonzero(absRmsf[centreIdx:] < 0.5)
+    if not len(belowIdxArray):
+        return phi2Array, rmsf, np.nan
+    idx = centreIdx + belowIdxArray[0]
+    halfWidth = phi2Array[idx - 1] + (absRmsf[idx - 1] - 0.5) / (absRmsf[idx - 1] - absRmsf[idx]) * dPhi
+    return phi2Array, rmsf, 2 * halfWidth
+
+
+def write_rmsf_file(phi2Array, rmsf, conf):
+    """
+    Writes the RMSF of the channels with data of all pixels.
+    """
+    filepathStatistics = conf.input.basename + conf.env.extCubeRmsynthRmsfStatistics
+    legendList = ["phi [rad/m^2]", "real", "imaginary", "absolute"]
+    info("Writing statistics file: %s", filepathStatistics)
+    with open(filepathStatistics, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [legendList]
+        for phi, value in zip(phi2Array, rmsf):
+            csvData.append([round(phi, 4), round(value.real, 6), round(value.imag, 6), round(abs(value), 6)])
+        writer.writerows(csvData)
+    write_stats_store(filepathStatistics, [
+        ["phi", "rad/m^2", phi2Array],
+        ["real", "", rmsf.real],
+        ["imaginary", "", rmsf.imag],
+        ["absolute", "", np.abs(rmsf)],
+        ])
+
+
+def get_kernelBytes(noOfChan, noOfPhi, kernelMethod="direct", tolerance=1e-6):
+    """
+    Returns the bytes of the kernel, or of the NUFFT plan, of one channel
+    pattern.
+    """
+    if kernelMethod == "nufft":
+        # channel and cell indices, gridding values, the largest gridding
+        # matrix and the deconvolution
+        spread = get_nufft_spread(tolerance)
+        return 2 * spread * noOfChan * (8 + 16 + 8 + NUFFT_DENSE_GRIDDING_FACTOR * 16) + noOfPhi * (8 + 8)
+    return noOfChan * noOfPhi * 16
+
+
+def get_kernelCacheSize(kernelBytes, memoryBudget, workers=1):
+    """
+    Returns the number of kernels a worker keeps, at most
+    `RMSYNTH_KERNEL_CACHE_SIZE` and a quarter of the budget of a worker.
+    """
+    return int(max(1, min(RMSYNTH_KERNEL_CACHE_SIZE, memoryBudget // max(1, workers) // 4 // kernelBytes)))
+
+
+def get_rowsPerTile(shapeCube, noOfPhi, memoryBudget, workers=1, reservedBytes=0):
+    """
+    Returns the number of image rows of a spatial tile.
+
+    The complex polarisation, the FDF and the output rows of a tile take at
+    most half of the budget of a worker without the `reservedBytes` of the
+    kernels, the channel blocks the other half. With more than one worker the
+    image gets split into at least one tile per worker.
+    """
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    # complex128 polarisation, its absolute value and mask per channel,
+    # complex128 FDF, its absolute value and three float32 output planes per phi
+    bytesPerRow = xdim * (noOfChan * (16 + 8 + 1) + noOfPhi * (16 + 8 + 12))
+    rowsPerTile = int((memoryBudget // max(1, workers) - reservedBytes) // 2 // bytesPerRow)
+    return max(1, min(rowsPerTile, int(np.ceil(ydim / max(1, workers)))))
+
+
+def get_channelsPerTileBlock(shapeCube, rowsPerTile, memoryBudget, workers=1, reservedBytes=0):
+    """
+    Returns the number of channels that get read at once for a tile of
+    `rowsPerTile` rows.
+    """
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    # block, read buffer and the float32 Stokes Q and U planes
+    bytesPerChannel = rowsPerTile * xdim * (noOfStokes * 4 + 4 + 8)
+    return int(max(1, min(noOfChan, (memoryBudget // max(1, workers) - reservedBytes) // 2 // bytesPerChannel)))
+
+
+# Per process state of the RM synthesis workers. Filled by
+# `init_rmsynth_worker` before the first tile gets processed.
+WORKER_STATE = {}
+
+
+def init_rmsynth_worker(cubeNameInput, outputNameDict, lambdaSqArray, weights, noise, phiArray, blockList, threshold, kernelMethod="direct", nufftTolerance=1e-6, kernelCacheSize=RMSYNTH_KERNEL_CACHE_SIZE):
+    """
+    Initialises a RM synthesis worker.
+
+    Each worker opens its own block reader of the cube and block writers of
+    the output cubes and only writes the rows of the tiles it gets assigned.
+    Therefore, no locking is necessary.
+
+    Parameters
+    ----------
+    outputNameDict: dict
+       Paths of the "peakPhi", "peakPI" and, if written, "fdf" cubes
+    weights: numpy.array
+       Weights of all channels, zero for channels without data
+    noise: numpy.array
+       Stokes V RMS noise in Jy/beam of all channels
+    blockList: list of lists
+       Blocks of consecutive channel numbers with a weight
+    threshold: float
+       Minimum peak polarised intensity in units of the noise of the FDF
+    kernelMethod: str
+       "direct" or "nufft", see `rmsynthKernel`
+    nufftTolerance: float
+       Relative error of the "nufft" kernel
+    kernelCacheSize: int
+       Number of kernels of different channel patterns the worker keeps
+    """
+    WORKER_STATE["blockReader"] = CubeBlockWriter(cubeNameInput, readOnly=True)
+    WORKER_STATE["writerDict"] = {key: CubeBlockWriter(filepath) for key, filepath in outputNameDict.items()}
+    WORKER_STATE["lambdaSqArray"] = lambdaSqArray
+    WORKER_STATE["weights"] = weights
+    WORKER_STATE["noise"] = noise
+    WORKER_STATE["phiArray"] = phiArray
+    WORKER_STATE["blockList"] = blockList
+    WORKER_STATE["threshold"] = threshold
+    WORKER_STATE["kernelMethod"] = kernelMethod
+    WORKER_STATE["nufftTolerance"] = nufftTolerance
+    WORKER_STATE["kernelCacheSize"] = kernelCacheSize
+    WORKER_STATE["kernelCache"] = {}
+
+
+def close_rmsynth_worker():
+    WORKER_STATE["blockReader"].close()
+    for blockWriter in WORKER_STATE["writerDict"].values():
+        blockWriter.close()
+    WORKER_STATE["kernelCache"] = {}
+
+
+def get_kernel_of_pattern(hasData):
+    """
+    Returns the channel indices and the kernel, or the NUFFT plan, of the
+    channels `hasData`. The kernels of the last channel patterns are kept,
+    usually all pixels of the cube share a few patterns.
+    """
+    kernelCache = WORKER_STATE["kernelCache"]
+    key = np.packbits(hasData).tobytes()
+    if key not in kernelCache:
+        if len(kernelCache) >= WORKER_STATE["kernelCacheSize"]:
+            kernelCache.pop(next(iter(kernelCache)))
+        chanIdxArray = np.flatnonzero(hasData)
+        kernelArgs = (WORKER_STATE["weights"][chanIdxArray], WORKER_STATE["lambdaSqArray"][chanIdxArray], WORKER_STATE["phiArray"])
+        if WORKER_STATE["kernelMethod"] == "nufft":
+            kernel = get_nufft_plan(*kernelArgs, WORKER_STATE["nufftTolerance"])
+        else:
+            kernel = get_rmsynth_kernel(*kernelArgs)
+        kernelCache[key] = (chanIdxArray, kernel)
+    return kernelCache[key]
+
+
+def read_pol_tile(yStart, yStop):
+    """
+    Returns the complex polarisation Q + iU [pixel, chan] of the rows `yStart`
+    to `yStop` and the mask of the values with data and weight.
+    """
+    blockReader = WORKER_STATE["blockReader"]
+    noOfPixels = (yStop - yStart) * blockReader.shape[-1]
+    pol = np.zeros((noOfPixels, blockReader.shape[1]), dtype=np.complex128)
+    hasData = np.zeros(pol.shape, dtype=bool)
+    for block in WORKER_STATE["blockList"]:
+        chanSlice = slice(block[0] - 1, block[-1])
+        rows = blockReader.read_rows(block[0] - 1, len(block), yStart, yStop)
+        stokesQ = rows[1].reshape(len(block), -1).T
+        stokesU = rows[2].reshape(len(block), -1).T
+        pol[:, chanSlice].real = stokesQ
+        pol[:, chanSlice].imag = stokesU
+        hasData[:, chanSlice] = np.isfinite(stokesQ) & np.isfinite(stokesU)
+        blockReader.flush()
+    pol[~hasData] = 0
+    return pol, hasData
+
+
+def get_peaks(absFdf, phiArray):
+    """
+    Returns the Faraday depth and the polarised intensity of the peaks of the
+    FDFs [pixel, phi], refined by a parabola through the three highest samples.
+    """
+    peakIdx = np.argmax(absFdf, axis=1)
+    pixelIdx = np.arange(absFdf.shape[0])
+    innerIdx = np.clip(peakIdx, 1, max(1, absFdf.shape[1] - 2))
+    if absFdf.shape[1] < 3:
+        return phiArray[peakIdx], absFdf[pixelIdx, peakIdx]
+    left, centre, right = absFdf[pixelIdx, innerIdx - 1], absFdf[pixelIdx, innerIdx], absFdf[pixelIdx, innerIdx + 1]
+    curvature = left - 2 * centre + right
+    isInner = (peakIdx == innerIdx) & (curvature < 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        offset = np.where(isInner, 0.5 * (left - right) / curvature, 0.)
+    peakPhi = phiArray[peakIdx] + offset * (phiArray[1] - phiArray[0])
+    peakPI = np.where(isInner, centre - 0.25 * (left - right) * offset, absFdf[pixelIdx, peakIdx])
+    return peakPhi, peakPI
+
+
+def process_tile(tile):
+    """
+    Computes the FDFs of the rows `yStart` to `yStop` and writes the peaks and
+    the FDFs of the pixels above the threshold into the output cubes. The
+    pixels are grouped by their channels with data, every group is one matrix
+    product with the kernel of its channels or one NUFFT with its plan.
+
+    Returns
+    -------
+    peakRSS: int
+       Peak RSS of the worker in bytes
+    noOfSynthesised: int
+       Number of pixels with data
+    noOfDetected: int
+       Number of pixels above the threshold
+    """
+    yStart, yStop = tile
+    weights = WORKER_STATE["weights"]
+    phiArray = WORKER_STATE["phiArray"]
+    xdim = WORKER_STATE["blockReader"].shape[-1]
+    pol, hasData = read_pol_tile(yStart, yStop)
+
+    # the theoretical noise of the FDF, sqrt(sum_i w_i^2 sigma_i^2) / sum_i w_i
+    weightsSum = hasData @ weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        noiseFdf = np.sqrt(hasData @ (weights * WORKER_STATE["noise"])**2) / weightsSum
+    dataPixelIdx = np.flatnonzero(weightsSum > 0)
+
+    peakPhi = np.full(pol.shape[0], np.nan, dtype=np.float32)
+    peakPI = np.full(pol.shape[0], np.nan, dtype=np.float32)
+    fdfTile = np.full((3, len(phiArray), pol.shape[0]), np.nan, dtype=np.float32) if "fdf" in WORKER_STATE["writerDict"] else None
+    noOfDetected = 0
+    if len(dataPixelIdx):
+        patterns, patternIdx = np.unique(np.packbits(hasData[dataPixelIdx], axis=1), axis=0, return_inverse=True)
+        patternIdx = patternIdx.ravel()
+        for ii in range(len(patterns)):
+            pixelIdx = dataPixelIdx[patternIdx == ii]
+            chanIdxArray, kernel = get_kernel_of_pattern(hasData[pixelIdx[0]])
+            fdf = get_fdf(pol[np.ix_(pixelIdx, chanIdxArray)], kernel)
+            absFdf = np.abs(fdf)
+            pixelPeakPhi, pixelPeakPI = get_peaks(absFdf, phiArray)
+            isDetected = pixelPeakPI >= WORKER_STATE["threshold"] * noiseFdf[pixelIdx]
+            pixelIdx = pixelIdx[isDetected]
+            noOfDetected += len(pixelIdx)
+            peakPhi[pixelIdx] = pixelPeakPhi[isDetected]
+            peakPI[pixelIdx] = pixelPeakPI[isDetected]
+            if fdfTile is not None:
+                fdfTile[0][:, pixelIdx] = fdf[isDetected].real.T
+                fdfTile[1][:, pixelIdx] = fdf[isDetected].imag.T
+                fdfTile[2][:, pixelIdx] = absFdf[isDetected].T
+
+    writerDict = WORKER_STATE["writerDict"]
+    rowsShape = (yStop - yStart, xdim)
+    writerDict["peakPhi"].write_rows(0, yStart, peakPhi.reshape((1, 1) + rowsShape))
+    writerDict["peakPI"].write_rows(0, yStart, peakPI.reshape((1, 1) + rowsShape))
+    if fdfTile is not None:
+        writerDict["fdf"].write_rows(0, yStart, fdfTile.reshape((3, len(phiArray)) + rowsShape))
+    for blockWriter in writerDict.values():
+        blockWriter.flush()
+    return get_peak_rss(), len(dataPixelIdx), noOfDetected
+
+
+def process_all_tiles(tileList, initargs, conf):
+    """
+    Processes all tiles with `rmsynthWorkers` processes.
+    """
+    workers = max(1, int(conf.input.rmsynthWorkers))
+    if workers == 1:
+        init_rmsynth_worker(*initargs)
+        resultList = list(map(process_tile, tileList))
+        close_rmsynth_worker()
+    else:
+        info(f"Processing RM synthesis with {workers} worker processes.")
+        # fork: the arrays are handed over to the workers without pickling
+        with multiprocessing.get_context("fork").Pool(processes=workers, initializer=init_rmsynth_worker, initargs=initargs) as pool:
+            resultList = list(pool.imap_unordered(process_tile, tileList))
+    peakRSS = max(result[0] for result in resultList)
+    info(f"Peak RSS of a RM synthesis process: {peakRSS / 1024**3:.2f} GB")
+    info(f"RM synthesis of {sum(result[1] for result in resultList)} pixels, {sum(result[2] for result in resultList)} above {conf.input.rmsynthThreshold} times the noise of the FDF.")
+
+
+def get_outputNameDict(conf):
+    """
+    Returns the paths of the output cubes.
+    """
+    outputNameDict = {
+        "peakPhi": os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeRmsynthPeakPhiFits),
+        "peakPI": os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeRmsynthPeakPIFits),
+        }
+    if conf.input.rmsynthWriteFdf:
+        outputNameDict["fdf"] = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeRmsynthFdfFits)
+    return outputNameDict
+
+
+def make_empty_images(header, outputNameDict, phiArray, lambdaSq0, fwhmRMSF):
+    """
+    Generates the empty output cubes with the spatial axes of the input cube.
+    The FDF cube has the Faraday depth as third axis and the real part,
+    imaginary part and absolute value of the FDF on the fourth axis.
+    """
+    xdim = int(header["NAXIS1"])
+    ydim = int(header["NAXIS2"])
+    rmsynthHeaderDict = {
+        "RMSFFWHM": (fwhmRMSF, "RMSF FWHM [rad/m^2]"),
+        "LAMSQ0": (lambdaSq0, "Weighted mean lambda^2 [m^2]"),
+        }
+    for key, bunit in [["peakPhi", "rad/m^2"], ["peakPI", header.get("BUNIT", "Jy/beam")]]:
+        info(f"Generating empty cube: {outputNameDict[key]}")
+        write_empty_cube(header, outputNameDict[key], (xdim, ydim, 1, 1))
+        update_fits_header_of_cube(outputNameDict[key], {"BUNIT": bunit, **rmsynthHeaderDict})
+    if "fdf" in outputNameDict:
+        fdfBytes = 3 * len(phiArray) * ydim * xdim * np.dtype(np.float32).itemsize
+        warning(f"Writing the FDF cube of {len(phiArray)} Faraday depths needs {fdfBytes / 1024**3:.1f} GB of disk space, disable it with rmsynthWriteFdf = False.")
+        info(f"Generating empty cube with {len(phiArray)} Faraday depths: {outputNameDict['fdf']}")
+        write_empty_cube(header, outputNameDict["fdf"], (xdim, ydim, len(phiArray), 3))
+        update_fits_header_of_cube(outputNameDict["fdf"], {
+            "CTYPE3": "FDEP",
+            "CRPIX3": 1,
+            "CRVAL3": phiArray[0],
+            "CDELT3": phiArray[1] - phiArray[0] if len(phiArray) > 1 else 1.,
+            "CUNIT3": "rad/m^2",
+            "CTYPE4": ("FDFPART", "1: real, 2: imaginary, 3: absolute"),
+            "CRPIX4": 1,
+            "CRVAL4": 1,
+            "CDELT4": 1,
+            **rmsynthHeaderDict,
+            })
+
+
+def run_rmsynth_on_cube(conf):
+    """
+    Runs RM synthesis on all pixels of the smoothed cube, or of the cube
+    without `smoothbeam`, in spatial tiles of full image rows. Every tile
+    reads its rows of all channels once. The kernel of the channels with data
+    is computed once per channel pattern and shared by all pixels with that
+    pattern, the FDFs are the matrix product of the kernel and the Stokes Q
+    and U spectra of these pixels.
+    """
+    cubeNameInput, mode = get_cubeNameInput_and_mode(conf)
+    info(SEPERATOR)
+    info(f"Opening data cube: {cubeNameInput}")
+    header = fits.getheader(cubeNameInput)
+    blockReader = CubeBlockWriter(cubeNameInput, readOnly=True)
+    shapeCube = blockReader.shape
+    weights, noise = get_weights_and_noise(blockReader, conf, mode=mode)
+    blockReader.close()
+    if not np.any(weights > 0):
+        error("No channels with data and RMS noise, skipping RM synthesis.")
+        return
+
+    lambdaSqArray = get_lambdaSqArray_from_header(header)
+    phiArray = get_phiArray(lambdaSqArray, weights, conf)
+    phi2Array, rmsf, fwhmRMSF = get_rmsf(weights, lambdaSqArray, phiArray)
+    lambdaSq0 = weights @ lambdaSqArray / np.sum(weights)
+    info(f"Measured RMSF FWHM: {fwhmRMSF:.3f} rad/m^2, weighted mean lambda^2: {lambdaSq0:.6f} m^2")
+    write_rmsf_file(phi2Array, rmsf, conf)
+
+    outputNameDict = get_outputNameDict(conf)
+    make_empty_images(header, outputNameDict, phiArray, lambdaSq0, fwhmRMSF)
+
+    kernelMethod = conf.input.rmsynthKernel
+    if kernelMethod not in ["direct", "nufft"]:
+        error(f"Unknown rmsynthKernel: {kernelMethod}")
+        raise ValueError(f"Unknown rmsynthKernel: {kernelMethod}")
+    nufftTolerance = float(conf.input.rmsynthNufftTolerance)
+    if kernelMethod == "nufft":
+        info(f"NUFFT kernel with tolerance {nufftTolerance}: gridding over {2 * get_nufft_spread(nufftTolerance)} cells per channel.")
+    memoryBudget = float(conf.input.cubeMemoryBudget) * 1024**3
+    workers = max(1, int(conf.input.rmsynthWorkers))
+    kernelBytes = get_kernelBytes(shapeCube[1], len(phiArray), kernelMethod, nufftTolerance)
+    kernelCacheSize = get_kernelCacheSize(kernelBytes, memoryBudget, workers)
+    rowsPerTile = get_rowsPerTile(shapeCube, len(phiArray), memoryBudget, workers, kernelCacheSize * kernelBytes)
+    channelsPerBlock = get_channelsPerTileBlock(shapeCube, rowsPerTile, memoryBudget, workers, kernelCacheSize * kernelBytes)
+    tileList = [(yStart, min(shapeCube[-2], yStart + rowsPerTile)) for yStart in range(0, shapeCube[-2], rowsPerTile)]
+    blockList = get_channelBlockList([ii + 1 for ii in np.flatnonzero(weights > 0)], channelsPerBlock)
+    info(f"Processing RM synthesis: {len(tileList)} tiles of up to {rowsPerTile} rows, {len(blockList)} blocks of up to {channelsPerBlock} channels.")
+    initargs = (cubeNameInput, outputNameDict, lambdaSqArray, weights, noise, phiArray, blockList, float(conf.input.rmsynthThreshold), kernelMethod, nufftTolerance, kernelCacheSize)
+    process_all_tiles(tileList, initargs, conf)
+
+
+@main_timer
+def main():
+    conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+    run_rmsynth_on_cube(conf)
+
+
+if __name__ == "__main__":
+    main()
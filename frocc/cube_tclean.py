@@ -25,7 +25,8 @@ import click
 import casatasks 
 
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
-from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, get_firstFreq, SEPERATOR, SEPERATOR_HEAVY
+from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, get_firstFreq, get_chanNoList_from_directory, SEPERATOR, SEPERATOR_HEAVY
+from frocc.smoothing import smooth_after_imaging
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
@@ -115,18 +116,14 @@ def call_tclean(channelInputMS, channelNumber, conf):
     outImageFits = outImageName + ".fits"
     info(f"Exporting: {outImageFits}")
     casatasks.exportfits(imagename=outImageName, fitsimage=outImageFits, overwrite=True)
+    if conf.input.smoothbeam and conf.input.smoothInImaging:
+        smooth_after_imaging([outImageFits], conf)
 
 
 def get_channelNumber_from_slurmArrayTaskId(slurmArrayTaskId, conf):
     '''
     '''
-    channelNoList = []
-    listing = glob(f"{conf.env.dirVis}/*{conf.env.markerChannel}*")
-    for filepath in listing:
-        # TODO: make this more generic, be carful with hard code 3 digits
-        startIndex = filepath.find(conf.env.markerChannel) + len(conf.env.markerChannel)
-        channelNoList.append(filepath[startIndex:startIndex+3])
-    channelNoList = sorted(list(set(channelNoList)))
+    channelNoList = get_chanNoList_from_directory(conf.env.dirVis, conf.env.markerChannel)
 
     return channelNoList[int(slurmArrayTaskId)-1]
 
@@ -0,0 +1,125 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ This script writes a spectral-major copy of the data cube. The fits cube is
+ stored as [Stokes, chan, y, x], so the spectrum of a pixel is spread across
+ the whole file. The copy is a numpy `.npy` file with the axes
+ [Stokes, y, x, chan], in which every spectrum is a contiguous read.
+ The transpose is done out-of-core in blocks of image rows, the memory used is
+ bounded by `transposeMemoryBudget`.
+
+------------------------------------------------------------------------------
+
+ Developed at: IDIA (Institure for Data Intensive Astronomy), Cape Town, ZA
+
+------------------------------------------------------------------------------
+"""
+
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from frocc.lhelpers import get_config_in_dot_notation, main_timer, SEPERATOR, get_memmap_of_cube, read_channel_mask
+from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
+from frocc.logger import *
+
+
+def get_filepathSpectralMajor(conf, mode="normal"):
+    """
+    Returns the path of the spectral-major copy of the normal or smoothed cube.
+    """
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedSpectralMajorNpy)
+    else:
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSpectralMajorNpy)
+
+
+def get_rowsPerBlock(shapeCube, memoryBudget):
+    """
+    Returns the number of image rows that get transposed at once.
+
+    A block of all channels is held twice, once as read from the cube and once
+    transposed.
+
+    Parameters
+    ----------
+    shapeCube: tuple
+       Shape of the cube [Stokes, chan, y, x]
+    memoryBudget: float
+       Memory budget in bytes
+
+    Returns
+    -------
+    rowsPerBlock: int
+    """
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    bytesPerRow = 2 * noOfChan * xdim * np.dtype(np.float32).itemsize
+    return int(max(1, min(ydim, memoryBudget // bytesPerRow)))
+
+
+def transpose_cube(filepathCube, filepathSpectralMajor, memoryBudget, maskedChanNoSet=()):
+    """
+    Writes a spectral-major copy [Stokes, y, x, chan] of a fits data cube.
+
+    Reading a block of rows gives one contiguous read per channel, writing the
+    transposed block is a single contiguous write. Channels in `maskedChanNoSet`
+    are written as NaN.
+
+    Parameters
+    ----------
+    filepathCube: str
+       Fits data cube with the axes [Stokes, chan, y, x]
+    filepathSpectralMajor: str
+       Output `.npy` file
+    memoryBudget: float
+       Memory budget in bytes
+    maskedChanNoSet: set
+       Channel numbers flagged in the channel mask of the cube
+    """
+    dataCube = get_memmap_of_cube(filepathCube, mode="r")
+    noOfStokes, noOfChan, ydim, xdim = dataCube.shape
+    info(f"Writing spectral-major cube with shape {(noOfStokes, ydim, xdim, noOfChan)}: {filepathSpectralMajor}")
+    spectralMajorCube = open_memmap(filepathSpectralMajor, mode="w+", dtype=np.float32, shape=(noOfStokes, ydim, xdim, noOfChan))
+
+    rowsPerBlock = get_rowsPerBlock(dataCube.shape, memoryBudget)
+    maskedChanIdxList = sorted(int(chanNo) - 1 for chanNo in maskedChanNoSet if 0 < int(chanNo) <= noOfChan)
+    info(f"Transposing blocks of {rowsPerBlock} rows.")
+    for stokesIdx in range(noOfStokes):
+        for yStart in range(0, ydim, rowsPerBlock):
+            yStop = min(ydim, yStart + rowsPerBlock)
+            info(f"Transposing Stokes index {stokesIdx}, rows {yStart} to {yStop - 1}")
+            block = np.array(dataCube[stokesIdx, :, yStart:yStop, :], dtype=np.float32)
+            block[maskedChanIdxList] = np.nan
+            spectralMajorCube[stokesIdx, yStart:yStop, :, :] = np.moveaxis(block, 0, -1)
+    spectralMajorCube.flush()
+    del spectralMajorCube
+
+
+def get_maskedChanNoSet(filepathCube, conf):
+    """
+    Returns the channel numbers flagged in the channel mask of the cube.
+    """
+    channelMask = read_channel_mask(filepathCube, conf)
+    if not channelMask or conf.input.ignoreStokesVFlagging:
+        return set()
+    return channelMask["flagged"] | channelMask["blanked"]
+
+
+@main_timer
+def main():
+    conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+    memoryBudget = float(conf.input.transposeMemoryBudget) * 1024**3
+    info(SEPERATOR)
+    filepathCube = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+    transpose_cube(filepathCube, get_filepathSpectralMajor(conf, mode="normal"), memoryBudget, get_maskedChanNoSet(filepathCube, conf))
+    filepathCube = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    if os.path.exists(filepathCube):
+        info(SEPERATOR)
+        transpose_cube(filepathCube, get_filepathSpectralMajor(conf, mode="smoothed"), memoryBudget, get_maskedChanNoSet(filepathCube, conf))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,6 @@ import sys
 import logging
 import datetime
 import os
-from glob import glob
 from logging import info, error
 import subprocess as sp
 from radio_beam import Beam, Beams
@@ -39,8 +38,10 @@ from frocc.lhelpers import (
     get_lastFreq,
     SEPERATOR,
     SEPERATOR_HEAVY,
-    get_chanNumbers
+    get_chanNumbers,
+    get_chanNoList_from_directory,
 )
+from frocc.smoothing import smooth_after_imaging
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
@@ -839,6 +840,7 @@ def call_wsclean(inputMS, conf, use_mpi=False):
     stokes = conf.input.stokes
     nchan = conf.input.nchan
 
+    casanameList = []
     for c in range(nchan):
         stack = {}
         for s in stokes:
@@ -854,18 +856,15 @@ def call_wsclean(inputMS, conf, use_mpi=False):
         casaname = f"{prefix}.chan{c+1:03d}.image.fits"
         info(f"Writing casa-compatible fits file: {casaname}")
         fits.writeto(casaname, data, head, overwrite=True)
+        casanameList.append(casaname)
+    if conf.input.smoothbeam and conf.input.smoothInImaging:
+        smooth_after_imaging(casanameList, conf)
 
 
 def get_channelNumber_from_slurmArrayTaskId(slurmArrayTaskId, conf):
     """
     """
-    channelNoList = []
-    listing = glob(f"{conf.env.dirVis}/*{conf.env.markerChannel}*")
-    for filepath in listing:
-        # TODO: make this more generic, be carful with hard code 3 digits
-        startIndex = filepath.find(conf.env.markerChannel) + len(conf.env.markerChannel)
-        channelNoList.append(filepath[startIndex : startIndex + 3])
-    channelNoList = sorted(list(set(channelNoList)))
+    channelNoList = get_chanNoList_from_directory(conf.env.dirVis, conf.env.markerChannel)
 
     return channelNoList[int(slurmArrayTaskId) - 1]
 
@@ -8,6 +8,8 @@ import datetime
 import os
 import ast
 import functools
+import json
+import re
 import numpy as np
 from numpy import nan
 import inspect
@@ -31,6 +33,15 @@ SEPERATOR_HEAVY = "="*79
 SEPERATOR_SOFT = "- " * 79
 SEPERATOR_SOFT = SEPERATOR_SOFT[:80]
 
+# approximate robust statistics, see `get_std_via_mad`
+ROBUST_STATS_SUBSAMPLE_SIZE = 2**18
+ROBUST_STATS_HISTOGRAM_BINS = 4096
+ROBUST_STATS_HISTOGRAM_RANGE = 5
+
+# FFT smoothing: peak bytes per pixel of a channel image while one channel gets
+# smoothed, the smoothed Stokes planes and the padded FFT buffers of a plane
+SMOOTHING_BYTES_PER_PIXEL = 96
+
 os.environ['LC_ALL'] = "C.UTF-8"
 os.environ['LANG'] = "C.UTF-8"
 
@@ -110,22 +121,151 @@ def get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, config
                 setattr(getattr(dot, section), key, str(value))
     return dot
 
+def get_channelNumber_match(filename, marker):
+    '''
+    Returns the regex match of the channel number following the last `marker`
+    in the basename of `filename`, or None.
+    '''
+    matchList = list(re.finditer(re.escape(marker) + r"(\d+)", os.path.basename(filename)))
+    return matchList[-1] if matchList else None
+
 def get_channelNumber_from_filename(filename, marker, digits=3):
     '''
-    TODO: digits=3 -> len(marker)
+    Returns the channel number following `marker`, zero padded to `digits`.
     '''
-    markerChannelPositionEnd = int(filename.find(marker)) + len(marker)
-    chanNo = filename[markerChannelPositionEnd:markerChannelPositionEnd+digits]
-    return chanNo.zfill(digits)
+    match = get_channelNumber_match(filename, marker)
+    if not match:
+        return ""
+    return match.group(1).zfill(digits)
 
 def change_channelNumber_from_filename(filename, marker, newChanNo, digits=3):
     '''
-    TODO: digits=3 -> len(marker)
+    Replaces the channel number following `marker` in the basename of `filename`.
+    '''
+    match = get_channelNumber_match(filename, marker)
+    if not match:
+        return filename
+    dirname, basename = os.path.split(filename)
+    basename = basename[:match.start(1)] + str(newChanNo).zfill(digits) + basename[match.end(1):]
+    return os.path.join(dirname, basename)
+
+def get_chanNoList_from_directory(directory, marker):
+    '''
+    Returns the sorted channel numbers (zero padded strings) of all files in
+    `directory` holding `marker`, with a single directory scan.
+    '''
+    chanNoSet = set()
+    with os.scandir(directory) as entryIterator:
+        for entry in entryIterator:
+            chanNo = get_channelNumber_from_filename(entry.name, marker)
+            if chanNo:
+                chanNoSet.add(chanNo)
+    return sorted(chanNoSet, key=int)
+
+def get_filepathChannelIndex(conf):
+    '''
+    Returns the path of the channel image index in `env.dirImages`.
+    '''
+    return os.path.join(conf.env.dirImages, conf.input.basename + conf.env.extChannelIndex)
+
+def get_channel_index_entry(filepath, chanNo, kind, size, mtime):
+    '''
+    Reads the header of a channel image into an index entry. Returns None if the
+    image can't be read, e.g. because it is still being written.
+    '''
+    try:
+        header = fits.getheader(filepath)
+        beam = [header["BMAJ"], header["BMIN"], header["BPA"]] if "BMAJ" in header else None
+        return {
+            "chanNo": chanNo,
+            "kind": kind,
+            "path": filepath,
+            "frequency": header.get("CRVAL3"),
+            "beam": beam,
+            "shape": [header[f"NAXIS{i}"] for i in range(int(header["NAXIS"]), 0, -1)],
+            "size": size,
+            "mtime": mtime,
+        }
+    except Exception:
+        return None
+
+def get_channel_index(conf):
+    '''
+    Returns the index of all channel images in `env.dirImages`.
+
+    The index is a dict from file name to channel number, kind ("image" or
+    "smoothed"), path, frequency, beam [BMAJ, BMIN, BPA] in deg, shape, size
+    and mtime. It is updated incrementally with one `os.scandir`: headers are
+    only read for new or changed files. The index file gets rewritten if
+    something changed.
+    '''
+    filepathIndex = get_filepathChannelIndex(conf)
+    try:
+        with open(filepathIndex) as f:
+            oldIndex = json.load(f)
+    except (OSError, ValueError):
+        oldIndex = {}
+    suffixDict = {conf.env.extTcleanImage: "image", conf.env.extTcleanImageSmoothed: "smoothed"}
+    pattern = re.compile(re.escape(conf.env.markerChannel) + r"(\d+)(" + "|".join(re.escape(ext) for ext in suffixDict) + r")$")
+    index = {}
+    changed = False
+    with os.scandir(conf.env.dirImages) as entryIterator:
+        for entry in entryIterator:
+            match = pattern.search(entry.name)
+            if not match or not entry.is_file():
+                continue
+            fileStat = entry.stat()
+            oldEntry = oldIndex.get(entry.name)
+            if oldEntry and oldEntry["size"] == fileStat.st_size and oldEntry["mtime"] == fileStat.st_mtime:
+                index[entry.name] = oldEntry
+                continue
+            newEntry = get_channel_index_entry(os.path.join(conf.env.dirImages, entry.name), int(match.group(1)), suffixDict[match.group(2)], fileStat.st_size, fileStat.st_mtime)
+            if newEntry:
+                index[entry.name] = newEntry
+                changed = True
+    if changed or len(index) != len(oldIndex):
+        filepathTmp = f"{filepathIndex}.{os.getpid()}.tmp"
+        with open(filepathTmp, "w") as f:
+            json.dump(index, f)
+        os.replace(filepathTmp, filepathIndex)
+    return index
+
+def get_channelFitsfileList_from_index(index, kind="image"):
+    '''
+    Returns the paths of all channel images of `kind`, sorted by channel number.
     '''
-    markerChannelPositionEnd = int(filename.find(marker)) + len(marker)
-    chanNo = filename[markerChannelPositionEnd:markerChannelPositionEnd+digits]
-    newFilename = filename.replace(marker+str(chanNo).zfill(digits), marker+str(newChanNo).zfill(digits))
-    return newFilename
+    return [entry["path"] for entry in sorted(index.values(), key=lambda entry: entry["chanNo"]) if entry["kind"] == kind]
+
+def get_filepathChannelMask(filepathCube, conf):
+    '''
+    Returns the path of the channel mask sidecar of a cube.
+    '''
+    return filepathCube + conf.env.extChannelMask
+
+def read_channel_mask(filepathCube, conf):
+    '''
+    Returns the channel mask of a cube as dict with the sets "flagged", the
+    channel numbers flagged by the IOR flagging, and "blanked", the channel
+    numbers of these that are blanked in the cube. Returns None if the cube has
+    no channel mask.
+    '''
+    try:
+        with open(get_filepathChannelMask(filepathCube, conf)) as f:
+            mask = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {"flagged": set(mask["flagged"]), "blanked": set(mask["blanked"])}
+
+def write_channel_mask(filepathCube, conf, flaggedChanNoList, blankedChanNoList):
+    '''
+    Writes the channel mask sidecar of a cube, see `read_channel_mask`.
+    '''
+    filepathMask = get_filepathChannelMask(filepathCube, conf)
+    info(f"Writing channel mask: {filepathMask}")
+    filepathTmp = f"{filepathMask}.{os.getpid()}.tmp"
+    with open(filepathTmp, "w") as f:
+        json.dump({"flagged": sorted(int(chanNo) for chanNo in flaggedChanNoList), "blanked": sorted(int(chanNo) for chanNo in blankedChanNoList)}, f)
+    os.replace(filepathTmp, filepathMask)
 
 def main_timer(func):
     '''
@@ -196,7 +336,81 @@ def get_mad(a, axis=None):
     return mad
 
 
-def get_std_via_mad(npArray, axis=None):
+def get_flat_subsample(npArray, size=ROBUST_STATS_SUBSAMPLE_SIZE):
+    """
+    Returns an evenly strided subsample of at most `size` elements.
+    """
+    flatArray = np.ravel(npArray)
+    step = max(1, flatArray.size // size)
+    return flatArray[::step]
+
+
+def get_mad_via_subsample(a):
+    """
+    Compute *Median Absolute Deviation* from an evenly strided pixel subsample.
+
+    For Gaussian noise the relative standard error of the resulting standard
+    deviation is about 1.17/sqrt(n) with n = `ROBUST_STATS_SUBSAMPLE_SIZE`,
+    which is 0.23% for the default of 2**18 pixels.
+
+    """
+    return get_mad(get_flat_subsample(a))
+
+
+def get_mad_via_histogram(a):
+    """
+    Compute *Median Absolute Deviation* from a histogram of the array.
+
+    The histogram covers +-`ROBUST_STATS_HISTOGRAM_RANGE` standard deviations
+    around the median of a pixel subsample. Median and MAD are read from the
+    linearly interpolated cumulative histogram, so both are accurate to one bin
+    width. With the defaults the resulting standard deviation has a relative
+    error below 1.4826 * 2 * 5 / 4096 = 0.4%. If median or MAD fall outside of
+    the histogram, the exact MAD is returned.
+
+    Parameters
+    ----------
+    a: numpy.array
+       The numpy array of which MAD gets calculated from
+
+    Returns
+    -------
+    mad: float
+       MAD from a
+
+    """
+    flatArray = np.ravel(a)
+    noOfValues = flatArray.size - np.count_nonzero(np.isnan(flatArray))
+    if noOfValues == 0:
+        return np.nan
+    subsample = get_flat_subsample(flatArray)
+    subsampleMedian = np.nanmedian(subsample)
+    subsampleMad = np.nanmedian(np.absolute(subsample - subsampleMedian))
+    if not subsampleMad > 0:
+        return get_mad(flatArray)
+
+    halfWidth = ROBUST_STATS_HISTOGRAM_RANGE * 1.4826 * subsampleMad
+    lowerEdge = subsampleMedian - halfWidth
+    upperEdge = subsampleMedian + halfWidth
+    hist, edges = np.histogram(flatArray, bins=ROBUST_STATS_HISTOGRAM_BINS, range=(lowerEdge, upperEdge))
+    # cumulative counts at the bin edges, including the values below the range
+    cumulativeCounts = np.concatenate(([np.count_nonzero(flatArray < lowerEdge)], hist)).cumsum()
+    halfCount = noOfValues / 2
+    if not cumulativeCounts[0] < halfCount <= cumulativeCounts[-1]:
+        return get_mad(flatArray)
+    med = np.interp(halfCount, cumulativeCounts, edges)
+
+    # count of |a - med| <= r for radii in steps of the bin width
+    radii = np.arange(0, ROBUST_STATS_HISTOGRAM_BINS + 1) * (edges[1] - edges[0])
+    countsWithinRadius = np.interp(med + radii, edges, cumulativeCounts) - np.interp(med - radii, edges, cumulativeCounts)
+    idx = np.searchsorted(countsWithinRadius, halfCount)
+    if idx == 0 or idx >= len(radii) or med + radii[idx] > upperEdge or med - radii[idx] < lowerEdge:
+        return get_mad(flatArray)
+    mad = np.interp(halfCount, countsWithinRadius[idx - 1:idx + 1], radii[idx - 1:idx + 1])
+    return mad
+
+
+def get_std_via_mad(npArray, axis=None, method="exact"):
     """
     Estimate standard deviation via Median Absolute Deviation.
 
@@ -205,6 +419,10 @@ def get_std_via_mad(npArray, axis=None):
     ----------
     npArray: numpy.array
        The numpy array of which the Standard Deviation gets calculated from
+    method: str
+       "exact", "subsample" or "histogram". The approximations only apply to
+       `axis=None`, see `get_mad_via_subsample` and `get_mad_via_histogram`
+       for their error bounds.
 
     Returns
     -------
@@ -212,7 +430,12 @@ def get_std_via_mad(npArray, axis=None):
        Standard Deviation from MAD
 
     """
-    mad = get_mad(npArray, axis=axis)
+    if axis is None and method == "subsample":
+        mad = get_mad_via_subsample(npArray)
+    elif axis is None and method == "histogram":
+        mad = get_mad_via_histogram(npArray)
+    else:
+        mad = get_mad(npArray, axis=axis)
     std = 1.4826 * mad
     return std
 
@@ -312,6 +535,546 @@ def update_fits_header_of_cube(filepathCube, headerDict):
             header[key] = value
 
 
+def get_memmap_of_cube(filepathCube, mode="r+"):
+    '''
+    Returns a numpy memmap of the primary data section of a fits file.
+
+    The memmap bypasses astropy's data handling. This allows several processes
+    to open the same pre-allocated cube at once and write into disjoint
+    channel slices. The fits data is expected to be unscaled floating point
+    (no BSCALE/BZERO), which is the case for all cubes written by frocc.
+
+    Parameters
+    ----------
+    filepathCube: str
+       Path to the fits file
+    mode: str
+       numpy.memmap mode, "r" for read-only or "r+" for read and write
+
+    Returns
+    -------
+    dataCube: numpy.memmap
+       Data of the fits file in numpy axis order, e.g. [Stokes, chan, y, x]
+    '''
+    with fits.open(filepathCube, memmap=True, ignore_missing_end=True) as hud:
+        header = hud[0].header
+        dataOffset = hud.fileinfo(0)['datLoc']
+    shape = tuple(int(header[f"NAXIS{i}"]) for i in range(int(header["NAXIS"]), 0, -1))
+    dtype = np.dtype(f">f{abs(int(header['BITPIX'])) // 8}")
+    return np.memmap(filepathCube, dtype=dtype, mode=mode, offset=dataOffset, shape=shape)
+
+
+def get_peak_rss():
+    '''
+    Returns the peak resident set size of this process in bytes.
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return np.nan
+
+
+def get_channelsPerBlock(shapeCube, memoryBudget, workers=1, copies=3):
+    '''
+    Returns the number of channels that get written as one block.
+
+    Parameters
+    ----------
+    shapeCube: tuple
+       Shape of the cube [Stokes, chan, y, x]
+    memoryBudget: float
+       Memory budget of the whole job in bytes
+    workers: int
+       Number of processes sharing the budget
+    copies: int
+       Number of block sized buffers each process holds at once
+
+    Returns
+    -------
+    channelsPerBlock: int
+    '''
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    bytesPerChannel = copies * noOfStokes * ydim * xdim * np.dtype(np.float32).itemsize
+    return int(max(1, min(noOfChan, memoryBudget // max(1, workers) // bytesPerChannel)))
+
+
+def get_smoothing_bytes(ydim, xdim):
+    '''
+    Returns the peak memory in bytes of smoothing one channel image of `ydim`
+    x `xdim` pixels by FFT convolution.
+    '''
+    return SMOOTHING_BYTES_PER_PIXEL * int(ydim) * int(xdim)
+
+
+def get_smoothingWorkers(ydim, xdim, memoryBudget, workers=1):
+    '''
+    Returns the number of channel images of `ydim` x `xdim` pixels that get
+    smoothed at once within `memoryBudget` bytes, at most `workers` and at
+    least one.
+    '''
+    return int(max(1, min(workers, memoryBudget // get_smoothing_bytes(ydim, xdim))))
+
+
+def get_channelBlockList(chanNoList, channelsPerBlock):
+    '''
+    Groups channel numbers into blocks of at most `channelsPerBlock`
+    consecutive channels.
+    '''
+    blockList = []
+    for chanNo in sorted(chanNoList):
+        if blockList and len(blockList[-1]) < channelsPerBlock and blockList[-1][-1] == chanNo - 1:
+            blockList[-1].append(chanNo)
+        else:
+            blockList.append([chanNo])
+    return blockList
+
+
+class CubeBlockWriter():
+    '''
+    Writes and reads blocks of consecutive channels of a fits cube
+    [Stokes, chan, y, x] with `os.pwrite`/`os.pread`.
+
+    For each Stokes parameter the channels of a block are contiguous in the
+    file, so a block takes one system call per Stokes parameter. After every
+    block the data is synced to disk and its pages are dropped from the page
+    cache, the memory used stays bounded by the block size instead of growing
+    with the cube like a memmap.
+    '''
+
+    def __init__(self, filepathCube, readOnly=False):
+        with fits.open(filepathCube, memmap=True, ignore_missing_end=True) as hud:
+            header = hud[0].header
+            self.dataOffset = hud.fileinfo(0)['datLoc']
+        self.shape = tuple(int(header[f"NAXIS{i}"]) for i in range(int(header["NAXIS"]), 0, -1))
+        self.dtype = np.dtype(f">f{abs(int(header['BITPIX'])) // 8}")
+        self.fd = os.open(filepathCube, os.O_RDONLY if readOnly else os.O_RDWR)
+        self.touchedRangeList = []
+
+    def get_offset_and_length(self, stokesIdx, firstChanIdx, noOfChannels):
+        planeSize = self.shape[-1] * self.shape[-2] * self.dtype.itemsize
+        offset = self.dataOffset + (stokesIdx * self.shape[1] + firstChanIdx) * planeSize
+        return offset, noOfChannels * planeSize
+
+    def write_channels(self, firstChanIdx, block):
+        '''
+        Writes `block` [Stokes, chan, y, x] starting at channel index `firstChanIdx`.
+        '''
+        for stokesIdx in range(block.shape[0]):
+            offset, length = self.get_offset_and_length(stokesIdx, firstChanIdx, block.shape[1])
+            buffer = memoryview(np.ascontiguousarray(block[stokesIdx], dtype=self.dtype)).cast("B")
+            written = 0
+            while written < length:
+                written += os.pwrite(self.fd, buffer[written:], offset + written)
+            self.touchedRangeList.append((offset, length))
+
+    def read_channels(self, firstChanIdx, noOfChannels):
+        '''
+        Returns the channels [Stokes, chan, y, x] starting at `firstChanIdx` as float32.
+        '''
+        block = np.empty((self.shape[0], noOfChannels) + self.shape[2:], dtype=np.float32)
+        for stokesIdx in range(self.shape[0]):
+            offset, length = self.get_offset_and_length(stokesIdx, firstChanIdx, noOfChannels)
+            buffer = bytearray(length)
+            view = memoryview(buffer)
+            read = 0
+            while read < length:
+                read += os.preadv(self.fd, [view[read:]], offset + read)
+            block[stokesIdx] = np.frombuffer(buffer, dtype=self.dtype).reshape(block.shape[1:])
+            self.touchedRangeList.append((offset, length))
+        return block
+
+    def get_rows_offset_and_length(self, stokesIdx, chanIdx, yStart, yStop):
+        rowSize = self.shape[-1] * self.dtype.itemsize
+        offset = self.dataOffset + ((stokesIdx * self.shape[1] + chanIdx) * self.shape[-2] + yStart) * rowSize
+        return offset, (yStop - yStart) * rowSize
+
+    def read_rows(self, firstChanIdx, noOfChannels, yStart, yStop):
+        '''
+        Returns the rows `yStart` to `yStop` of the channels starting at
+        `firstChanIdx` as float32 tile [Stokes, chan, y, x]. The rows of a
+        channel are contiguous in the file, a tile takes one system call per
+        Stokes parameter and channel.
+        '''
+        if yStart == 0 and yStop == self.shape[-2]:
+            return self.read_channels(firstChanIdx, noOfChannels)
+        tile = np.empty((self.shape[0], noOfChannels, yStop - yStart, self.shape[-1]), dtype=np.float32)
+        for stokesIdx in range(self.shape[0]):
+            for blockIdx in range(noOfChannels):
+                offset, length = self.get_rows_offset_and_length(stokesIdx, firstChanIdx + blockIdx, yStart, yStop)
+                buffer = bytearray(length)
+                view = memoryview(buffer)
+                read = 0
+                while read < length:
+                    read += os.preadv(self.fd, [view[read:]], offset + read)
+                tile[stokesIdx, blockIdx] = np.frombuffer(buffer, dtype=self.dtype).reshape(tile.shape[2:])
+                self.touchedRangeList.append((offset, length))
+        return tile
+
+    def write_rows(self, firstChanIdx, yStart, tile):
+        '''
+        Writes `tile` [Stokes, chan, y, x] into the rows starting at `yStart` of
+        the channels starting at `firstChanIdx`.
+        '''
+        for stokesIdx in range(tile.shape[0]):
+            for blockIdx in range(tile.shape[1]):
+                offset, length = self.get_rows_offset_and_length(stokesIdx, firstChanIdx + blockIdx, yStart, yStart + tile.shape[2])
+                buffer = memoryview(np.ascontiguousarray(tile[stokesIdx, blockIdx], dtype=self.dtype)).cast("B")
+                written = 0
+                while written < length:
+                    written += os.pwrite(self.fd, buffer[written:], offset + written)
+                self.touchedRangeList.append((offset, length))
+
+    def flush(self):
+        '''
+        Syncs the written blocks to disk and drops all touched pages from the page cache.
+        '''
+        if not self.touchedRangeList:
+            return
+        try:
+            os.fdatasync(self.fd)
+        except OSError:
+            pass
+        for offset, length in self.touchedRangeList:
+            os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_DONTNEED)
+        self.touchedRangeList = []
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_filepathAveragemapSums(conf):
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapSumsNpy)
+
+
+def get_filepathAveragemapState(conf):
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapStateJson)
+
+
+def read_manifest_sources(cubeName):
+    """
+    Returns the signature and the source channel image fingerprints by channel
+    number from the buildcube manifest of `cubeName`, or None and an empty
+    dict without manifest.
+    """
+    try:
+        with open(cubeName + ".manifest.json") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None, {}
+    return manifest.get("signature"), {chanNo: entry.get("source") for chanNo, entry in manifest.get("channels", {}).items()}
+
+
+def get_source_key(source):
+    """
+    Returns the part of a source fingerprint that identifies the channel image
+    content. The mtime only counts if there is no checksum.
+    """
+    if not source:
+        return None
+    return [source.get("size"), source.get("crc32"), None if source.get("crc32") is not None else source.get("mtime")]
+
+
+def get_average_map_state(mapWeights, bandList, shapeCube, signature, sourceDict):
+    """
+    Returns the state of the weighted sums in `extCubeAveragemapSumsNpy`: the
+    weights [map, chan] of every channel, the bands and the source images of
+    the channels in the cube.
+    """
+    return {
+        "shape": [int(dim) for dim in shapeCube],
+        "bands": [[float(startFreq), float(stopFreq)] for startFreq, stopFreq in bandList],
+        "signature": signature,
+        "weights": mapWeights.tolist(),
+        "sources": {chanNo: get_source_key(source) for chanNo, source in sourceDict.items()},
+        }
+
+
+def read_average_map_state(conf):
+    try:
+        with open(get_filepathAveragemapState(conf)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_average_map_state(conf, state):
+    """
+    Writes the state of the weighted sums atomically.
+    """
+    filepathState = get_filepathAveragemapState(conf)
+    info(f"Writing average map state: {filepathState}")
+    filepathTmp = f"{filepathState}.{os.getpid()}.tmp"
+    with open(filepathTmp, "w") as f:
+        json.dump(state, f)
+    os.replace(filepathTmp, filepathState)
+
+
+def remove_average_map_state(conf):
+    try:
+        os.remove(get_filepathAveragemapState(conf))
+    except FileNotFoundError:
+        pass
+
+
+def get_deltaWeights(state, newState, conf):
+    """
+    Returns the weight changes [map, chan] from the weighted sums of `state` to
+    `newState`, or None if the sums need to be computed from scratch.
+
+    The sums can only be updated if the cube and the bands are the same and
+    none of the contributing channels got re-imaged since, because the old
+    contribution of a re-imaged channel is not in the cube any more.
+    """
+    if not state:
+        info("No weighted sums of previous average maps found.")
+        return None
+    filepathSums = get_filepathAveragemapSums(conf)
+    try:
+        sumsShape = np.load(filepathSums, mmap_mode="r").shape
+    except (OSError, ValueError):
+        info(f"Weighted sums of previous average maps not readable: {filepathSums}")
+        return None
+    noOfMaps = len(newState["weights"])
+    if state["shape"] != newState["shape"] or state["bands"] != newState["bands"] or sumsShape != (3, noOfMaps) + tuple(newState["shape"][2:]):
+        info("Cube or bands changed since the previous average maps.")
+        return None
+    if not newState["signature"] or state["signature"] != newState["signature"]:
+        info("No buildcube manifest or a different cube configuration than for the previous average maps.")
+        return None
+    weights = np.array(state["weights"], dtype=np.float64)
+    contributingChanNoList = [ii + 1 for ii in np.flatnonzero(np.any(weights != 0, axis=0))]
+    reimagedChanNoList = [chanNo for chanNo in contributingChanNoList if not state["sources"].get(str(chanNo)) or newState["sources"].get(str(chanNo)) != state["sources"][str(chanNo)]]
+    if reimagedChanNoList:
+        info(f"Channels re-imaged since the previous average maps: {reimagedChanNoList}")
+        return None
+    return np.array(newState["weights"], dtype=np.float64) - weights
+
+
+def get_countsDtype(noOfChan):
+    """
+    Returns the smallest dtype of the histogram counters for `noOfChan` channels.
+    """
+    return np.dtype(np.uint16) if noOfChan < 2**16 else np.dtype(np.uint32)
+
+
+def get_accumulatorBytesPerRow(shapeCube, noOfMaps=1, histogramBins=0):
+    """
+    Returns the bytes per image row of the accumulators of a tile: three
+    float64 accumulators, the float32 output tile and the histograms of the
+    robust `averageMapMethod` per map.
+    """
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    bytesPerPixel = np.dtype(np.float64).itemsize + np.dtype(np.float32).itemsize + histogramBins * get_countsDtype(noOfChan).itemsize
+    return 3 * noOfMaps * xdim * bytesPerPixel
+
+
+def get_rowsPerTile(shapeCube, memoryBudget, workers=1, noOfMaps=1, histogramBins=0):
+    """
+    Returns the number of image rows of a spatial tile.
+
+    The accumulators of a tile take at most half of the budget of a worker,
+    the channel blocks the other half. With more than one worker the image
+    gets split into at least one tile per worker.
+    """
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    bytesPerRow = get_accumulatorBytesPerRow(shapeCube, noOfMaps, histogramBins)
+    rowsPerTile = int(memoryBudget // max(1, workers) // 2 // bytesPerRow)
+    return max(1, min(rowsPerTile, int(np.ceil(ydim / max(1, workers)))))
+
+
+def get_channelsPerTileBlock(shapeCube, rowsPerTile, memoryBudget, workers=1, noOfMaps=1, histogramBins=0):
+    """
+    Returns the number of channels that get read at once for a tile of
+    `rowsPerTile` rows.
+    """
+    noOfStokes, noOfChan, ydim, xdim = shapeCube
+    accumulatorBytes = rowsPerTile * get_accumulatorBytesPerRow(shapeCube, noOfMaps, histogramBins)
+    # block, read buffer, float64 copy of a Stokes plane and the polarised intensity
+    bytesPerChannel = rowsPerTile * xdim * (noOfStokes * 4 + 4 + 8 + 4)
+    return int(max(1, min(noOfChan, (memoryBudget // max(1, workers) - accumulatorBytes) // bytesPerChannel)))
+
+
+def get_tileList_and_channelsPerBlock(shapeCube, noOfMaps, conf):
+    """
+    Returns the tiles as list of (yStart, yStop) and the number of channels
+    read at once within `cubeMemoryBudget`.
+    """
+    memoryBudget = float(conf.input.cubeMemoryBudget) * 1024**3
+    workers = max(1, int(conf.input.averageMapWorkers))
+    histogramBins = int(conf.input.averageMapHistogramBins) if conf.input.averageMapMethod != "mean" else 0
+    rowsPerTile = get_rowsPerTile(shapeCube, memoryBudget, workers, noOfMaps, histogramBins)
+    channelsPerBlock = get_channelsPerTileBlock(shapeCube, rowsPerTile, memoryBudget, workers, noOfMaps, histogramBins)
+    ydim = shapeCube[-2]
+    tileList = [(yStart, min(ydim, yStart + rowsPerTile)) for yStart in range(0, ydim, rowsPerTile)]
+    return tileList, channelsPerBlock
+
+
+def accumulate_weighted_sums(blockReader, accumulator, mapWeights, blockList, yStart, yStop):
+    """
+    Adds the weighted Stokes I, linear polarised intensity sqrt(Q^2 + U^2) and
+    Stokes V of the rows `yStart` to `yStop` read by `blockReader` to
+    `accumulator` [3, map, pixel].
+
+    Returns
+    -------
+    success: bool
+       False if a channel with negative weight, i.e. one that gets removed,
+       has non-finite pixels in the tile. Its contribution can not be
+       subtracted and `accumulator` is not usable.
+    """
+    noOfMaps = mapWeights.shape[0]
+    for blockChanNoList in blockList:
+        block = blockReader.read_rows(blockChanNoList[0] - 1, len(blockChanNoList), yStart, yStop)
+        block = block.reshape(block.shape[0], block.shape[1], -1)
+        blockReader.flush()
+        blockWeights = mapWeights[:, blockChanNoList[0] - 1:blockChanNoList[-1]]
+        removedIdxArray = np.flatnonzero(np.any(blockWeights < 0, axis=0))
+        if len(removedIdxArray) and not np.isfinite(block[:, removedIdxArray]).all():
+            return False
+        polarised = np.hypot(block[1], block[2])
+        for mapIdx in range(noOfMaps):
+            # only the channels of the map get summed, so that blanked pixels
+            # of other channels do not propagate
+            chanIdxArray = np.flatnonzero(blockWeights[mapIdx])
+            if not len(chanIdxArray):
+                continue
+            if chanIdxArray[-1] - chanIdxArray[0] + 1 == len(chanIdxArray):
+                chanIdxArray = slice(chanIdxArray[0], chanIdxArray[-1] + 1)
+            weights = blockWeights[mapIdx, chanIdxArray]
+            accumulator[0, mapIdx] += weights @ block[0, chanIdxArray]
+            accumulator[1, mapIdx] += weights @ polarised[chanIdxArray]
+            accumulator[2, mapIdx] += weights @ block[3, chanIdxArray]
+        del block, polarised
+    return True
+
+
+def subtract_channels_from_average_maps(chanNoList, conf):
+    """
+    Subtracts the contributions of `chanNoList` from the weighted sums of the
+    average maps, while the channels still hold their data. Called before the
+    IOR flagging blanks them in the smoothed cube, so that the next average map
+    run only needs to renormalise. The average maps themselves get updated by
+    the next run of `cube_average_map.py`.
+    """
+    state = read_average_map_state(conf)
+    if not conf.input.averageMapIncremental or not state:
+        return
+    cubeNameInput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    mapWeights = np.array(state["weights"], dtype=np.float64)
+    removedIdxList = [int(chanNo) - 1 for chanNo in chanNoList if 0 < int(chanNo) <= mapWeights.shape[1] and mapWeights[:, int(chanNo) - 1].any()]
+    if not removedIdxList:
+        return
+    info(SEPERATOR)
+    info(f"Subtracting {len(removedIdxList)} channels from the weighted sums of the average maps.")
+    mapWeights[:, removedIdxList] = 0.
+    with CubeBlockWriter(cubeNameInput, readOnly=True) as blockReader:
+        shapeCube = blockReader.shape
+    signature, sourceDict = read_manifest_sources(cubeNameInput)
+    newState = get_average_map_state(mapWeights, state["bands"], shapeCube, signature, sourceDict)
+    deltaWeights = get_deltaWeights(state, newState, conf)
+    remove_average_map_state(conf)
+    if deltaWeights is None:
+        info("The next average map run computes the weighted sums from scratch.")
+        return
+    noOfMaps = mapWeights.shape[0]
+    tileList, channelsPerBlock = get_tileList_and_channelsPerBlock(shapeCube, noOfMaps, conf)
+    blockList = get_channelBlockList([ii + 1 for ii in np.flatnonzero(np.any(mapWeights != 0, axis=0))], channelsPerBlock)
+    deltaBlockList = get_channelBlockList([ii + 1 for ii in removedIdxList], channelsPerBlock)
+    sums = np.load(get_filepathAveragemapSums(conf), mmap_mode="r+")
+    noOfFromScratch = 0
+    with CubeBlockWriter(cubeNameInput, readOnly=True) as blockReader:
+        for yStart, yStop in tileList:
+            tileShape = (3, noOfMaps, yStop - yStart, shapeCube[-1])
+            accumulator = np.array(sums[:, :, yStart:yStop], dtype=np.float64).reshape(3, noOfMaps, -1)
+            if not accumulate_weighted_sums(blockReader, accumulator, deltaWeights, deltaBlockList, yStart, yStop):
+                noOfFromScratch += 1
+                accumulator = np.zeros((3, noOfMaps, (yStop - yStart) * shapeCube[-1]), dtype=np.float64)
+                accumulate_weighted_sums(blockReader, accumulator, mapWeights, blockList, yStart, yStop)
+            sums[:, :, yStart:yStop] = accumulator.reshape(tileShape)
+            sums.flush()
+    del sums
+    if noOfFromScratch:
+        info(f"Removed channels hold blanked pixels in {noOfFromScratch} of {len(tileList)} tiles, their weighted sums got computed from scratch.")
+    write_average_map_state(conf, newState)
+
+
+def get_channel_statsDict(conf, mode="normal"):
+    '''
+    Returns the channel statistics written by buildcube.
+
+    Channels flagged by the IOR flagging are marked as flagged as well, unless
+    `ignoreStokesVFlagging` is set. The flags are taken from the channel mask
+    of the cube, or from the IOR statistics file for cubes without mask.
+
+    Parameters
+    ----------
+    conf: DotMap
+       Config object
+    mode: str
+       "normal" or "smoothed" cube
+
+    Returns
+    -------
+    statsDict: dict of lists
+       Channel statistics with the column names of the statistics file
+    '''
+    if mode == "smoothed":
+        filepathStatistics = conf.input.basename + conf.env.extCubeSmoothedStatistics
+        filepathCube = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    else:
+        filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
+        filepathCube = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+    info(f"Reading channel statistics: {filepathStatistics}")
+    statsDict = get_dict_from_statsFile(filepathStatistics)
+    if conf.input.ignoreStokesVFlagging:
+        return statsDict
+    channelMask = read_channel_mask(filepathCube, conf)
+    filepathIORStatistics = conf.input.basename + conf.env.extCubeIORStatistics
+    if channelMask:
+        info(f"Applying flags from: {get_filepathChannelMask(filepathCube, conf)}")
+        flaggedChanNoSet = channelMask["flagged"] | channelMask["blanked"]
+    elif os.path.exists(filepathIORStatistics):
+        info(f"Applying flags from: {filepathIORStatistics}")
+        iorStatsDict = get_dict_from_statsFile(filepathIORStatistics)
+        flaggedChanNoSet = {chanNo for chanNo, flagged in zip(iorStatsDict['chanNo'], iorStatsDict['flagged']) if flagged}
+    else:
+        return statsDict
+    statsDict['flagged'] = [flagged or chanNo in flaggedChanNoSet for chanNo, flagged in zip(statsDict['chanNo'], statsDict['flagged'])]
+    return statsDict
+
+
+def get_lowest_channelNo_with_data_from_statsDict(statsDict, allowNan=False):
+    '''
+    Returns the lowest channel number which holds data, without reading the cube.
+
+    Parameters
+    ----------
+    statsDict: dict of lists
+       Channel statistics from `get_channel_statsDict`
+    allowNan: bool
+       If False the channel must not have any blanked Stokes I pixel
+
+    Returns
+    -------
+    chanNo: int
+    '''
+    for chanNo, flagged, nanFraction in zip(statsDict['chanNo'], statsDict['flagged'], statsDict['nanFraction']):
+        if flagged or nanFraction == 1 or (nanFraction > 0 and not allowNan):
+            continue
+        return chanNo
+
+
 def get_lowest_channelNo_with_data_in_cube(filepathCube):
     '''
     '''
@@ -462,3 +1225,205 @@ def get_dict_from_tabFile(tabFile):
             for i, key in enumerate(allStatsDict):
                 allStatsDict[key].append(eval(line.split('\t')[i]))
     return allStatsDict
+
+
+def get_dirPlotQueue(conf):
+    '''
+    Returns the directory of the plot queue in `env.dirPlots`.
+    '''
+    return os.path.join(conf.env.dirPlots, conf.env.dirPlotQueue)
+
+def get_jsonable(value):
+    '''
+    Converts numpy types and sets, which `json` can't serialize, to python types.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Can't queue plot argument of type {type(value).__name__}")
+
+def queue_plot(conf, plotName, plotFunction, **kwargs):
+    '''
+    Queues a plot to be rendered by the report job with `render_plot_queue`,
+    so the calling stage doesn't wait for Matplotlib and can release its
+    memory. The plot is rendered right away if `deferPlots` is not set or the
+    report is not part of `runScripts`, and skipped if `plotName` is in
+    `disabledPlots`.
+
+    Parameters
+    ----------
+    plotName: str
+       Name of the plot as used in `disabledPlots`
+    plotFunction: function
+       Function of a frocc module, called as `plotFunction(conf=conf, **kwargs)`
+    kwargs:
+       Arguments of `plotFunction`, numpy arrays and sets are passed as lists
+    '''
+    if plotName in conf.input.disabledPlots:
+        info(f"Plot is disabled: {plotName}")
+        return
+    if not conf.input.deferPlots or "cube_report.py" not in conf.input.runScripts:
+        plotFunction(conf=conf, **kwargs)
+        return
+    dirPlotQueue = get_dirPlotQueue(conf)
+    os.makedirs(dirPlotQueue, exist_ok=True)
+    # the module is taken from the file, stages run as `__main__`
+    moduleName = "frocc." + os.path.splitext(os.path.basename(inspect.getfile(plotFunction)))[0]
+    entry = {"plotName": plotName, "module": moduleName, "function": plotFunction.__name__, "kwargs": kwargs}
+    filepathEntry = os.path.join(dirPlotQueue, f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}-{plotName}.json")
+    info(f"Queueing plot: {filepathEntry}")
+    with open(filepathEntry + ".tmp", "w") as f:
+        json.dump(entry, f, default=get_jsonable)
+    os.replace(filepathEntry + ".tmp", filepathEntry)
+
+def render_queued_plot(filepathEntry, conf):
+    '''
+    Renders a plot from the plot queue and removes it from the queue.
+    '''
+    import importlib
+    from matplotlib import pyplot as plt
+    with open(filepathEntry) as f:
+        entry = json.load(f)
+    if entry["plotName"] in conf.input.disabledPlots:
+        info(f"Plot is disabled: {entry['plotName']}")
+    else:
+        info(f"Rendering plot: {entry['plotName']}")
+        plotFunction = getattr(importlib.import_module(entry["module"]), entry["function"])
+        plotFunction(conf=conf, **entry["kwargs"])
+        plt.close("all")
+    os.remove(filepathEntry)
+
+PLOT_WORKER_STATE = {}
+
+def init_plot_worker(conf):
+    PLOT_WORKER_STATE["conf"] = conf
+
+def render_plot_worker(plotJob):
+    '''
+    Renders a plot job, either the path of a queued plot or a list of
+    [plotName, plotFunction, kwargs]. Errors are logged and returned, so one
+    broken plot doesn't stop the others.
+    '''
+    conf = PLOT_WORKER_STATE["conf"]
+    try:
+        if isinstance(plotJob, str):
+            render_queued_plot(plotJob, conf)
+        else:
+            plotName, plotFunction, kwargs = plotJob
+            info(f"Rendering plot: {plotName}")
+            plotFunction(conf=conf, **kwargs)
+    except Exception as e:
+        error(f"Plot could not be rendered: {plotJob}: {type(e).__name__}: {e}")
+        return [plotJob, e]
+    return [plotJob, None]
+
+def render_plot_queue(conf, plotJobList=()):
+    '''
+    Renders all queued plots and the plot jobs `plotJobList` in `plotWorkers`
+    forked processes.
+
+    Parameters
+    ----------
+    plotJobList: list
+       List of [plotName, plotFunction, kwargs]. Jobs of `disabledPlots` are
+       skipped.
+
+    Returns
+    -------
+    failedList: list
+       List of [plotJob, exception] of all plots that failed
+    '''
+    dirPlotQueue = get_dirPlotQueue(conf)
+    queuedList = sorted(entry.path for entry in os.scandir(dirPlotQueue) if entry.name.endswith(".json")) if os.path.isdir(dirPlotQueue) else []
+    jobList = queuedList + [plotJob for plotJob in plotJobList if plotJob[0] not in conf.input.disabledPlots]
+    info(f"Rendering {len(queuedList)} queued and {len(jobList) - len(queuedList)} report plots.")
+    workers = max(1, min(int(conf.input.plotWorkers), len(jobList)))
+    if workers == 1:
+        init_plot_worker(conf)
+        resultList = [render_plot_worker(plotJob) for plotJob in jobList]
+    else:
+        import multiprocessing
+        with multiprocessing.get_context("fork").Pool(workers, initializer=init_plot_worker, initargs=(conf,)) as pool:
+            resultList = pool.map(render_plot_worker, jobList, chunksize=1)
+    return [result for result in resultList if result[1] is not None]
+
+
+def get_filepathStatsStore(filepathStatistics):
+    '''
+    Returns the path of the binary statistics store of a `.tab` statistics file.
+    '''
+    return os.path.splitext(filepathStatistics)[0] + ".npz"
+
+def write_stats_store(filepathStatistics, statsColumnList):
+    '''
+    Writes the binary store of a `.tab` statistics file.
+
+    Every column is stored as typed numpy array in full precision, the column
+    names and units in the arrays `_columns` and `_units`. The `.tab` file is
+    only an export for humans, the stages read the store with
+    `get_dict_from_statsFile`.
+
+    Parameters
+    ----------
+    filepathStatistics: str
+       Path of the `.tab` statistics file
+    statsColumnList: list
+       List of [name, unit, values] per column, unit is "" for unitless columns
+    '''
+    filepathStore = get_filepathStatsStore(filepathStatistics)
+    columnDict = {}
+    for name, unit, values in statsColumnList:
+        columnDict[name] = np.asarray(values)
+        if columnDict[name].dtype == object:
+            raise TypeError(f"Column {name} of statistics store {filepathStore} has no numeric type")
+    columnDict["_columns"] = np.array([name for name, unit, values in statsColumnList])
+    columnDict["_units"] = np.array([unit for name, unit, values in statsColumnList])
+    filepathTmp = f"{filepathStore}.{os.getpid()}.tmp"
+    with open(filepathTmp, "wb") as f:
+        np.savez(f, **columnDict)
+    os.replace(filepathTmp, filepathStore)
+
+def is_stats_store_up_to_date(filepathStatistics):
+    '''
+    Checks whether the binary store exists and is not older than the `.tab` file.
+    '''
+    filepathStore = get_filepathStatsStore(filepathStatistics)
+    if not os.path.exists(filepathStore):
+        return False
+    return not os.path.exists(filepathStatistics) or os.path.getmtime(filepathStore) >= os.path.getmtime(filepathStatistics)
+
+def get_dict_from_statsFile(filepathStatistics, asArrays=False):
+    '''
+    Returns the columns of a statistics file as dict of lists, or of numpy
+    arrays if `asArrays` is set.
+
+    The binary store from `write_stats_store` is loaded if it is not older than
+    the `.tab` file, otherwise the `.tab` file is parsed.
+    '''
+    filepathStore = get_filepathStatsStore(filepathStatistics)
+    if is_stats_store_up_to_date(filepathStatistics):
+        with np.load(filepathStore, allow_pickle=False) as store:
+            statsDict = {str(name): store[name] for name in store["_columns"]}
+        if not asArrays:
+            statsDict = {name: values.tolist() for name, values in statsDict.items()}
+        return statsDict
+    statsDict = get_dict_from_tabFile(filepathStatistics)
+    if asArrays:
+        statsDict = {name: np.array(values) for name, values in statsDict.items()}
+    return statsDict
+
+def merge_stats_stores(filepathStatisticsList, filepathStatistics):
+    '''
+    Concatenates the binary stores of `filepathStatisticsList` into the store
+    of `filepathStatistics`.
+    '''
+    filepathStore = get_filepathStatsStore(filepathStatisticsList[0])
+    with np.load(filepathStore, allow_pickle=False) as store:
+        columnList, unitList = store["_columns"].tolist(), store["_units"].tolist()
+    statsDictList = [get_dict_from_statsFile(filepath, asArrays=True) for filepath in filepathStatisticsList]
+    # empty partitions would change the type of the columns
+    statsDictList = [statsDict for statsDict in statsDictList if len(statsDict[columnList[0]])] or statsDictList[:1]
+    write_stats_store(filepathStatistics, [[name, unit, np.concatenate([statsDict[name] for statsDict in statsDictList])] for name, unit in zip(columnList, unitList)])
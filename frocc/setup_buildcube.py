@@ -22,6 +22,7 @@ from frocc.lhelpers import (
     get_firstFreq,
     get_basename_from_path,
     get_optimal_taskNo_cpu_mem,
+    get_smoothing_bytes,
     SEPERATOR,
     run_command_with_logging,
 )
@@ -33,6 +34,7 @@ from frocc.config import (
     FILEPATH_CONFIG_TEMPLATE_ORIGINAL,
     FILEPATH_LOG_PIPELINE,
     FILEPATH_LOG_TIMER,
+    ENVVAR_IMAGING_JOB_ID,
 )
 import frocc
 
@@ -52,6 +54,11 @@ import numpy as np
 
 # make is obsulete since this moved into config.input.configFile
 
+# slurm time limits in hours
+TIME_LIMIT_TCLEAN = 20
+TIME_LIMIT_WSCLEAN = 72
+TIME_LIMIT_BUILDCUBE = 2
+
 # SETTINGS
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
@@ -273,6 +280,15 @@ def create_directories(conf):
         os.makedirs(conf.input.dirOutput)
 
 
+def get_slurm_time(hours):
+    """
+    Returns the slurm time limit days-hours:minutes:seconds of `hours`, rounded
+    up to full minutes.
+    """
+    minutes = int(np.ceil(hours * 60))
+    return f"{minutes // 1440}-{minutes // 60 % 24:02d}:{minutes % 60:02d}:00"
+
+
 def write_all_sbatch_files(conf):
     """
     TODO: make this shorter and better
@@ -320,7 +336,7 @@ def write_all_sbatch_files(conf):
         "mem": str(tcleanSlurm["mem"]) + "GB",
         "output": f"logs/{basename}-%A-%a.out",
         "error": f"logs/{basename}-%A-%a.err",
-        "time": "20:00:00",
+        "time": get_slurm_time(TIME_LIMIT_TCLEAN),
     }
     if os.path.exists(basename + ".py"):
         scriptPath = basename + ".py"
@@ -364,7 +380,7 @@ def write_all_sbatch_files(conf):
         "mem": f"{int(mem)}GB",
         "output": f"logs/{basename}-%A-%a.out",
         "error": f"logs/{basename}-%A-%a.err",
-        "time": "3-00:00:00",
+        "time": get_slurm_time(TIME_LIMIT_WSCLEAN),
     }
     if os.path.exists(basename + ".py"):
         scriptPath = basename + ".py"
@@ -378,6 +394,18 @@ def write_all_sbatch_files(conf):
         noOfArrayTasks = 2
     else:
         noOfArrayTasks = 1
+    memoryBudget = float(conf.input.cubeMemoryBudget)
+    if conf.input.smoothbeam and conf.input.smoothingBackend == "fft":
+        # the smoothing stays within the budget, but smoothes at least one channel
+        imsize = conf.input.imsize if isinstance(conf.input.imsize, (list, tuple)) else [conf.input.imsize, conf.input.imsize]
+        memoryBudget = max(memoryBudget, get_smoothing_bytes(imsize[1], imsize[0]) / 1024**3)
+    # each cube mode is split into contiguous channel partitions, the
+    # streaming buildcube fills each cube with a single task
+    if conf.input.buildcubeStreaming:
+        if int(conf.input.buildcubePartitions) > 1:
+            info("Ignoring buildcubePartitions, the streaming buildcube fills each cube with a single task.")
+    else:
+        noOfArrayTasks *= max(1, int(conf.input.buildcubePartitions))
     basename = "cube_buildcube"
     filename = basename + ".sbatch"
     sbatchDict = {
@@ -385,10 +413,16 @@ def write_all_sbatch_files(conf):
         "job-name": basename,
         "output": "logs/" + basename + "-%A-%a.out",
         "error": "logs/" + basename + "-%A-%a.err",
-        "cpus-per-task": 2,
-        "mem": "50GB",
-        "time": "02:00:00",
+        "cpus-per-task": max(2, int(conf.input.buildcubeWorkers)),
+        # cube blocks within the budget plus an interpreter per worker
+        "mem": f"{int(np.ceil(memoryBudget)) + 4 + int(conf.input.buildcubeWorkers)}GB",
+        "time": get_slurm_time(TIME_LIMIT_BUILDCUBE),
     }
+    if conf.input.buildcubeStreaming:
+        # runs alongside the imaging, waits up to `buildcubeStreamingTimeout`
+        # for the last channel image and fills the remaining channels
+        timeLimitImaging = TIME_LIMIT_WSCLEAN if "cube_wsclean.py" in conf.input.runScripts else TIME_LIMIT_TCLEAN
+        sbatchDict["time"] = get_slurm_time(timeLimitImaging + float(conf.input.buildcubeStreamingTimeout) / 3600 + TIME_LIMIT_BUILDCUBE)
     if os.path.exists(basename + ".py"):
         scriptPath = basename + ".py"
     else:
@@ -404,14 +438,37 @@ def write_all_sbatch_files(conf):
     # ior flagging
     basename = "cube_ior_flagging"
     filename = basename + ".sbatch"
-    # TODO: calculate memory requirements better. Less magic numbers, put in config.
+    # the flagging stays within the cube memory budget, the hdf5 converter needs its own allocation
+    if conf.input.hdf5Converter:
+        mem = "230GB"
+    else:
+        mem = f"{int(np.ceil(float(conf.input.cubeMemoryBudget))) + 4}GB"
     sbatchDict = {
         "array": "1-1%1",
         "job-name": basename,
         "output": "logs/" + basename + "-%A-%a.out",
         "error": "logs/" + basename + "-%A-%a.err",
         "cpus-per-task": conf.env.hdf5ConverterMaxCpuCores,
-        "mem": "230GB",
+        "mem": mem,
+        "time": "06:00:00",
+    }
+    if os.path.exists(basename + ".py"):
+        scriptPath = basename + ".py"
+    else:
+        scriptPath = os.path.join(PATH_PACKAGE, basename + ".py")
+    command = conf.env.prefixSingularity + " python3 " + scriptPath
+    write_sbtach_file(filename, command, conf, sbatchDict)
+
+    # spectral-major transpose
+    basename = "cube_transpose"
+    filename = basename + ".sbatch"
+    sbatchDict = {
+        "array": "1-1%1",
+        "job-name": basename,
+        "output": "logs/" + basename + "-%A-%a.out",
+        "error": "logs/" + basename + "-%A-%a.err",
+        "cpus-per-task": 1,
+        "mem": f"{int(np.ceil(float(conf.input.transposeMemoryBudget))) + 4}GB",
         "time": "06:00:00",
     }
     if os.path.exists(basename + ".py"):
@@ -429,8 +486,8 @@ def write_all_sbatch_files(conf):
         "job-name": basename,
         "output": "logs/" + basename + "-%A-%a.out",
         "error": "logs/" + basename + "-%A-%a.err",
-        "cpus-per-task": 1,
-        "mem": "100GB",
+        "cpus-per-task": int(conf.input.averageMapWorkers),
+        "mem": f"{int(np.ceil(float(conf.input.cubeMemoryBudget))) + 4}GB",
         "time": "00:30:00",
     }
     if os.path.exists(basename + ".py"):
@@ -440,6 +497,25 @@ def write_all_sbatch_files(conf):
     command = conf.env.prefixSingularity + " python3 " + scriptPath
     write_sbtach_file(filename, command, conf, sbatchDict)
 
+    # RM synthesis of all pixels
+    basename = "cube_rmsynth"
+    filename = basename + ".sbatch"
+    sbatchDict = {
+        "array": "1-1%1",
+        "job-name": basename,
+        "output": "logs/" + basename + "-%A-%a.out",
+        "error": "logs/" + basename + "-%A-%a.err",
+        "cpus-per-task": int(conf.input.rmsynthWorkers),
+        "mem": f"{int(np.ceil(float(conf.input.cubeMemoryBudget))) + 4}GB",
+        "time": "06:00:00",
+    }
+    if os.path.exists(basename + ".py"):
+        scriptPath = basename + ".py"
+    else:
+        scriptPath = os.path.join(PATH_PACKAGE, basename + ".py")
+    command = conf.env.prefixSingularity + " python3 " + scriptPath
+    write_sbtach_file(filename, command, conf, sbatchDict)
+
     # cube_cleanup
     basename = "cube_cleanup"
     filename = basename + ".sbatch"
@@ -467,7 +543,7 @@ def write_all_sbatch_files(conf):
         "job-name": basename,
         "output": "logs/" + basename + "-%A-%a.out",
         "error": "logs/" + basename + "-%A-%a.err",
-        "cpus-per-task": 1,
+        "cpus-per-task": int(conf.input.plotWorkers),
         "mem": "30GB",
         "time": "00:30:00",
     }
@@ -487,7 +563,7 @@ def write_all_sbatch_files(conf):
         "output": "logs/" + basename + "-%A-%a.out",
         "error": "logs/" + basename + "-%A-%a.err",
         "cpus-per-task": 1,
-        "mem": "100GB",
+        "mem": f"{int(np.ceil(float(conf.input.cubeMemoryBudget))) + 4}GB",
     }
     if os.path.exists(basename + ".py"):
         scriptPath = basename + ".py"
@@ -634,7 +710,13 @@ def main(ctx):
         )
         for runScript in conf.input.runScripts[1:]:
             sbatchScript = runScript.replace(".py", ".sbatch")
-            command += f"$SLURMID;SLURMID=$(sbatch --dependency=afterok:$SLURMID {sbatchScript} | cut -d ' ' -f4) && echo "
+            # a streaming buildcube starts with the imaging and ingests the
+            # channels as they finish, it waits for the imaging job to end
+            if runScript == "cube_buildcube.py" and conf.input.buildcubeStreaming:
+                dependency = f"after:$SLURMID --export=ALL,{ENVVAR_IMAGING_JOB_ID}=$SLURMID"
+            else:
+                dependency = "afterok:$SLURMID"
+            command += f"$SLURMID;SLURMID=$(sbatch --dependency={dependency} {sbatchScript} | cut -d ' ' -f4) && echo "
         command += "$SLURMID && echo Slurm jobs submitted!"
         info(f"Slurm command: {command}")
         sbatchResult = subprocess.run(
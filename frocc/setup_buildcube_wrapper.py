@@ -58,6 +58,11 @@ PATH_HOME = expanduser("~") + "/"
 def main(ctx):
     '''
     '''
+    if "--bench" in ctx.args:
+        # the benchmark has its own options, see tool_bench_stages.py --help
+        from frocc.tool_bench_stages import main as bench_main
+        bench_main(args=[arg for arg in ctx.args if arg != "--bench"])
+        return None
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE_ORIGINAL, configFilename="")
     check_all(ctx.args)
 
@@ -0,0 +1,398 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ Smoothing of channel images to a common resolution. Used by buildcube for
+ the smoothed cube and by the imaging scripts with `smoothInImaging`. The
+ channel images are convolved in memory by FFT convolution or with CASA
+ imsmooth, see `smoothingBackend`.
+
+------------------------------------------------------------------------------
+
+ Developed at: IDIA (Institure for Data Intensive Astronomy), Cape Town, ZA
+
+------------------------------------------------------------------------------
+"""
+
+import multiprocessing
+import os
+from logging import info, error
+
+import numpy as np
+from astropy import units
+from astropy.io import fits
+from radio_beam import Beam, Beams
+from radio_beam.utils import BeamError
+from scipy.signal import fftconvolve
+
+from frocc.lhelpers import get_channel_index, get_firstFreq, get_smoothingWorkers
+
+
+def get_beam_of_channel_image(fitsname, conf, index=None):
+    """Get the beam of a channel image from the channel index
+
+    Args:
+        fitsname (str): Channel fits file
+        conf (config): Config object
+        index (dict): Channel index from `get_channel_index`, read if not given
+
+    Returns:
+        Beam: Beam of the channel image, from its header if not indexed
+    """
+    if index is None:
+        index = get_channel_index(conf)
+    entry = index.get(os.path.basename(fitsname))
+    if entry and entry["beam"]:
+        major, minor, pa = entry["beam"]
+        return Beam(major=major * units.deg, minor=minor * units.deg, pa=pa * units.deg)
+    return Beam.from_fits_header(fits.getheader(fitsname))
+
+
+def get_smoothing_beam(fitsnames, conf):
+    """Get the common target resolution of all channel images
+
+    Args:
+        fitsnames (list): List of all channel fits files
+        conf (config): Config object
+
+    Returns:
+        tuple: major, minor and pa as CASA quantity strings
+    """
+    if conf.input.smoothbeam == "auto":
+        beam_list = [get_beam_of_channel_image(fitsname, conf) for fitsname in fitsnames]
+        beams = Beams(
+            major=np.array([b.major.to(units.deg).value for b in beam_list])
+            * units.deg,
+            minor=np.array([b.minor.to(units.deg).value for b in beam_list])
+            * units.deg,
+            pa=np.array([b.pa.to(units.deg).value for b in beam_list]) * units.deg,
+        )
+        common_beam = beams.common_beam()
+        major = f"{np.ceil(common_beam.major.to(units.arcsec).value)}arcsec"
+        minor = f"{np.ceil(common_beam.minor.to(units.arcsec).value)}arcsec"
+        pa = f"{np.ceil(common_beam.pa.to(units.deg).value)}deg"
+    elif conf.input.smoothbeam.find(",") > 0:
+        major, minor = conf.input.smoothbeam.split(",")
+        pa = "0deg"
+    else:
+        major = conf.input.smoothbeam
+        minor = conf.input.smoothbeam
+        pa = "0deg"
+    return major, minor, pa
+
+
+def get_beam_from_beamTuple(beam):
+    """Get a radio_beam Beam from the output of `get_smoothing_beam`
+
+    Args:
+        beam (tuple): major, minor and pa as CASA quantity strings
+
+    Returns:
+        Beam: Beam object
+    """
+    major, minor, pa = beam
+    return Beam(major=units.Quantity(major), minor=units.Quantity(minor), pa=units.Quantity(pa))
+
+
+def get_beamTuple_from_beam(beam):
+    """Get major, minor and pa as CASA quantity strings from a Beam
+
+    Args:
+        beam (Beam): Beam object
+
+    Returns:
+        tuple: major, minor and pa as CASA quantity strings
+    """
+    return f"{beam.major.to(units.arcsec).value:.4f}arcsec", f"{beam.minor.to(units.arcsec).value:.4f}arcsec", f"{beam.pa.to(units.deg).value:.4f}deg"
+
+
+def is_same_beam(beamA, beamB):
+    """Check whether two beams agree to 1 milliarcsec and 0.01 deg
+
+    Args:
+        beamA (Beam): Beam object
+        beamB (Beam): Beam object
+
+    Returns:
+        bool: True if the beams agree
+    """
+    return (
+        np.isclose(beamA.major.to(units.arcsec).value, beamB.major.to(units.arcsec).value, rtol=0, atol=1e-3)
+        and np.isclose(beamA.minor.to(units.arcsec).value, beamB.minor.to(units.arcsec).value, rtol=0, atol=1e-3)
+        and np.isclose(beamA.pa.to(units.deg).value % 180, beamB.pa.to(units.deg).value % 180, rtol=0, atol=1e-2)
+    )
+
+
+def get_imaging_smoothing_beam(fitsname, conf):
+    """Get the target beam for smoothing a channel right after imaging
+
+    A fixed `smoothbeam` is used as is. For "auto" the common beam is predicted
+    by scaling the major axis of this channel with frequency to the lowest
+    frequency of `freqRanges`, rounded up to full arcsec and made circular.
+    Channels predicting the same beam agree on it, buildcube checks the
+    prediction against all channel beams.
+
+    Args:
+        fitsname (str): Channel fits file
+        conf (config): Config object
+
+    Returns:
+        tuple: major, minor and pa as CASA quantity strings
+    """
+    if conf.input.smoothbeam != "auto":
+        return get_smoothing_beam([], conf)
+    header = fits.getheader(fitsname)
+    scaling = max(1, float(header["CRVAL3"]) / get_firstFreq(conf))
+    major = f"{np.ceil(Beam.from_fits_header(header).major.to(units.arcsec).value * scaling)}arcsec"
+    return major, major, "0.0deg"
+
+
+def get_presmoothed_beam(fitsnames, conf):
+    """Get the target beam of channels smoothed during imaging, if it is usable
+
+    The largest beam of the existing smoothed channel images is used if every
+    channel beam can be convolved to it.
+
+    Args:
+        fitsnames (list): List of all channel fits files
+        conf (config): Config object
+
+    Returns:
+        tuple: major, minor and pa as CASA quantity strings or None
+    """
+    index = get_channel_index(conf)
+    smoothedBeamList = [get_beam_of_channel_image(get_smoothedFitsname(fitsname), conf, index) for fitsname in fitsnames if os.path.basename(get_smoothedFitsname(fitsname)) in index]
+    if not smoothedBeamList:
+        return None
+    candidateBeam = max(smoothedBeamList, key=lambda beam: beam.sr)
+    for fitsname in fitsnames:
+        channelBeam = get_beam_of_channel_image(fitsname, conf, index)
+        if is_same_beam(candidateBeam, channelBeam):
+            continue
+        try:
+            candidateBeam.deconvolve(channelBeam)
+        except (ValueError, BeamError):
+            info(f"Beam of {fitsname} is larger than the beam predicted during imaging: {get_beamTuple_from_beam(candidateBeam)}")
+            return None
+    beam = get_beamTuple_from_beam(candidateBeam)
+    info(f"Using the beam of the channels smoothed during imaging: {beam}")
+    return beam
+
+
+def get_fitsfiles_to_smooth(fitsnames, beam):
+    """Get the channel images without an up to date smoothed image at `beam`
+
+    Args:
+        fitsnames (list): List of channel fits files
+        beam (tuple): Target resolution from `get_smoothing_beam`
+
+    Returns:
+        list: Channel fits files that need smoothing
+    """
+    targetBeam = get_beam_from_beamTuple(beam)
+    toSmoothList = []
+    for fitsname in fitsnames:
+        smoothedFitsname = get_smoothedFitsname(fitsname)
+        if os.path.exists(smoothedFitsname) and os.path.getmtime(smoothedFitsname) >= os.path.getmtime(fitsname):
+            try:
+                if is_same_beam(Beam.from_fits_header(fits.getheader(smoothedFitsname)), targetBeam):
+                    continue
+            except Exception:
+                pass
+        toSmoothList.append(fitsname)
+    if len(toSmoothList) < len(fitsnames):
+        info(f"Reusing {len(fitsnames) - len(toSmoothList)} channel images smoothed before.")
+    return toSmoothList
+
+
+def get_smoothedFitsname(fitsname):
+    """Get the filename of the smoothed version of a channel image
+
+    Args:
+        fitsname (str): Channel fits file
+
+    Returns:
+        str: Smoothed channel fits file
+    """
+    return fitsname.replace(".fits", "") + ".smoothed.fits"
+
+
+def smoother(fitsnames, conf, beam=None):
+    """Smooth channel images to common resolution
+
+    The backend is chosen with `smoothingBackend`: "fft" convolves in memory,
+    "casa" uses importfits/imsmooth/exportfits and is kept as reference. The
+    "fft" backend smoothes up to `buildcubeWorkers` channels at once within
+    `cubeMemoryBudget`.
+
+    Args:
+        fitsnames (list): List of fits files to be smoothed
+        conf (config): Config object
+        beam (tuple): Target resolution from `get_smoothing_beam`. Derived
+            from `fitsnames` if not given.
+
+    Returns:
+        list: List of smoothed fits files
+    """    
+    if not beam:
+        beam = get_smoothing_beam(fitsnames, conf)
+    if conf.input.smoothingBackend == "casa":
+        return smoother_casa(fitsnames, beam)
+    if not fitsnames:
+        return []
+    header = fits.getheader(fitsnames[0])
+    workers = max(1, int(conf.input.buildcubeWorkers or 1))
+    smoothingWorkers = get_smoothingWorkers(header["NAXIS2"], header["NAXIS1"], float(conf.input.cubeMemoryBudget) * 1024**3, workers)
+    if smoothingWorkers < workers:
+        info(f"Smoothing {smoothingWorkers} instead of {workers} channels at once to stay within cubeMemoryBudget.")
+    return smoother_fft(fitsnames, beam, workers=smoothingWorkers)
+
+
+def smoother_casa(fitsnames, beam):
+    """Smooth channel images to common resolution with CASA imsmooth
+
+    Args:
+        fitsnames (list): List of fits files to be smoothed
+        beam (tuple): Target resolution from `get_smoothing_beam`
+
+    Returns:
+        list: List of smoothed fits files
+    """
+    # CASA is only needed for this backend
+    import casatasks
+    major, minor, pa = beam
+    outSmoothedFitsNames = []
+    for fitsname in fitsnames:
+        outImageName = fitsname.replace(".fits", "")
+        outSmoothedName = outImageName + ".smoothed"
+        outSmoothedFits = get_smoothedFitsname(fitsname)
+
+        info(f"Importing: {fitsname}")
+        casatasks.importfits(
+            fitsimage=fitsname, 
+            imagename=outImageName,
+            overwrite=True,
+        )
+
+        casatasks.imsmooth(
+            imagename=outImageName,
+            outfile=outSmoothedName,
+            targetres=True,
+            kernel="gauss",
+            major=major,
+            minor=minor,
+            pa=pa,
+            overwrite=True,
+        )
+        info(f"Exporting: {outSmoothedFits}")
+        casatasks.exportfits(
+            imagename=outSmoothedName, 
+            fitsimage=outSmoothedFits, 
+            overwrite=True
+        )
+        outSmoothedFitsNames.append(outSmoothedFits)
+    return outSmoothedFitsNames
+
+
+def get_convolution_kernel(header, targetBeam):
+    """Get the kernel that convolves a channel image to the target beam
+
+    Like CASA imsmooth, a target beam that the channel beam can't be convolved
+    to is an error.
+
+    Args:
+        header (fits.Header): Header of the channel image
+        targetBeam (Beam): Target resolution
+
+    Raises:
+        ValueError: If the target beam is smaller than the channel beam
+
+    Returns:
+        tuple: kernel array (None if the channel is already at the target
+            resolution) and the Jy/beam scaling factor
+    """
+    channelBeam = Beam.from_fits_header(header)
+    if is_same_beam(targetBeam, channelBeam):
+        return None, 1.0
+    try:
+        kernelBeam = targetBeam.deconvolve(channelBeam)
+    except (ValueError, BeamError):
+        error(f"Channel beam {get_beamTuple_from_beam(channelBeam)} can't be convolved to the target beam {get_beamTuple_from_beam(targetBeam)}")
+        raise ValueError(f"Target beam {get_beamTuple_from_beam(targetBeam)} is smaller than the channel beam {get_beamTuple_from_beam(channelBeam)}")
+    scaling = (targetBeam.sr / channelBeam.sr).decompose().value
+    pixscale = abs(header["CDELT2"]) * units.deg
+    return kernelBeam.as_kernel(pixscale).array, scaling
+
+
+def smooth_channel_fft(fitsname, targetBeam):
+    """Smooth all Stokes planes of a channel image by FFT convolution
+
+    Blanked pixels are convolved as zeros and blanked again afterwards, the
+    result is scaled to Jy per target beam.
+
+    Args:
+        fitsname (str): Channel fits file
+        targetBeam (Beam): Target resolution
+
+    Returns:
+        str: Smoothed fits file
+    """
+    outSmoothedFits = get_smoothedFitsname(fitsname)
+    info(f"Smoothing: {fitsname}")
+    with fits.open(fitsname) as hud:
+        header = hud[0].header.copy()
+        data = hud[0].data
+        kernel, scaling = get_convolution_kernel(header, targetBeam)
+        smoothedData = np.empty(data.shape, dtype=np.float32)
+        for idx in np.ndindex(data.shape[:-2]):
+            plane = np.asarray(data[idx], dtype=np.float64)
+            nanMask = np.isnan(plane)
+            if kernel is not None:
+                plane = fftconvolve(np.where(nanMask, 0.0, plane), kernel, mode="same")
+                plane[nanMask] = np.nan
+            smoothedData[idx] = plane * scaling
+    header.update(targetBeam.to_header_keywords())
+    fits.writeto(outSmoothedFits, smoothedData, header, overwrite=True)
+    return outSmoothedFits
+
+
+def smoother_fft(fitsnames, beam, workers=1):
+    """Smooth channel images to common resolution in memory, parallel over channels
+
+    Args:
+        fitsnames (list): List of fits files to be smoothed
+        beam (tuple): Target resolution from `get_smoothing_beam`
+        workers (int): Number of worker processes
+
+    Returns:
+        list: List of smoothed fits files
+    """
+    targetBeam = get_beam_from_beamTuple(beam)
+    if workers <= 1 or len(fitsnames) <= 1:
+        return [smooth_channel_fft(fitsname, targetBeam) for fitsname in fitsnames]
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        return pool.starmap(smooth_channel_fft, [(fitsname, targetBeam) for fitsname in fitsnames])
+
+
+def smooth_after_imaging(fitsnames, conf):
+    """Smooth freshly imaged channels to the beam agreed ahead of buildcube
+
+    Called by the imaging scripts if `smoothInImaging` is set, buildcube then
+    reuses the smoothed channel images.
+
+    Args:
+        fitsnames (list): List of fits files to be smoothed
+        conf (config): Config object
+
+    Returns:
+        list: List of smoothed fits files
+    """
+    beamDict = {}
+    for fitsname in fitsnames:
+        beamDict.setdefault(get_imaging_smoothing_beam(fitsname, conf), []).append(fitsname)
+    outSmoothedFitsNames = []
+    for beam, beamFitsnames in beamDict.items():
+        info(f"Smoothing {len(beamFitsnames)} channel images to: {beam}")
+        outSmoothedFitsNames += smoother(beamFitsnames, conf, beam=beam)
+    return outSmoothedFitsNames
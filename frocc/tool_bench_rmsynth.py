@@ -0,0 +1,104 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ Benchmark of the RM synthesis kernels of `cube_rmsynth.py`. Synthetic Stokes
+ Q and U spectra of Faraday thin components with Gaussian noise are sampled
+ at equally spaced channels between 880 and 1680 MHz, a few channels are
+ flagged. The FDFs of all pixels get computed with the "direct" kernel and
+ the "nufft" kernel for every tolerance. Wall time, speedup and the largest
+ error relative to the weighted mean polarised intensity of a pixel are
+ reported per number of channels and Faraday depths. The time to compute the
+ kernel or the NUFFT plan once per channel pattern is reported separately.
+
+ Usage: python3 tool_bench_rmsynth.py --channels 300,1000,3000 --phis 201,1001,4001
+
+------------------------------------------------------------------------------
+"""
+
+import time
+import click
+import numpy as np
+
+from frocc.cube_rmsynth import get_rmsynth_kernel, get_nufft_plan, get_nufft_spread, get_fdf, SPEED_OF_LIGHT
+from frocc.lhelpers import SEPERATOR
+from frocc.logger import *
+
+FIRST_FREQ = 880e6  # Hz
+LAST_FREQ = 1680e6  # Hz
+FLAGGED_FRACTION = 0.1
+
+
+def get_synthetic_spectra(noOfChan, noOfPixels, rng, noOfComponents=3):
+    '''
+    Returns lambda^2 and weights of the channels with data and the complex
+    polarisation [pixel, chan] of Faraday thin components with noise.
+    '''
+    frequencies = np.linspace(FIRST_FREQ, LAST_FREQ, noOfChan)
+    hasData = rng.random(noOfChan) >= FLAGGED_FRACTION
+    lambdaSqArray = (SPEED_OF_LIGHT / frequencies[hasData])**2
+    noise = rng.uniform(0.5, 2., len(lambdaSqArray)) * 1e-4
+    weights = 1 / noise**2
+    amplitudes = rng.uniform(0., 1e-2, (noOfPixels, noOfComponents))
+    phiComponents = rng.uniform(-300., 300., (noOfPixels, noOfComponents))
+    angles = rng.uniform(0., np.pi, (noOfPixels, noOfComponents))
+    pol = np.einsum("pc,pcl->pl", amplitudes, np.exp(2j * (angles[:, :, None] + phiComponents[:, :, None] * lambdaSqArray[None, None, :])))
+    pol += (rng.normal(size=pol.shape) + 1j * rng.normal(size=pol.shape)) * noise
+    return lambdaSqArray, weights, pol
+
+
+def get_phiArray(lambdaSqArray, noOfPhi):
+    '''
+    Returns `noOfPhi` Faraday depths in steps of a tenth of the theoretical
+    RMSF FWHM, centred on zero.
+    '''
+    dPhi = 2 * np.sqrt(3) / (np.max(lambdaSqArray) - np.min(lambdaSqArray)) / 10
+    return dPhi * (np.arange(noOfPhi) - noOfPhi // 2)
+
+
+def get_best_runtime_and_fdf(pol, kernel, repeats):
+    '''
+    Returns the fastest wall time of `repeats` runs and the FDFs.
+    '''
+    runtimeList = []
+    for ii in range(repeats):
+        start = time.perf_counter()
+        fdf = get_fdf(pol, kernel)
+        runtimeList.append(time.perf_counter() - start)
+    return min(runtimeList), fdf
+
+
+@click.command()
+@click.option("--channels", default="300,1000,3000", help="Comma separated numbers of channels.")
+@click.option("--phis", default="201,1001,4001", help="Comma separated numbers of Faraday depths.")
+@click.option("--tolerances", default="1e-3,1e-6,1e-9", help="Comma separated tolerances of the NUFFT kernel.")
+@click.option("--pixels", default=1024, help="Number of pixels.")
+@click.option("--repeats", default=3, help="Runs per kernel, the fastest one is reported.")
+def main(channels, phis, tolerances, pixels, repeats):
+    rng = np.random.default_rng(42)
+    info(SEPERATOR)
+    info("channels\tphis\tkernel\ttolerance\tspread\tsetup [s]\truntime [s]\tspeedup\tmax relative error")
+    for noOfChan in [int(value) for value in channels.split(",")]:
+        lambdaSqArray, weights, pol = get_synthetic_spectra(noOfChan, pixels, rng)
+        meanPI = np.abs(pol) @ weights / np.sum(weights)
+        for noOfPhi in [int(value) for value in phis.split(",")]:
+            phiArray = get_phiArray(lambdaSqArray, noOfPhi)
+            start = time.perf_counter()
+            kernel = get_rmsynth_kernel(weights, lambdaSqArray, phiArray)
+            setupRuntime = time.perf_counter() - start
+            directRuntime, directFdf = get_best_runtime_and_fdf(pol, kernel, repeats)
+            del kernel
+            info(f"{noOfChan}\t{noOfPhi}\tdirect\t-\t-\t{setupRuntime:.4f}\t{directRuntime:.4f}\t1.0\t-")
+            for tolerance in [float(value) for value in tolerances.split(",")]:
+                start = time.perf_counter()
+                plan = get_nufft_plan(weights, lambdaSqArray, phiArray, tolerance)
+                setupRuntime = time.perf_counter() - start
+                runtime, fdf = get_best_runtime_and_fdf(pol, plan, repeats)
+                error = np.max(np.abs(fdf - directFdf).max(axis=1) / meanPI)
+                info(f"{noOfChan}\t{noOfPhi}\tnufft\t{tolerance:.0e}\t{2 * get_nufft_spread(tolerance)}\t{setupRuntime:.4f}\t{runtime:.4f}\t{directRuntime / runtime:.1f}\t{error:.2e}")
+    info(SEPERATOR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ Benchmark of the robust RMS noise estimators in `lhelpers.get_std_via_mad`.
+ Synthetic Gaussian noise planes with a few bright pixels and a blanked
+ corner are measured with every `robustStatsMethod`. Wall time and the
+ relative error against the "exact" method are reported per image size.
+
+ Usage: python3 tool_bench_robust_stats.py --sizes 512,2048,8192
+
+------------------------------------------------------------------------------
+"""
+
+import time
+import click
+import numpy as np
+
+from frocc.lhelpers import get_std_via_mad, SEPERATOR
+from frocc.logger import *
+
+METHOD_LIST = ["exact", "subsample", "histogram"]
+
+
+def get_synthetic_plane(imSize, rng, rms=1e-4):
+    '''
+    Returns a big-endian float32 plane, as read from a fits file, with Gaussian
+    noise, a row of bright pixels and a blanked corner.
+    '''
+    plane = (rng.normal(size=(imSize, imSize)) * rms).astype(">f4")
+    plane[imSize // 2, : imSize // 16] = 1.0
+    plane[: imSize // 32, : imSize // 32] = np.nan
+    return plane
+
+
+def get_best_runtime_and_std(plane, method, repeats):
+    '''
+    Returns the fastest wall time of `repeats` runs and the estimated std.
+    '''
+    runtimeList = []
+    for ii in range(repeats):
+        start = time.perf_counter()
+        std = get_std_via_mad(plane, method=method)
+        runtimeList.append(time.perf_counter() - start)
+    return min(runtimeList), std
+
+
+@click.command()
+@click.option("--sizes", default="512,1024,2048,4096,8192", help="Comma separated image sizes in px.")
+@click.option("--repeats", default=3, help="Runs per method, the fastest one is reported.")
+def main(sizes, repeats):
+    rng = np.random.default_rng(42)
+    info(SEPERATOR)
+    info("imSize [px]\tmethod\truntime [s]\tspeedup\trelative error")
+    for imSize in [int(size) for size in sizes.split(",")]:
+        plane = get_synthetic_plane(imSize, rng)
+        exactRuntime, exactStd = get_best_runtime_and_std(plane, "exact", repeats)
+        for method in METHOD_LIST:
+            if method == "exact":
+                runtime, std = exactRuntime, exactStd
+            else:
+                runtime, std = get_best_runtime_and_std(plane, method, repeats)
+            info(f"{imSize}\t{method}\t{runtime:.4f}\t{exactRuntime / runtime:.1f}\t{abs(std - exactStd) / exactStd:.2e}")
+    info(SEPERATOR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ Benchmark of the post-imaging stages on synthetic channel images.
+ Full Stokes IQUV channel fits files with Gaussian noise, a point source, a
+ configurable fraction of missing and blanked channels and a frequency dependent
+ beam are written to a temporary working directory. Every stage runs in a
+ forked child process, which reports its wall time, peak RSS and the bytes
+ read and written from `/proc/self/io`. Worker processes of the stages are
+ not included, so with `--workers` > 1 peak RSS and I/O are lower bounds.
+
+ Usage: frocc --bench --scales 512x32,1024x64
+        python3 tool_bench_stages.py --scales 512x32,1024x64
+
+------------------------------------------------------------------------------
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+import click
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import get_config_in_dot_notation, get_channel_index, get_channelFitsfileList_from_index, get_dict_from_statsFile, get_peak_rss, SEPERATOR, DotMap
+from frocc.config import FILEPATH_CONFIG_TEMPLATE_ORIGINAL
+from frocc.logger import *
+
+BASENAME = "bench"
+REFERENCE_FREQ = 0.9e9  # Hz
+CHANNEL_WIDTH = 2.5e6  # Hz
+PIXEL_SIZE = 1.5  # arcsec
+REFERENCE_BEAM = 8.  # arcsec at REFERENCE_FREQ
+
+
+def get_bench_conf(workDir, nchan, workers):
+    '''
+    Returns a config with all output paths pointing into `workDir`.
+    '''
+    conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE_ORIGINAL, configFilename="")
+    conf.input.basename = BASENAME
+    conf.input.dirOutput = workDir
+    conf.input.dirHdf5Output = workDir
+    conf.input.smoothbeam = f"{np.ceil(REFERENCE_BEAM * 1.5)}arcsec"
+    conf.input.buildcubeWorkers = workers
+    conf.input.fileXYphasePolAngleCoeffs = ""
+    for dirKey in conf.env.dirList:
+        conf.env[dirKey] = os.path.join(workDir, conf.env[dirKey])
+        os.makedirs(conf.env[dirKey], exist_ok=True)
+    conf.data = DotMap({"field": "BENCH", "predictedOutputChannels": [list(range(1, nchan + 1))]})
+    return conf
+
+
+def write_synthetic_channel_images(conf, imSize, nchan, nanFraction, flaggedFraction, beamVariation, seed=42):
+    '''
+    Writes synthetic IQUV channel images as exported by the imaging.
+
+    Parameters
+    ----------
+    nanFraction: float
+       Fraction of channel images that are entirely blanked
+    flaggedFraction: float
+       Fraction of channels without image
+    beamVariation: float
+       Relative random scatter of the beam on top of the 1/frequency scaling
+    '''
+    rng = np.random.default_rng(seed)
+    # the lowest channel always holds data
+    chanNoArray = rng.permutation(np.arange(2, nchan + 1))
+    noOfFlagged = int(flaggedFraction * nchan)
+    flaggedChanNoSet = set(chanNoArray[:noOfFlagged].tolist())
+    blankedChanNoSet = set(chanNoArray[noOfFlagged:noOfFlagged + int(nanFraction * nchan)].tolist())
+    for chanNo in range(1, nchan + 1):
+        if chanNo in flaggedChanNoSet:
+            continue
+        freq = REFERENCE_FREQ + CHANNEL_WIDTH * chanNo
+        data = (rng.normal(size=(4, 1, imSize, imSize)) * 1e-4).astype(np.float32)
+        data[:, 0, imSize // 2, imSize // 3] = [1., 0.1, 0.05, 0.01]
+        if chanNo in blankedChanNoSet:
+            data[:] = np.nan
+        beam = REFERENCE_BEAM * REFERENCE_FREQ / freq * (1 + beamVariation * rng.random())
+        header = fits.Header()
+        header["CTYPE1"], header["CRPIX1"], header["CDELT1"], header["CRVAL1"] = "RA---SIN", imSize / 2, -PIXEL_SIZE / 3600, 150.
+        header["CTYPE2"], header["CRPIX2"], header["CDELT2"], header["CRVAL2"] = "DEC--SIN", imSize / 2, PIXEL_SIZE / 3600, 2.
+        header["CTYPE3"], header["CRPIX3"], header["CDELT3"], header["CRVAL3"] = "FREQ", 1, CHANNEL_WIDTH, freq
+        header["CTYPE4"], header["CRPIX4"], header["CDELT4"], header["CRVAL4"] = "STOKES", 1, 1, 1
+        header["BMAJ"], header["BMIN"], header["BPA"] = beam / 3600, 0.8 * beam / 3600, 0.
+        filepath = conf.env.dirImages + conf.input.basename + conf.env.markerChannel + str(chanNo).zfill(3) + conf.env.extTcleanImage
+        fits.writeto(filepath, data, header, overwrite=True)
+
+
+def get_proc_io():
+    '''
+    Returns the I/O counters of this process from `/proc/self/io`.
+    '''
+    ioDict = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                ioDict[key] = int(value)
+    except OSError:
+        pass
+    return ioDict
+
+
+def run_stage_in_child(stageFunction, conn):
+    '''
+    Runs `stageFunction` and sends wall time, peak RSS and I/O to `conn`.
+    '''
+    try:
+        # reset the peak RSS inherited from the parent process
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    ioStart = get_proc_io()
+    start = time.perf_counter()
+    try:
+        stageFunction()
+        status = "ok"
+    except Exception as e:
+        status = f"failed: {type(e).__name__}: {e}"
+    runtime = time.perf_counter() - start
+    ioEnd = get_proc_io()
+    ioDelta = {key: ioEnd[key] - ioStart.get(key, 0) for key in ioEnd}
+    conn.send({"status": status, "runtime": runtime, "peakRSS": get_peak_rss(), "io": ioDelta})
+    conn.close()
+
+
+def run_stage(stageFunction):
+    '''
+    Runs `stageFunction` in a forked child process and returns its measurements.
+    '''
+    context = multiprocessing.get_context("fork")
+    parentConn, childConn = context.Pipe(duplex=False)
+    process = context.Process(target=run_stage_in_child, args=(stageFunction, childConn))
+    process.start()
+    result = parentConn.recv() if parentConn.poll(None) else {}
+    process.join()
+    return result
+
+
+def get_stageList(conf):
+    '''
+    Returns the stages as list of [name, function], in pipeline order.
+    '''
+    # imported here, so the import time is not part of the first stage
+    from frocc import cube_ior_flagging, cube_average_map
+    from frocc.cube_buildcube import build_cube_partition
+    from frocc.smoothing import smoother_fft, get_smoothing_beam
+    cube_ior_flagging.CREATE_ITERATION_PLOTS = False
+    try:
+        from frocc.cube_report import generate_preview_jpg
+    except ImportError as e:
+        warning(f"Preview stage not available: {e}")
+        generate_preview_jpg = None
+
+    def stage_smooth():
+        fitsnames = get_channelFitsfileList_from_index(get_channel_index(conf))
+        smoother_fft(fitsnames, get_smoothing_beam(fitsnames, conf), workers=int(conf.input.buildcubeWorkers))
+
+    def stage_build_cube():
+        build_cube_partition(conf, "normal")
+
+    def stage_update_cube():
+        # all channels are unchanged, only the manifest gets checked
+        build_cube_partition(conf, "normal")
+
+    def stage_build_smoothed_cube():
+        # reuses the channel images of the smooth stage
+        build_cube_partition(conf, "smoothed")
+
+    def stage_ior_fit():
+        statsDict = get_dict_from_statsFile(conf.input.basename + conf.env.extCubeStatistics)
+        cube_ior_flagging.get_outlierIndex_and_fitStats_dict(statsDict, conf)
+
+    def stage_average_map():
+        cube_average_map.make_empty_image(conf, mode="normal")
+        cube_average_map.fill_cube_with_images(conf, mode="normal")
+
+    def stage_preview_jpg():
+        generate_preview_jpg(conf)
+
+    stageList = [
+        ["smooth (fft)", stage_smooth],
+        ["build_cube", stage_build_cube],
+        ["update_cube", stage_update_cube],
+        ["build_smoothed_cube", stage_build_smoothed_cube],
+        ["ior_fit", stage_ior_fit],
+        ["average_map", stage_average_map],
+        ]
+    if generate_preview_jpg:
+        stageList.append(["preview_jpg", stage_preview_jpg])
+    return stageList
+
+
+def format_bytes(nBytes):
+    '''
+    Returns `nBytes` as human readable string.
+    '''
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(nBytes) < 1024:
+            return f"{nBytes:.1f}{unit}"
+        nBytes /= 1024
+    return f"{nBytes:.1f}TB"
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True, allow_extra_args=True))
+@click.option("--scales", default="256x16,512x32,1024x64", help="Comma separated <imsize>x<nchan> scales.")
+@click.option("--nanFraction", "nanFraction", default=0.05, help="Fraction of entirely blanked channel images.")
+@click.option("--flaggedFraction", "flaggedFraction", default=0.05, help="Fraction of channels without image.")
+@click.option("--beamVariation", "beamVariation", default=0.05, help="Relative random scatter of the channel beams.")
+@click.option("--workers", default=1, help="Number of buildcube worker processes.")
+@click.option("--workDir", "workDir", default="", help="Working directory, a temporary directory if not given.")
+@click.option("--keep", is_flag=True, help="Keep the synthetic data and products.")
+def main(scales, nanFraction, flaggedFraction, beamVariation, workers, workDir, keep):
+    cwd = os.getcwd()
+    resultList = []
+    for scale in scales.split(","):
+        imSize, nchan = [int(value) for value in scale.lower().split("x")]
+        scaleDir = os.path.join(workDir or tempfile.mkdtemp(prefix="frocc-bench-"), f"{imSize}x{nchan}") + "/"
+        os.makedirs(scaleDir, exist_ok=True)
+        os.chdir(scaleDir)
+        info(SEPERATOR)
+        info(f"Benchmark scale: imsize {imSize}, {nchan} channels in {scaleDir}")
+        conf = get_bench_conf(scaleDir, nchan, workers)
+        stageList = [["generate", lambda: write_synthetic_channel_images(conf, imSize, nchan, nanFraction, flaggedFraction, beamVariation)]]
+        for name, stageFunction in stageList + get_stageList(conf):
+            info(f"Running stage: {name}")
+            result = run_stage(stageFunction)
+            resultList.append([scale, name, result])
+            if result.get("status") != "ok":
+                warning(f"Stage {name} {result.get('status')}")
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(scaleDir, ignore_errors=True)
+
+    info(SEPERATOR)
+    if workers > 1:
+        warning("Peak RSS and I/O are measured in the stage process only, without its worker processes.")
+    info("scale\tstage\twall time [s]\tpeak RSS\tread\twritten\tdisk read\tdisk written\tstatus")
+    for scale, name, result in resultList:
+        io = result.get("io", {})
+        info(f"{scale}\t{name}\t{result.get('runtime', np.nan):.3f}\t{format_bytes(result.get('peakRSS', 0))}\t"
+             f"{format_bytes(io.get('rchar', 0))}\t{format_bytes(io.get('wchar', 0))}\t"
+             f"{format_bytes(io.get('read_bytes', 0))}\t{format_bytes(io.get('write_bytes', 0))}\t{result.get('status')}")
+    info(SEPERATOR)
+
+
+if __name__ == "__main__":
+    main()